@@ -0,0 +1,276 @@
+"""
+受け付け制御: クライアントごとのレート制限と、上流のモデルごとの同時呼び出し数の上限
+
+- ClientRateLimiter: クライアント (API キー、無ければ接続元アドレス) ごとのトークンバケット
+  超えたリクエストは 429 と Retry-After で断る
+- ModelGate: モデル (image / text / tts) ごとのセマフォ。空きが無ければ上限付きの待ち行列で待ち、
+  待ち行列が一杯か ADMISSION_MAX_WAIT 秒待っても空かなければ Overloaded (429) を送出する
+
+どちらもプロセスごとの状態のため、gunicorn のワーカーが N 個なら全体の上限は設定値の N 倍になる
+"""
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional
+
+from observability import get_logger, registry
+
+log = get_logger("admission")
+
+# 1 クライアントあたりのレート (1 分あたりのリクエスト数。0 で無効) とバースト
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "60"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+# 覚えておくクライアント数の上限 (超えたら最も古いものから忘れる)
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+# クライアントを識別するヘッダー (無ければ接続元アドレス)
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER", "X-API-Key")
+# リバースプロキシの後ろで動かす場合に X-Forwarded-For の先頭を接続元とみなす
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "").lower() in ("1", "true", "yes")
+
+# モデルごとの同時呼び出し数・待ち行列の長さ
+MODEL_LIMITS = {
+    "image": (int(os.getenv("ADMISSION_IMAGE_CONCURRENCY", "8")), int(os.getenv("ADMISSION_IMAGE_QUEUE", "16"))),
+    "text": (int(os.getenv("ADMISSION_TEXT_CONCURRENCY", "16")), int(os.getenv("ADMISSION_TEXT_QUEUE", "64"))),
+    "tts": (int(os.getenv("ADMISSION_TTS_CONCURRENCY", "8")), int(os.getenv("ADMISSION_TTS_QUEUE", "32"))),
+}
+# 待ち行列で待つ最大秒数と、断るときに返す Retry-After
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+# 上流のサービス (resilience のポリシー名) -> モデル
+UPSTREAM_MODELS = {
+    "gemini_image": "image",
+    "gemini_prompt": "text",
+    "gemini_summary": "text",
+    "gemini_tts": "tts",
+}
+
+QUEUE_DEPTH = registry.gauge("admission_queue_depth", "Calls waiting for an upstream model slot", ("model",))
+IN_FLIGHT = registry.gauge("admission_in_flight", "Upstream calls holding a model slot", ("model",))
+WAIT_SECONDS = registry.histogram(
+    "admission_wait_seconds", "Time spent waiting for an upstream model slot", ("model",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+REJECTED = registry.counter("admission_rejected_total", "Requests rejected by admission control",
+                            ("scope", "reason"))
+
+
+class Overloaded(Exception):
+    """受け付けの上限を超えた (retry_after 秒後に再試行できる)"""
+
+    def __init__(self, scope: str, reason: str, retry_after: float):
+        super().__init__(f"{scope} is overloaded ({reason}, retry after {retry_after:.0f}s)")
+        self.scope = scope
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """rate 個/秒で補充され、最大 burst 個まで貯まるトークン"""
+
+    def __init__(self, rate: float, burst: int, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+
+    def take(self) -> float:
+        """トークンを 1 つ使う。足りなければ使わずに、次のトークンまでの秒数を返す (使えたら 0)"""
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+
+class ClientRateLimiter:
+    """クライアントごとのトークンバケット (最近使われた max_clients 件だけを覚える)"""
+
+    def __init__(self, per_minute: float = RATE_LIMIT_PER_MINUTE, burst: int = RATE_LIMIT_BURST,
+                 max_clients: int = RATE_LIMIT_MAX_CLIENTS, clock: Callable[[], float] = time.monotonic):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        self._clock = clock
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def check(self, client: str) -> None:
+        """リクエストを 1 件受け付ける。上限を超えていれば Overloaded"""
+        if not self.enabled:
+            return
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = TokenBucket(self.rate, self.burst, self._clock)
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+            wait = bucket.take()
+        if wait:
+            REJECTED.inc(scope="client", reason="rate_limited")
+            log.info("client rate limited", client=client, retry_after_s=round(wait, 1))
+            raise Overloaded("client", "rate_limited", wait)
+
+
+def client_key(headers, remote_addr: Optional[str]) -> str:
+    """レート制限のキー (API キーのヘッダー、無ければ接続元アドレス)"""
+    api_key = headers.get(RATE_LIMIT_KEY_HEADER)
+    if api_key:
+        return f"key:{api_key}"
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = headers.get("X-Forwarded-For")
+        if forwarded:
+            return f"addr:{forwarded.split(',')[0].strip()}"
+    return f"addr:{remote_addr or 'unknown'}"
+
+
+class _Waiter:
+    """待ち行列の 1 件 (スレッドは Event、asyncio は Future で起こす)"""
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop
+        self.granted = False
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self) -> None:
+        """ロック取得済みで呼ぶ (枠を譲る)"""
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class ModelGate:
+    """
+    モデルへの同時呼び出し数を limit 件に制限するセマフォ
+    空きを待てるのは max_queue 件・max_wait 秒まで (超えたら Overloaded)。空いた枠は到着順に渡す
+    スレッドからは acquire / slot、asyncio からは acquire_async と release で使う
+    (asyncio の待ちはスレッドを使わず Future で待つ)
+    """
+
+    def __init__(self, model: str, limit: int, max_queue: int, max_wait: float = ADMISSION_MAX_WAIT,
+                 retry_after: float = ADMISSION_RETRY_AFTER, clock: Callable[[], float] = time.monotonic):
+        self.model = model
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._clock = clock
+        self._active = 0
+        self._waiters: Deque[_Waiter] = deque()
+        self._lock = threading.Lock()
+
+    def _reject(self, reason: str) -> Overloaded:
+        REJECTED.inc(scope=self.model, reason=reason)
+        log.warning("upstream model overloaded", model=self.model, reason=reason,
+                    in_flight=self._active, queued=len(self._waiters))
+        return Overloaded(self.model, reason, self.retry_after)
+
+    def _enter(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> Optional[_Waiter]:
+        """空きがあれば確保して None、無ければ待ち行列に入れた _Waiter (一杯なら Overloaded)"""
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                IN_FLIGHT.set(self._active, model=self.model)
+                return None
+            if len(self._waiters) >= self.max_queue:
+                raise self._reject("queue_full")
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            QUEUE_DEPTH.set(len(self._waiters), model=self.model)
+            return waiter
+
+    def _leave(self, waiter: _Waiter) -> bool:
+        """待つのをやめる。その前に枠を譲られていたら True"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            QUEUE_DEPTH.set(len(self._waiters), model=self.model)
+            return False
+
+    def try_acquire(self) -> bool:
+        """待たずに空きがあれば確保して True"""
+        with self._lock:
+            if self._active >= self.limit or self._waiters:
+                return False
+            self._active += 1
+            IN_FLIGHT.set(self._active, model=self.model)
+            return True
+
+    def acquire(self) -> None:
+        started = self._clock()
+        waiter = self._enter()
+        if waiter is not None:
+            if not waiter.event.wait(self.max_wait) and not self._leave(waiter):
+                raise self._reject("wait_timeout")
+        WAIT_SECONDS.observe(self._clock() - started, model=self.model)
+
+    async def acquire_async(self) -> None:
+        started = self._clock()
+        waiter = self._enter(asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+            except asyncio.TimeoutError:
+                if not self._leave(waiter):
+                    raise self._reject("wait_timeout")
+            except asyncio.CancelledError:
+                if self._leave(waiter):
+                    self.release()  # 取り消される直前に譲られた枠を次に渡す
+                raise
+        WAIT_SECONDS.observe(self._clock() - started, model=self.model)
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().wake()  # 実行中の数は変えずに枠を渡す
+                QUEUE_DEPTH.set(len(self._waiters), model=self.model)
+                return
+            self._active -= 1
+            IN_FLIGHT.set(self._active, model=self.model)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+_gates: Dict[str, ModelGate] = {}
+_gates_lock = threading.Lock()
+
+
+def model_gate(model: str) -> ModelGate:
+    with _gates_lock:
+        gate = _gates.get(model)
+        if gate is None:
+            limit, max_queue = MODEL_LIMITS[model]
+            gate = _gates[model] = ModelGate(model, limit, max_queue)
+        return gate
+
+
+def upstream_gate(service: str) -> Optional[ModelGate]:
+    """上流のサービス (gemini_tts など) の呼び出しを制限するゲート (対象外なら None)"""
+    model = UPSTREAM_MODELS.get(service)
+    return model_gate(model) if model else None
+
+
+client_limiter = ClientRateLimiter()
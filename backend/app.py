@@ -1,38 +1,61 @@
 import os
 import io
-from flask import Flask, request, jsonify, send_from_directory, make_response
+import json
+import re
+import tempfile
+import math
+import time
+import unicodedata
+from contextlib import ExitStack
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory, make_response, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
 from dotenv import load_dotenv
 import google.generativeai as genai
 import pkg_resources # Import pkg_resources
 # Remove direct type imports if they cause issues with the installed version
 # from google.generativeai import types # Commented out or remove
-from PIL import Image
 import base64
-import traceback # Keep for error logging
 
 # Import TTS service
-from tts_service import TTSService
+from tts_service import TTSService, wave_file
+from cache import LRUCache, DiskCache, TieredCache, make_cache_key
+from blob_store import BlobStore
+from conversation_store import ConversationStore
+from jobs import JobManager, QueueFull
+from pdf_text import iter_pdf_pages
+from uploads import MAX_UPLOAD_BYTES, MemoryBudgetExceeded, SpoolingRequest, Upload, accounting as upload_accounting
+from image_preprocess import normalize_inline_image, stats as image_preprocess_stats
+from audio_codec import AUDIO_FORMATS, encode_pcm, mime_type_for, read_wav_pcm, supported_formats
+from observability import get_logger, registry as metrics_registry, span
+from resilience import CircuitOpenError, primed, upstream_policy
+from admission import Overloaded, client_key, client_limiter
+from singleflight import SingleFlight
 
 load_dotenv()
 
+log = get_logger("app")
+
 app = Flask(__name__, static_folder='../frontend', static_url_path='')
+# アップロードは一時ファイルに受信し (メモリに全体を読み込まない)、サイズ上限を超えたら 413
+app.request_class = SpoolingRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 
 # Initialize TTS service with error handling
 tts_service = None
 try:
     from tts_service import TTSService
     tts_service = TTSService()
-    print("TTS service initialized successfully")
+    log.info("TTS service initialized")
 except Exception as e:
-    print(f"Warning: TTS service initialization failed: {e}")
-    print("TTS features will not be available, but image generation will still work")
+    # TTS 機能は使えないが、画像生成は動作する
+    log.warning("TTS service initialization failed", error=e)
 
 # Print the installed version
 try:
     version = pkg_resources.get_distribution("google-generativeai").version
-    print(f"--- Using google-generativeai version: {version} ---")
+    log.info("google-generativeai version", version=version)
 except pkg_resources.DistributionNotFound:
-    print("--- google-generativeai package not found ---")
+    log.warning("google-generativeai package not found")
 
 # Configure the Gemini API client
 api_key = os.getenv("GOOGLE_API_KEY")
@@ -42,6 +65,9 @@ genai.configure(api_key=api_key)
 
 # Removed helper function create_content_part as we construct dictionaries directly
 
+# 内容ハッシュで識別する配信物 (画像・音声) のキャッシュ期間
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
 @app.route('/')
 def index():
     return send_from_directory(app.static_folder, 'index.html')
@@ -55,6 +81,70 @@ def tts_index():
 def tts_static(filename):
     return send_from_directory('../frontend/tts', filename)
 
+# リクエストの処理時間 (ストリーミングの場合はレスポンスヘッダーを返すまで)
+HTTP_SECONDS = metrics_registry.histogram(
+    "http_request_duration_seconds", "Time until the response headers are returned",
+    ("endpoint", "method", "status"))
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+# 外部 API (Gemini) を呼ぶエンドポイント (クライアントごとのレート制限の対象)
+RATE_LIMITED_ENDPOINTS = {"generate_image", "generate_speech", "preview_voice", "summarize_text", "stream_speech"}
+
+@app.before_request
+def _admit_client():
+    """クライアントごとのレート制限 (超えたら Overloaded で 429)"""
+    if request.endpoint in RATE_LIMITED_ENDPOINTS:
+        client_limiter.check(client_key(request.headers, request.remote_addr))
+
+@app.after_request
+def _record_request_duration(response):
+    started = g.get("request_started")
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint,
+                             method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 形式のメトリクス (処理段階ごとの時間・外部 API のエラー数・リクエスト時間。METRICS_DIR があれば全ワーカーの合計)"""
+    return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"success": False, "error": f"ファイルサイズが上限 ({MAX_UPLOAD_BYTES // (1024 * 1024)}MB) を超えています"}), 413
+
+@app.errorhandler(MemoryBudgetExceeded)
+def upload_memory_exceeded(e):
+    response = jsonify({"success": False, "error": str(e)})
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+def _unavailable_response(error, retry_after, status=503):
+    """
+    外部 API を呼べない間のレスポンス (Retry-After 付き)
+    サーキットブレーカーが開いている間は 503、受け付けの上限 (admission) を超えた場合は 429
+    """
+    response = jsonify({"success": False, "error": error})
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response, status
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    if e.scope == "client":
+        return _unavailable_response("リクエストが多すぎます。しばらくしてから再度お試しください。", e.retry_after, 429)
+    return _unavailable_response("サービスが混雑しています。しばらくしてから再度お試しください。", e.retry_after, 429)
+
+def _service_error(result, default_error):
+    """TTS サービスの失敗結果のレスポンス (retry_after があれば外部 API を呼べなかったとして 503 / 429)"""
+    if result.get("retry_after") is not None:
+        return _unavailable_response(result.get("error", default_error), result["retry_after"],
+                                     result.get("status", 503))
+    return jsonify({"success": False, "error": result.get("error", default_error)}), 500
+
 # TTS API Endpoints
 @app.route('/api/tts/extract-text', methods=['POST'])
 def extract_text():
@@ -70,21 +160,162 @@ def extract_text():
         if file.filename == '':
             return jsonify({"success": False, "error": "ファイルが選択されていません"}), 400
         
-        # Read file content
-        file_content = file.read()
-        file_type = file.content_type
-        filename = file.filename
-        
-        # Extract text using TTS service
-        result = tts_service.extract_text_from_file(file_content, file_type, filename)
+        # 受信済みの一時ファイルをそのまま渡す (file.read() で全体をメモリに載せない)
+        with Upload.from_file_storage(file) as upload:
+            result = tts_service.extract_text_from_file(upload, upload.content_type, upload.filename,
+                                                        pages=request.form.get('pages'))
         
         return jsonify(result)
         
+    except (MemoryBudgetExceeded, RequestEntityTooLarge):
+        raise
     except Exception as e:
-        print(f"Text extraction endpoint error: {e}")
-        traceback.print_exc()
+        log.exception("text extraction endpoint error")
         return jsonify({"success": False, "error": f"テキスト抽出エラー: {str(e)}"}), 500
 
+@app.route('/api/tts/extract-text/batch', methods=['POST'])
+def extract_text_batch():
+    """
+    複数ファイル (files フィールド) のテキストを並列に抽出し、終わった順に NDJSON で返す
+    1 行目以降: ファイルごとの結果 (index・filename・elapsed_ms など)
+    最終行: {"done": true, "files", "succeeded", "failed", "total_ms"}
+    """
+    if not tts_service:
+        return jsonify({"success": False, "error": "TTS機能が利用できません。システム管理者にお問い合わせください。"}), 503
+
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({"success": False, "error": "ファイルが選択されていません"}), 400
+
+    # 途中のファイルで上限を超えたら作成済みのものを閉じる。作成できたらレスポンスの終了時に閉じる
+    with ExitStack() as stack:
+        uploads = [stack.enter_context(Upload.from_file_storage(file)) for file in files]
+        close_uploads = stack.pop_all().close
+
+    def lines():
+        started = time.perf_counter()
+        succeeded = 0
+        try:
+            for result in tts_service.iter_extract_files(
+                [(upload, upload.content_type, upload.filename) for upload in uploads]
+            ):
+                if result.get("success"):
+                    succeeded += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            close_uploads()
+        yield json.dumps({
+            "done": True,
+            "files": len(uploads),
+            "succeeded": succeeded,
+            "failed": len(uploads) - succeeded,
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+        }) + "\n"
+
+    response = Response(
+        stream_with_context(lines()),
+        mimetype='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(close_uploads)  # 本文を送る前に接続が切れた場合
+    return response
+
+@app.route('/api/tts/extract-text/images', methods=['POST'])
+def extract_text_from_images():
+    """複数の画像 (files フィールド) をまとめて OCR し、アップロード順に連結したテキストを返す"""
+    if not tts_service:
+        return jsonify({"success": False, "error": "TTS機能が利用できません。システム管理者にお問い合わせください。"}), 503
+
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({"success": False, "error": "ファイルが選択されていません"}), 400
+    unsupported = [file.filename for file in files if file.content_type not in ('image/jpeg', 'image/png')]
+    if unsupported:
+        return jsonify({"success": False, "error": f"画像以外のファイルが含まれています: {', '.join(unsupported)}"}), 400
+
+    with ExitStack() as stack:
+        uploads = [stack.enter_context(Upload.from_file_storage(file)) for file in files]
+        result = tts_service.ocr_images([upload.read_bytes() for upload in uploads])
+    if result.get("success"):
+        for page in result["images"]:
+            page["filename"] = files[page["index"]].filename
+    return jsonify(result)
+
+@app.route('/api/tts/extract-text/lookup', methods=['POST'])
+def lookup_extracted_text():
+    """
+    ファイルの SHA-256 だけを受け取り、抽出済みならその結果を返す (アップロードを省略するための事前確認)
+    未抽出なら 404 を返すので、クライアントは通常どおり /api/tts/extract-text にアップロードする
+    """
+    if not tts_service:
+        return jsonify({"success": False, "error": "TTS機能が利用できません。システム管理者にお問い合わせください。"}), 503
+
+    data = request.get_json(silent=True) or {}
+    file_hash = (data.get('file_hash') or '').lower()
+    file_type = data.get('file_type') or ''
+    if not BlobStore.is_valid_digest(file_hash):
+        return jsonify({"success": False, "error": "file_hash には SHA-256 (16進 64 文字) を指定してください"}), 400
+
+    result = tts_service.lookup_extraction(file_hash, file_type, data.get('pages'))
+    if result is None:
+        return jsonify({"success": False, "cached": False}), 404
+    return jsonify(result)
+
+@app.route('/api/tts/extract-text/stream', methods=['POST'])
+def extract_text_stream():
+    """
+    PDF のテキストをページごとに抽出し、終わった順に SSE で送信する
+    page イベント: {"page", "text", "total"} / done イベント: 抽出したページ数 / error イベント
+    """
+    if not tts_service:
+        return jsonify({"success": False, "error": "TTS機能が利用できません。システム管理者にお問い合わせください。"}), 503
+
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({"success": False, "error": "ファイルが選択されていません"}), 400
+    if file.content_type != 'application/pdf':
+        return jsonify({"success": False, "error": "ページ単位の抽出は PDF のみ対応しています"}), 400
+
+    upload = Upload.from_file_storage(file)
+    pages = request.form.get('pages')
+
+    def events():
+        count = 0
+        try:
+            for item in iter_pdf_pages(upload.source(), pages):
+                count += 1
+                yield _sse_event(item, event="page")
+        except Exception as e:
+            log.exception("PDF page streaming error")
+            yield _sse_event({"success": False, "error": f"PDF処理エラー: {str(e)}"}, event="error")
+            return
+        finally:
+            upload.close()
+        yield _sse_event({"success": True, "pages": count, "method": "PyPDF2"}, event="done")
+
+    response = Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(upload.close)  # 本文を送る前に接続が切れた場合
+    return response
+
+def _summarize_params(data):
+    """要約リクエストの (パラメータ, エラーメッセージ)。不正ならパラメータは None"""
+    text = data.get('text')
+    speaker_mode = data.get('speaker_mode', 'single')  # デフォルトは単一話者
+    if not text:
+        return None, "要約するテキストが指定されていません"
+    # auto / direct / hierarchical (長文をセクションごとに並列要約してからまとめる)
+    mode = data.get('mode', 'auto')
+    if mode not in ('auto', 'direct', 'hierarchical'):
+        return None, f"不明な要約モードです: {mode}"
+    section_tokens = data.get('section_tokens')
+    if section_tokens is not None and (not isinstance(section_tokens, int) or section_tokens < 500):
+        return None, "section_tokens は 500 以上の整数で指定してください"
+    return {"text": text, "speaker_mode": speaker_mode, "mode": mode, "section_tokens": section_tokens}, None
+
 @app.route('/api/tts/summarize', methods=['POST'])
 def summarize_text():
     """テキストを要約"""
@@ -93,22 +324,115 @@ def summarize_text():
         
     try:
         data = request.get_json()
-        text = data.get('text')
-        speaker_mode = data.get('speaker_mode', 'single')  # デフォルトは単一話者
+        params, error = _summarize_params(data)
+        if error:
+            return jsonify({"success": False, "error": error}), 400
         
-        if not text:
-            return jsonify({"success": False, "error": "要約するテキストが指定されていません"}), 400
+        if data.get('async'):
+            return _submit_job("summarize", params)
         
         # Summarize using TTS service
-        result = tts_service.summarize_text(text, speaker_mode)
+        result = tts_service.summarize_text(params["text"], params["speaker_mode"], mode=params["mode"],
+                                            section_tokens=params["section_tokens"])
+        if not result.get("success") and result.get("retry_after") is not None:
+            return _service_error(result, "要約に失敗しました")
         
         return jsonify(result)
         
     except Exception as e:
-        print(f"Summarization endpoint error: {e}")
-        traceback.print_exc()
+        log.exception("summarization endpoint error")
         return jsonify({"success": False, "error": f"要約エラー: {str(e)}"}), 500
 
+# 生成音声の保存先 (delivery="url" で返す音声 ID の実体)
+audio_store = BlobStore(
+    os.getenv("AUDIO_STORE_DIR", os.path.join(tempfile.gettempdir(), "image-app", "audio")),
+    max_bytes=int(os.getenv("AUDIO_STORE_MAX_BYTES", str(1024 * 1024 * 1024))),
+)
+
+def _negotiate_audio(data, accept=None):
+    """
+    音声の返却方法と形式を決める
+    返却方法: json (base64 を JSON に埋め込む・既定) / binary (音声バイナリをそのまま返す) / url (保存して ID と URL を返す)
+    形式: format パラメータ、なければ Accept ヘッダー (audio/flac など)、どちらもなければ wav
+    accept は Accept ヘッダー (werkzeug の MIMEAccept)。省略時は Flask のリクエストから取る
+    """
+    delivery = data.get('delivery')
+    audio_format = (data.get('format') or '').lower() or None
+    mime_to_format = {mime_type_for(name): name for name in reversed(list(AUDIO_FORMATS))}
+    accept = request.accept_mimetypes if accept is None else accept
+    best = accept.best_match(['application/json'] + list(mime_to_format))
+    if best in mime_to_format:
+        delivery = delivery or 'binary'
+        audio_format = audio_format or mime_to_format[best]
+    if delivery not in ('json', 'binary', 'url'):
+        delivery = 'json'
+    return delivery, audio_format or 'wav'
+
+def _audio_format_error(audio_format):
+    """未対応形式ならエラーメッセージを返す"""
+    if audio_format in supported_formats():
+        return None
+    return f"対応していない音声形式です: {audio_format} (対応形式: {', '.join(supported_formats())})"
+
+def _unsupported_audio_format(audio_format):
+    """未対応形式ならエラーレスポンスを返す"""
+    error = _audio_format_error(audio_format)
+    if error is None:
+        return None
+    return jsonify({"success": False, "error": error}), 400
+
+def _audio_response(result, delivery):
+    """TTS の結果を指定された返却方法のレスポンスに変換する"""
+    audio_format = result["format"]
+    if delivery == 'json':
+        # JSON形式でレスポンスを返す
+        return jsonify({
+            "success": True,
+            "audio_data": result["audio_data"],
+            "format": audio_format
+        })
+    if delivery == 'binary':
+        response = send_file(io.BytesIO(result["audio_data"]), mimetype=mime_type_for(audio_format),
+                             conditional=True, etag=False, download_name=f"speech.{audio_format}")
+        response.vary.add("Accept")
+        return response
+    audio_id = audio_store.put(result["audio_data"])
+    return jsonify({
+        "success": True,
+        "audio_id": audio_id,
+        "audio_url": f"/api/tts/audio/{audio_id}",
+        "format": audio_format
+    })
+
+@app.route('/api/tts/audio/<audio_id>', methods=['GET'])
+def get_audio(audio_id):
+    """
+    保存済み音声を返す (Range リクエスト対応でシーク・途中再生が可能)
+    ?format=mp3 などを付けると保存済みの WAV を変換して返す
+    """
+    if not audio_store.path(audio_id):
+        return _audio_not_found()
+    audio_format = (request.args.get('format') or '').lower()
+    if audio_format:
+        error = _unsupported_audio_format(audio_format)
+        if error:
+            return error
+        stored_mime_type = audio_store.mime_type(audio_id)
+        if mime_type_for(audio_format) != stored_mime_type:
+            if stored_mime_type is None:
+                return _audio_not_found()
+            if stored_mime_type != "audio/wav":
+                return jsonify({"success": False, "error": "変換元の音声が WAV ではありません"}), 400
+            wav_data = audio_store.get(audio_id)
+            if wav_data is None:
+                return _audio_not_found()
+            pcm_data, rate, channels = read_wav_pcm(wav_data)
+            audio_id = audio_store.put(encode_pcm(pcm_data, audio_format, rate, channels))
+    return _send_blob(audio_store, audio_id, "private") or _audio_not_found()
+
+def _audio_not_found():
+    return jsonify({"success": False, "error": "音声が見つかりません"}), 404
+
 @app.route('/api/tts/preview-voice', methods=['POST'])
 def preview_voice():
     """音声プレビュー生成"""
@@ -121,22 +445,22 @@ def preview_voice():
         text = data.get('text', 'こんにちは。これは音声のプレビューです。')
         style = data.get('style', '')
         rate = data.get('rate', 1.0)
+        delivery, audio_format = _negotiate_audio(data)
+        error = _unsupported_audio_format(audio_format)
+        if error:
+            return error
         
-        result = tts_service.preview_voice(voice, text, style, rate)
+        result = tts_service.preview_voice(voice, text, style, rate,
+                                           output="base64" if delivery == "json" else "bytes",
+                                           audio_format=audio_format)
         
         if result.get("success"):
-            # JSON形式でレスポンスを返す
-            return jsonify({
-                "success": True,
-                "audio_data": result["audio_data"],
-                "format": result["format"]
-            })
+            return _audio_response(result, delivery)
         else:
-            return jsonify({"success": False, "error": result.get("error", "音声プレビューに失敗しました")}), 500
+            return _service_error(result, "音声プレビューに失敗しました")
             
     except Exception as e:
-        print(f"Preview voice error: {e}")
-        traceback.print_exc()
+        log.exception("preview voice error")
         return jsonify({"success": False, "error": f"音声プレビューエラー: {str(e)}"}), 500
 
 @app.route('/api/tts/generate', methods=['POST'])
@@ -156,34 +480,503 @@ def generate_speech():
         if not text:
             return jsonify({"success": False, "error": "テキストが指定されていません"}), 400
         
-        result = tts_service.generate_speech(text, voice_settings, speaker_mode, style, rate)
+        delivery, audio_format = _negotiate_audio(data)
+        error = _unsupported_audio_format(audio_format)
+        if error:
+            return error
         
-        if result.get("success"):
-            # JSON形式でレスポンスを返す
-            return jsonify({
-                "success": True,
-                "audio_data": result["audio_data"],
-                "format": result["format"]
+        if data.get('async'):
+            return _submit_job("tts", {
+                "text": text, "voice_settings": voice_settings, "speaker_mode": speaker_mode,
+                "style": style, "rate": rate, "format": audio_format, "chunked": data.get('chunked'),
             })
+        
+        result = tts_service.generate_speech(text, voice_settings, speaker_mode, style, rate,
+                                             output="base64" if delivery == "json" else "bytes",
+                                             audio_format=audio_format,
+                                             chunked=data.get('chunked'))
+        
+        if result.get("success"):
+            return _audio_response(result, delivery)
         else:
-            return jsonify({"success": False, "error": result.get("error", "音声生成に失敗しました")}), 500
+            return _service_error(result, "音声生成に失敗しました")
             
     except Exception as e:
-        print(f"Generate speech error: {e}")
-        traceback.print_exc()
+        log.exception("generate speech error")
         return jsonify({"success": False, "error": f"音声生成エラー: {str(e)}"}), 500
 
+@app.route('/api/tts/stream', methods=['POST'])
+def stream_speech():
+    """
+    音声を文単位のセグメントに分けて合成し、SSE で順に送信する
+    segment イベント: 1 セグメント分の音声 (base64) と合成時間
+    done イベント: 全体を連結した音声の URL と合計時間 / error イベント: 途中のエラー
+    """
+    if not tts_service:
+        return jsonify({"success": False, "error": "TTS service is not available"}), 503
+
+    data = request.get_json()
+    text = data.get('text', '')
+    voice_settings = data.get('voice_settings', {})
+    speaker_mode = data.get('speaker_mode', 'single')
+    style = data.get('style', '')
+    audio_format = (data.get('format') or 'wav').lower()
+
+    if not text:
+        return jsonify({"success": False, "error": "テキストが指定されていません"}), 400
+    error = _unsupported_audio_format(audio_format)
+    if error:
+        return error
+
+    def events():
+        pcm_parts = []
+        for segment in tts_service.iter_speech_segments(text, voice_settings, speaker_mode, style, audio_format):
+            if not segment["success"]:
+                yield _sse_event(segment, event="error")
+                return
+            pcm_parts.append(segment.pop("pcm"))
+            log.debug("streamed segment", index=segment['index'], total=segment['total'],
+                      synth_ms=segment['synth_ms'], elapsed_ms=segment['elapsed_ms'])
+            yield _sse_event(segment, event="segment")
+        # 全体の音声も保存しておき、再生し直しやダウンロードに使えるようにする
+        audio_id = audio_store.put(wave_file(tts_service.join_pcm(pcm_parts)))
+        yield _sse_event({
+            "success": True,
+            "segments": len(pcm_parts),
+            "audio_id": audio_id,
+            "audio_url": f"/api/tts/audio/{audio_id}",
+            "format": "wav",
+        }, event="done")
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Async jobs (長時間の音声生成・要約) ---
+job_manager = JobManager(
+    max_workers=int(os.getenv("JOB_WORKERS", "2")),
+    max_queued=int(os.getenv("JOB_QUEUE_MAX", "100")),
+    ttl=float(os.getenv("JOB_RESULT_TTL", "3600")),
+    db_path=os.getenv("JOB_DB_PATH") or None,
+)
+
+def _run_tts_job(payload, job):
+    """音声生成ジョブ: 結果の音声は音声ストアに保存し URL を返す"""
+    result = tts_service.generate_speech(
+        payload["text"], payload.get("voice_settings", {}), payload.get("speaker_mode", "single"),
+        payload.get("style", ""), payload.get("rate", 1.0), output="bytes",
+        audio_format=payload.get("format", "wav"), chunked=payload.get("chunked"),
+        on_progress=job.set_progress,
+    )
+    if not result.get("success"):
+        return result
+    audio_id = audio_store.put(result["audio_data"])
+    return {
+        "success": True,
+        "audio_id": audio_id,
+        "audio_url": f"/api/tts/audio/{audio_id}",
+        "format": result["format"],
+    }
+
+def _run_summarize_job(payload, job):
+    """要約ジョブ"""
+    return tts_service.summarize_text(
+        payload["text"],
+        payload.get("speaker_mode", "single"),
+        mode=payload.get("mode", "auto"),
+        section_tokens=payload.get("section_tokens"),
+        on_progress=job.set_progress,
+    )
+
+if tts_service:
+    job_manager.register("tts", _run_tts_job)
+    job_manager.register("summarize", _run_summarize_job)
+
+def _submit_job(kind, payload):
+    """ジョブを登録し 202 でジョブ ID を返す"""
+    try:
+        job = job_manager.submit(kind, payload)
+    except QueueFull:
+        response = jsonify({"success": False, "error": "処理待ちのジョブが多すぎます。しばらくしてから再度お試しください。"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+    return jsonify({
+        "success": True,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/api/jobs/{job.id}",
+        "events_url": f"/api/jobs/{job.id}/events",
+    }), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """ジョブの状態・進捗・結果 (完了後 JOB_RESULT_TTL 秒間)"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "ジョブが見つかりません"}), 404
+    return jsonify({"success": True, **job.to_dict()})
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """ジョブを取り消す"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "ジョブが見つかりません"}), 404
+    return jsonify({"success": True, **job.to_dict()})
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """ジョブの状態変化を SSE で送る (完了・失敗・取り消しで終了)"""
+    if job_manager.get(job_id) is None:
+        return jsonify({"success": False, "error": "ジョブが見つかりません"}), 404
+
+    def events():
+        last_sent = None
+        while True:
+            job = job_manager.get(job_id)
+            if job is None:
+                yield _sse_event({"error": "ジョブが見つかりません"}, event="error")
+                return
+            state = job.to_dict()
+            if state != last_sent:
+                last_sent = state
+                yield _sse_event(state, event="status")
+            if job.finished:
+                return
+            job_manager.wait_for_change(job_id, job.version, timeout=1.0)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Prompt processing (translate / enhance) ---
+PROMPT_PROCESSOR_MODEL = "gemini-2.0-flash"
+IMAGE_GENERATION_MODEL = "gemini-2.0-flash-exp-image-generation"
+
+TRANSLATE_INSTRUCTION = (
+    "Translate the following Japanese text to English, providing only the English translation. "
+    "This text accompanies an image."
+)
+ENHANCE_INSTRUCTION = (
+    "You are a helpful assistant specializing in crafting effective prompts for AI image generation. "
+    "Take the user's request (provided in Japanese) and transform it into a detailed, descriptive English prompt "
+    "suitable for an AI image generator. Focus on visual details, style, composition, and desired mood. "
+    "IMPORTANT: If the generated image needs to contain any text, ensure that the text is ONLY in English. "
+    "Default Context: Unless the user specifies a location or ethnicity, depict Japanese settings or people. "
+    "Directly output ONLY the final enhanced English prompt, without any conversational text or explanations."
+)
+
+# 処理済みプロンプトのキャッシュ (メモリ LRU/TTL + PROMPT_CACHE_DIR 指定時はディスク層)
+_prompt_cache_dir = os.getenv("PROMPT_CACHE_DIR")
+prompt_cache = TieredCache(
+    LRUCache(
+        max_entries=int(os.getenv("PROMPT_CACHE_SIZE", "1024")),
+        ttl=float(os.getenv("PROMPT_CACHE_TTL", "86400")),
+    ),
+    disk=DiskCache(
+        _prompt_cache_dir,
+        max_bytes=int(os.getenv("PROMPT_CACHE_DISK_MAX_BYTES", str(64 * 1024 * 1024))),
+        ttl=float(os.getenv("PROMPT_CACHE_TTL", "86400")),
+    ) if _prompt_cache_dir else None,
+    serialize=lambda text: text.encode("utf-8"),
+    deserialize=lambda raw: raw.decode("utf-8"),
+)
+
+def normalize_prompt(prompt):
+    """キャッシュキー用にプロンプトを正規化 (NFKC・前後空白除去・連続空白の圧縮)"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", prompt)).strip()
+
+def _prompt_request(prompt, has_image):
+    """
+    プロンプト処理の (モード, モデルへの入力, キャッシュキー) を返す。
+    画像ありは翻訳、画像なしは画像生成用に拡張する。キーは正規化したプロンプトと処理モードから作る
+    """
+    # Determine instruction based on image presence
+    if has_image:
+        # If image exists, just translate the text prompt for context
+        mode, instruction = "translate", TRANSLATE_INSTRUCTION
+    else:
+        # If no image, enhance the prompt for image generation
+        mode, instruction = "enhance", ENHANCE_INSTRUCTION
+    cache_key = make_cache_key(PROMPT_PROCESSOR_MODEL, mode, instruction, normalize_prompt(prompt))
+    return mode, f"{instruction}\n\nUser request (Japanese): {prompt}", cache_key
+
+def _processed_prompt_text(response):
+    """プロンプト処理の応答からテキストを取り出す (無ければ None)"""
+    # Check if response has text and candidates
+    if (
+        response.candidates
+        and response.candidates[0].content
+        and response.candidates[0].content.parts
+        and response.candidates[0].content.parts[0].text
+    ):
+        return response.candidates[0].content.parts[0].text.strip()
+    return None
+
+# 同じプロンプトの処理が同時に来たらモデルの呼び出しを 1 回にまとめる
+prompt_flight = SingleFlight("prompt")
+
+def _process_prompt(prompt, has_image):
+    """
+    日本語プロンプトを翻訳 (画像あり) または画像生成用に拡張 (画像なし) する。
+    結果はキャッシュする。同じプロンプトの処理が実行中ならその結果を待つ。応答が不正な場合は None を返す。
+    """
+    mode, request_text, cache_key = _prompt_request(prompt, has_image)
+    cached = prompt_cache.get(cache_key)
+    if cached is not None:
+        log.debug("prompt cache hit", mode=mode, processed=cached)
+        return cached
+    return prompt_flight.do(cache_key, _process_prompt_uncached, prompt, mode, request_text, cache_key)
+
+def _process_prompt_uncached(prompt, mode, request_text, cache_key):
+    # 直前まで実行されていた同じ処理の結果がキャッシュに入っていればそれを使う
+    cached = prompt_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    log.debug("processing prompt", mode=mode, prompt=prompt)
+    # Use a model good at instruction following
+    prompt_processor_model = genai.GenerativeModel(PROMPT_PROCESSOR_MODEL)
+    with span("prompt_processing", mode=mode):
+        enhancement_response = upstream_policy("gemini_prompt").call(
+            prompt_processor_model.generate_content, request_text)
+
+    processed_prompt = _processed_prompt_text(enhancement_response)
+    if processed_prompt:
+        log.debug("processed prompt", mode=mode, processed=processed_prompt)
+        prompt_cache.set(cache_key, processed_prompt)
+        return processed_prompt
+
+    log.warning("prompt processing failed: no text part in response", mode=mode, response=enhancement_response)
+    return None
+
+# 生成画像のコンテンツアドレス型ストア (SHA-256)
+image_store = BlobStore(
+    os.getenv("IMAGE_STORE_DIR", os.path.join(tempfile.gettempdir(), "image-app", "images")),
+    max_bytes=int(os.getenv("IMAGE_STORE_MAX_BYTES", str(1024 * 1024 * 1024))),
+)
+
+@app.route('/images/<digest>', methods=['GET'])
+def get_image(digest):
+    """生成画像をバイナリで返す (内容ハッシュを強い ETag とし、不変としてキャッシュさせる)"""
+    return _send_blob(image_store, digest, "public") or (jsonify({"error": "画像が見つかりません"}), 404)
+
+def _send_blob(store, digest, visibility):
+    """
+    ストアのファイルを強い ETag と不変のキャッシュヘッダー付きで返す
+    無い場合 (確認の直後に容量の上限で削除された場合も) は None
+    """
+    path = store.path(digest)
+    mime_type = store.mime_type(digest) if path else None
+    if not mime_type:
+        return None
+    try:
+        response = send_file(path, mimetype=mime_type, conditional=True, etag=digest, max_age=IMMUTABLE_MAX_AGE)
+    except FileNotFoundError:
+        return None
+    response.headers["Cache-Control"] = f"{visibility}, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    return response
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """キャッシュのヒット/ミス統計"""
+    stats = {"prompt": prompt_cache.stats(), "images": image_store.stats(), "audio": audio_store.stats()}
+    if tts_service:
+        stats["speech"] = tts_service.speech_cache.stats()
+        stats["extraction"] = tts_service.extraction_cache.stats()
+    stats["uploads"] = upload_accounting.stats()
+    stats["image_preprocess"] = image_preprocess_stats()
+    stats["conversations"] = conversation_store.stats()
+    return jsonify(stats)
+
+# 会話履歴 (クライアントは conversation_id と新しいターンだけを送る)
+conversation_store = ConversationStore(
+    max_turns=int(os.getenv("CONVERSATION_MAX_TURNS", "40")),
+    max_tokens=int(os.getenv("CONVERSATION_MAX_TOKENS", "32000")),
+    ttl=float(os.getenv("CONVERSATION_TTL", "86400")),
+    max_conversations=int(os.getenv("CONVERSATION_MAX", "1000")),
+    db_path=os.getenv("CONVERSATION_DB_PATH"),
+)
+
+def _history_contents(turns):
+    """保存済みのターンをモデルへの contents に変換する (画像の参照は画像ストアから読み込む)"""
+    contents = []
+    for turn in turns:
+        parts = []
+        for part in turn["parts"]:
+            if "text" in part:
+                parts.append({"text": part["text"]})
+                continue
+            data = image_store.get(part["image"])
+            if data is None:
+                continue  # ストアから削除済みの画像は履歴から外す
+            parts.append({"inline_data": {"mime_type": part["mime_type"],
+                                          "data": base64.b64encode(data).decode("ascii")}})
+        if parts:
+            contents.append({"role": turn["role"], "parts": parts})
+    return contents
+
+def _model_turn(results):
+    """生成結果 (text / image URL) を保存用のモデルのターンにする"""
+    parts = []
+    for result in results:
+        if result["type"] == "text":
+            parts.append({"text": result["content"]})
+        elif result["type"] == "image":
+            digest = result["content"].rsplit("/", 1)[-1]
+            mime_type = image_store.mime_type(digest)
+            if mime_type:  # 保存直後に削除された画像は履歴に残さない
+                parts.append({"image": digest, "mime_type": mime_type})
+    return {"role": "model", "parts": parts}
+
+STOPPED_NOTICE = "[注意: コンテンツ生成が途中で停止された可能性があります]"
+
+def _result_from_part(part):
+    """応答のパートをクライアントに返す形 (text / image URL) にする。どちらでもなければ None"""
+    if hasattr(part, 'text') and part.text:
+        log.debug("stream text part", text=part.text)
+        return {"type": "text", "content": part.text}
+    if hasattr(part, 'inline_data') and part.inline_data:
+        # 画像はストアに一度だけ書き込み、レスポンスには URL のみを返す
+        digest = image_store.put(part.inline_data.data)
+        log.debug("stream image part", mime_type=part.inline_data.mime_type,
+                  bytes=len(part.inline_data.data), digest=digest)
+        return {"type": "image", "content": f"/images/{digest}"}
+    log.debug("stream part without text or inline_data", part=part)
+    return None
+
+def _iter_stream_results(response_stream):
+    """
+    Gemini のストリームからテキスト・画像パートを受信順に取り出す (受信完了までを image_stream として計測)
+    途中で終わった場合もストリームを閉じる (ストリームが使っているモデルの枠を返す)
+    """
+    try:
+        with span("image_stream") as fields:
+            fields["parts"] = 0
+            for chunk in response_stream:
+                if not chunk.candidates:
+                    log.debug("stream chunk without candidates")
+                    continue
+
+                for part in chunk.candidates[0].content.parts:
+                    result = _result_from_part(part)
+                    if result:
+                        fields["parts"] += 1
+                        yield result
+    finally:
+        close = getattr(response_stream, "close", None)
+        if close:
+            close()
+
+def _sse_event(payload, event=None):
+    """Server-Sent Events 形式の 1 イベントを組み立てる"""
+    message = f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    if event:
+        message = f"event: {event}\n{message}"
+    return message
+
+def _stream_generation_events(response_stream, on_complete=None):
+    """
+    生成結果を SSE で逐次送信する。
+    パートは message イベント、ストリーム途中の例外は error イベント、終了時は done イベント。
+    on_complete(results) を指定すると正常終了時に呼び、戻り値の dict を done イベントに含める
+    """
+    results = []
+    sent = 0
+    try:
+        for result in _iter_stream_results(response_stream):
+            sent += 1
+            results.append(result)
+            yield _sse_event(result)
+    except genai.types.BlockedPromptException as e:
+        log.warning("prompt blocked during stream", error=e)
+        yield _sse_event({"error": f"リクエストがブロックされました。プロンプトの内容を確認してください。 {e}", "status": 400}, event="error")
+        return
+    except genai.types.StopCandidateException as e:
+        log.warning("generation stopped during stream", error=e, partial=sent > 0)
+        # 途中まで送信済みのパートはクライアント側に残る (partial で区別)
+        yield _sse_event({"error": f"コンテンツ生成が安全上の理由で停止しました。 {e}", "status": 400, "partial": sent > 0}, event="error")
+        return
+    except Exception as e:
+        log.exception("error during streaming")
+        yield _sse_event({"error": f"ストリーム処理中に予期せぬエラーが発生しました: {str(e)}", "status": 500}, event="error")
+        return
+
+    if not sent:
+        log.warning("no processable content in stream")
+        yield _sse_event({"error": "モデルから有効な応答が得られませんでした。", "status": 500}, event="error")
+        return
+
+    done = {"count": sent}
+    if on_complete:
+        done.update(on_complete(results) or {})
+    yield _sse_event(done, event="done")
+
+@app.route('/api/conversations/<conversation_id>', methods=['DELETE'])
+def delete_conversation(conversation_id):
+    """会話履歴を破棄する (新しいチャットを始めるとき)"""
+    conversation_store.delete(conversation_id)
+    return jsonify({"success": True})
+
+def _generation_history(data):
+    """
+    リクエストの履歴を (use_conversation, conversation_id, 履歴の contents) で返す
+    conversation_id を送るクライアントは履歴をサーバー側で管理する (null や不明な ID なら新しい会話)
+    """
+    if 'conversation_id' not in data:
+        return False, None, data.get('history', [])
+    conversation_id = data.get('conversation_id')
+    if not conversation_id or not conversation_store.exists(conversation_id):
+        conversation_id = conversation_store.create()
+    return True, conversation_id, _history_contents(conversation_store.turns(conversation_id))
+
+def _user_message(processed_prompt, image_input_data, use_conversation):
+    """
+    今回のユーザーメッセージの parts と、会話履歴に保存するターン (画像は画像ストアの参照) を返す
+    入力画像は縮小・向き補正・再圧縮してから送る (大きな写真のアップロード量とモデルの処理時間を減らす)
+    """
+    current_parts_list = []
+    user_turn = {"role": "user", "parts": []}
+    # Use the processed (enhanced or translated) prompt if available
+    if processed_prompt:
+        current_parts_list.append({"text": processed_prompt})
+        user_turn["parts"].append({"text": processed_prompt})
+
+    if image_input_data:
+        try:
+            image_input_data = normalize_inline_image(image_input_data)
+            raw = base64.b64decode(image_input_data["data"])
+            current_parts_list.append({
+                "inline_data": {
+                    "mime_type": image_input_data["mime_type"],
+                    "data": image_input_data["data"]
+                }
+            })
+            if use_conversation:
+                digest = image_store.put(raw)
+                user_turn["parts"].append({"image": digest, "mime_type": image_input_data["mime_type"]})
+        except (KeyError, TypeError, AttributeError, ValueError, OSError) as e:
+            # 画像が不正な場合 (形式の誤り・base64 や画像としてデコードできない) は
+            # テキストだけを送る (どちらも無ければ呼び出し元で 400)
+            log.warning("invalid uploaded image data", error=e)
+    return current_parts_list, user_turn
+
 @app.route('/generate', methods=['POST'])
 def generate_image():
     try:
         data = request.get_json()
         prompt = data.get('prompt')
-        history_data = data.get('history', [])
         image_input_data = data.get('image_data') # { mime_type: ..., data: base64_string }
+        use_conversation, conversation_id, history_data = _generation_history(data)
+        # SSE モード: body の stream フラグまたは Accept ヘッダーで指定
+        wants_stream = bool(data.get('stream')) or request.accept_mimetypes.best == 'text/event-stream'
 
-        print(f"Received prompt: {prompt}")
-        print(f"Received history length: {len(history_data)}")
-        print(f"Received image data: {'Yes' if image_input_data else 'No'}")
+        log.info("generate request", prompt=prompt, history_turns=len(history_data),
+                 conversation_id=conversation_id, has_image=bool(image_input_data), stream=wants_stream)
 
         if not prompt and not image_input_data:
              return jsonify({"error": "Prompt or image is required"}), 400
@@ -192,52 +985,14 @@ def generate_image():
         processed_prompt = None
         if prompt:
             try:
-                print(f"--- Processing prompt: '{prompt}' ---")
-                # Use a model good at instruction following
-                prompt_processor_model = genai.GenerativeModel("gemini-2.0-flash") # Reverted to 1.5 flash for complex instructions
-
-                # Determine instruction based on image presence
-                if image_input_data:
-                    # If image exists, just translate the text prompt for context
-                    instruction = (
-                        "Translate the following Japanese text to English, providing only the English translation. "
-                        "This text accompanies an image."
-                    )
-                    log_prefix = "Translating accompanying prompt:"
-                else:
-                    # If no image, enhance the prompt for image generation
-                    instruction = (
-                        "You are a helpful assistant specializing in crafting effective prompts for AI image generation. "
-                        "Take the user's request (provided in Japanese) and transform it into a detailed, descriptive English prompt "
-                        "suitable for an AI image generator. Focus on visual details, style, composition, and desired mood. "
-                        "IMPORTANT: If the generated image needs to contain any text, ensure that the text is ONLY in English. "
-                        "Default Context: Unless the user specifies a location or ethnicity, depict Japanese settings or people. "
-                        "Directly output ONLY the final enhanced English prompt, without any conversational text or explanations."
-                    )
-                    log_prefix = "Enhancing prompt for generation:"
-
-                print(f"--- {log_prefix} '{prompt}' ---")
-                enhancement_response = prompt_processor_model.generate_content(
-                    f"{instruction}\n\nUser request (Japanese): {prompt}"
-                )
-
-                # Check if response has text and candidates (same logic as before)
-                if (
-                    enhancement_response.candidates
-                    and enhancement_response.candidates[0].content
-                    and enhancement_response.candidates[0].content.parts
-                    and enhancement_response.candidates[0].content.parts[0].text
-                ):
-                    processed_prompt = enhancement_response.candidates[0].content.parts[0].text.strip()
-                    print(f"--- Processed prompt: '{processed_prompt}' ---")
-                else:
-                    print(f"--- Prompt processing failed: No text part in response ---")
-                    print(f"Processing response object: {enhancement_response}")
+                processed_prompt = _process_prompt(prompt, bool(image_input_data))
+                if processed_prompt is None:
                     return jsonify({"error": "プロンプトの処理に失敗しました (応答が不正です)"}), 500
 
+            except (CircuitOpenError, Overloaded):
+                raise
             except Exception as e:
-                print(f"--- Prompt processing failed: Exception: {e} ---")
-                traceback.print_exc()
+                log.exception("prompt processing failed")
                 return jsonify({"error": f"プロンプトの処理中にエラーが発生しました: {e}"}), 500
         else:
             processed_prompt = None # Ensure variable exists even if there's no prompt
@@ -250,37 +1005,18 @@ def generate_image():
         contents.extend(history_data)
 
         # Construct the current user message parts as dictionaries
-        current_parts_list = []
-        # Use the processed (enhanced or translated) prompt if available
-        if processed_prompt:
-            current_parts_list.append({"text": processed_prompt})
-
-        if image_input_data:
-            try:
-                image_part_dict = {
-                    "inline_data": {
-                        "mime_type": image_input_data["mime_type"],
-                        "data": image_input_data["data"]
-                    }
-                }
-                current_parts_list.append(image_part_dict)
-                print(f"Added uploaded image part: {image_input_data['mime_type']}")
-            except (KeyError, TypeError) as e:
-                print(f"Error processing uploaded image data structure: {e}")
-                # Append error text or handle differently? Let's keep it simple.
-                # Maybe don't add a text part here if image fails, rely on overall check.
-                pass # Rely on the check below
+        current_parts_list, user_turn = _user_message(processed_prompt, image_input_data, use_conversation)
 
         if not current_parts_list:
              # This case should ideally not happen if initial check passed,
              # but handles edge cases like failed image processing without text prompt.
-            print("Error: No valid parts to send after processing prompt and image.")
+            log.warning("no valid parts to send after processing prompt and image")
             return jsonify({"error": "送信する有効なメッセージパートがありません。"}), 400
 
         contents.append({"role": "user", "parts": current_parts_list})
 
         # --- Call Image Generation Model (remains the same) ---
-        model = genai.GenerativeModel("gemini-2.0-flash-exp-image-generation")
+        model = genai.GenerativeModel(IMAGE_GENERATION_MODEL)
 
         # generation_config as dictionary (or None)
         generation_config_dict = {
@@ -290,63 +1026,58 @@ def generate_image():
         # if not generation_config_dict: # No longer needed as we always set modalities
         #      generation_config_dict = None
 
-        print(f"Sending contents to Gemini (dict format): {contents}")
-        print(f"Using generation_config: {generation_config_dict}") # Add log for config
+        # contents には base64 の画像が含まれるため、全体はログに出さない
+        log.debug("sending contents to Gemini", turns=len(contents),
+                  parts=sum(len(turn["parts"]) for turn in contents), generation_config=generation_config_dict)
 
-        # Use generate_content with stream=True
-        response_stream = model.generate_content(
-            contents=contents,
-            generation_config=generation_config_dict,
-            stream=True # Set stream=True here
-        )
+        # Use generate_content with stream=True (最初の応答を受け取るまでを image_request として計測)
+        # モデルの枠はストリームを読み終えるまで使う (SSE では最後のイベントを送るまで)。
+        # 最初のチャンクまでの失敗はここで再試行し、受け付けの拒否やブレーカーはこの時点でエラーレスポンスにする
+        with span("image_request"):
+            response_stream = primed(upstream_policy("gemini_image").stream(
+                model.generate_content,
+                contents=contents,
+                generation_config=generation_config_dict,
+                stream=True # Set stream=True here
+            ))
 
-        print("--- Processing Gemini API Stream ---")
-        results = []
-        full_response_text = "" # To accumulate text if needed
+        def save_turns(results):
+            if not use_conversation:
+                return None
+            conversation_store.append(conversation_id, user_turn, _model_turn(results))
+            return {"conversation_id": conversation_id}
 
-        try:
-            for chunk in response_stream:
-                if not chunk.candidates:
-                    print("Received chunk with no candidates, skipping.")
-                    continue
+        if wants_stream:
+            # SSE: 各パートを受信次第クライアントへ送る
+            response = Response(
+                stream_with_context(_stream_generation_events(response_stream, on_complete=save_turns)),
+                mimetype='text/event-stream',
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+            response.call_on_close(response_stream.close)  # 本文を送る前に接続が切れた場合も枠を返す
+            return response
 
-                print(f"Processing chunk: {chunk}") # Log each received chunk
+        results = []
 
-                for part in chunk.candidates[0].content.parts:
-                    print(f"Processing response part: {part}")
-                    if hasattr(part, 'text') and part.text:
-                        print(f"Found text part in chunk: {part.text[:50]}...")
-                        results.append({"type": "text", "content": part.text})
-                        full_response_text += part.text # Accumulate text if necessary
-
-                    elif hasattr(part, 'inline_data') and part.inline_data:
-                        print(f"Found inline_data part in chunk. Mime type: {part.inline_data.mime_type}")
-                        image_data = part.inline_data.data
-                        mime_type = part.inline_data.mime_type
-                        base64_image = base64.b64encode(image_data).decode('utf-8')
-                        data_url = f"data:{mime_type};base64,{base64_image}"
-                        print(f"Generated data URL from chunk: {data_url[:100]}...")
-                        results.append({"type": "image", "content": data_url})
-                    else:
-                        print(f"Chunk part has no processable text or inline_data: {part}")
+        try:
+            for result in _iter_stream_results(response_stream):
+                results.append(result)
 
         # Handle potential errors during streaming, like finish_reason being SAFETY
         except genai.types.BlockedPromptException as e:
-             print(f"BlockedPromptException during stream: {e}")
+             log.warning("prompt blocked during stream", error=e)
              return jsonify({"error": f"リクエストがブロックされました。プロンプトの内容を確認してください。 {e}"}), 400
         except genai.types.StopCandidateException as e:
-             print(f"StopCandidateException during stream: {e}")
+             log.warning("generation stopped during stream", error=e, partial=bool(results))
              # Check if we got any results before stopping
              if results:
-                  print("Stream stopped potentially due to safety, but sending partial results.")
                   # Optionally add a warning message to results
-                  results.append({"type": "text", "content": "[注意: コンテンツ生成が途中で停止された可能性があります]"})
+                  results.append({"type": "text", "content": STOPPED_NOTICE})
              else:
                   return jsonify({"error": f"コンテンツ生成が安全上の理由で停止しました。 {e}"}), 400
         # Catch other potential exceptions related to the stream
         except Exception as e:
-            print(f"An error occurred during streaming: {e}")
-            traceback.print_exc()
+            log.exception("error during streaming")
             return jsonify({"error": f"ストリーム処理中に予期せぬエラーが発生しました: {str(e)}"}), 500
 
 
@@ -354,26 +1085,30 @@ def generate_image():
         # (Note: prompt_feedback might be on the first chunk or aggregated differently in streaming)
         # Let's rely on the exceptions for now.
 
-        print("--- Stream Processing Finished ---")
-        print(f"Final accumulated results being sent to frontend: {results}")
-
         # If results are empty after processing stream (e.g., only empty chunks received)
         if not results:
-             print("No processable content found in the entire stream.")
+             log.warning("no processable content in stream")
              return jsonify({"error": "モデルから有効な応答が得られませんでした。"}), 500
 
 
-        return jsonify({"results": results})
+        response_data = {"results": results}
+        response_data.update(save_turns(results) or {})
+        return jsonify(response_data)
 
     except genai.types.BlockedPromptException as e:
-        print(f"BlockedPromptException: {e}")
+        log.warning("prompt blocked", error=e)
         return jsonify({"error": f"リクエストがブロックされました。プロンプトの内容を確認してください。 {e}"}), 400
     except genai.types.StopCandidateException as e:
-         print(f"StopCandidateException: {e}")
+         log.warning("generation stopped", error=e)
          return jsonify({"error": f"コンテンツ生成が安全上の理由で停止しました。 {e}"}), 400
+    except CircuitOpenError as e:
+        log.warning("upstream unavailable", service=e.service, retry_after_s=round(e.retry_after, 1))
+        return _unavailable_response("画像生成サービスが一時的に利用できません。しばらくしてから再度お試しください。",
+                                     e.retry_after)
+    except Overloaded as e:
+        return overloaded(e)
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        traceback.print_exc()
+        log.exception("unexpected error in generate")
         if "API key not valid" in str(e):
              return jsonify({"error": "無効なGoogle APIキーです。"}), 500
         # Check for the specific AttributeError again, if it persists with dicts
@@ -382,5 +1117,17 @@ def generate_image():
 
         return jsonify({"error": f"予期せぬエラーが発生しました: {str(e)}"}), 500
 
+def create_app():
+    """
+    WSGI アプリケーションのファクトリー (本番は gunicorn -c backend/gunicorn.conf.py で起動する)
+    外部 API のクライアントとジョブの実行スレッドは各プロセスで最初に使うときに作られるため、
+    fork 前のマスタープロセス (gunicorn の preload) で呼んでもよい
+    """
+    return app
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
+    # 開発用サーバーは dev_server.py から起動し直す
+    # (app.py のまま起動すると、PDF 抽出のワーカーが app.py を __mp_main__ として読み込み直す)
+    import sys
+    dev_server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dev_server.py')
+    os.execv(sys.executable, [sys.executable, dev_server] + sys.argv[1:])
@@ -0,0 +1,435 @@
+"""
+asyncio で動く ASGI のエントリーポイント
+
+    uvicorn asgi:app --app-dir backend --port 5000
+
+Gemini を呼ぶ重い経路 (POST /generate・/api/tts/generate・/api/tts/summarize) は google-genai の
+非同期クライアント (genai.Client(...).aio) で処理し、上流の応答を待つ間にスレッドを占有しない。
+1 プロセスで数百件の呼び出しを同時に待てる (1 件あたりのメモリはコルーチン 1 つ分)
+それ以外のルートと "async": true のジョブ登録は、これまでどおり Flask のアプリ (app.py) が処理する
+"""
+import os
+import math
+import time
+import base64
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from google import genai
+from google.genai import types
+from google.generativeai.types import BlockedPromptException, StopCandidateException
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import app as wsgi
+from audio_codec import mime_type_for
+from observability import get_logger, span
+from resilience import CircuitOpenError, primed_async, upstream_policy
+from admission import Overloaded, client_key, client_limiter
+
+log = get_logger("asgi")
+
+# Flask に渡すリクエストを処理するスレッド数 (アップロードの抽出など同期のルート用)
+WSGI_WORKERS = int(os.getenv("WSGI_WORKERS", "16"))
+
+# 生成が途中で停止したとはみなさない終了理由
+_NORMAL_FINISH_REASONS = ("FINISH_REASON_UNSPECIFIED", "STOP", "MAX_TOKENS")
+
+_client: Optional[genai.Client] = None
+
+
+def genai_client() -> genai.Client:
+    """画像生成・プロンプト処理用のクライアント (最初の呼び出しで作成する)"""
+    global _client
+    if _client is None:
+        _client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+    return _client
+
+
+flask_app = WSGIMiddleware(wsgi.app, workers=WSGI_WORKERS)
+
+
+class _DelegateToFlask:
+    """ボディを読み終えたリクエストを Flask のアプリに渡す (読み込み済みのボディを送り直す)"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def __call__(self, scope, receive, send) -> None:
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": self.body, "more_body": False}
+            return await receive()  # 切断の通知を待つ
+
+        await flask_app(scope, replay, send)
+
+
+def _accept(request: Request) -> MIMEAccept:
+    return parse_accept_header(request.headers.get("accept"), MIMEAccept)
+
+
+def _admit_client(request: Request) -> None:
+    """app._admit_client と同じクライアントごとのレート制限 (超えたら Overloaded)"""
+    client_limiter.check(client_key(request.headers, request.client.host if request.client else None))
+
+
+def _timed(endpoint: str):
+    """Flask の after_request と同じく http_request_duration_seconds に記録する"""
+    def decorator(handler):
+        async def wrapper(request: Request):
+            started = time.perf_counter()
+            response = await handler(request)
+            if not isinstance(response, _DelegateToFlask):  # 渡した先の Flask で記録される
+                wsgi.HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint,
+                                          method=request.method, status=response.status_code)
+            return response
+        return wrapper
+    return decorator
+
+
+# --- 画像生成 ---
+
+async def _process_prompt(prompt: str, has_image: bool) -> Optional[str]:
+    """app._process_prompt の asyncio 版 (キャッシュと single-flight は共有)"""
+    mode, request_text, cache_key = wsgi._prompt_request(prompt, has_image)
+    cached = wsgi.prompt_cache.get(cache_key)
+    if cached is not None:
+        log.debug("prompt cache hit", mode=mode, processed=cached)
+        return cached
+    return await wsgi.prompt_flight.do_async(cache_key, _process_prompt_uncached, prompt, mode, request_text,
+                                             cache_key)
+
+
+async def _process_prompt_uncached(prompt: str, mode: str, request_text: str, cache_key: str) -> Optional[str]:
+    cached = wsgi.prompt_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    log.debug("processing prompt", mode=mode, prompt=prompt)
+    with span("prompt_processing", mode=mode):
+        response = await upstream_policy("gemini_prompt").call_async(
+            genai_client().aio.models.generate_content, model=wsgi.PROMPT_PROCESSOR_MODEL, contents=request_text)
+
+    processed_prompt = wsgi._processed_prompt_text(response)
+    if processed_prompt:
+        log.debug("processed prompt", mode=mode, processed=processed_prompt)
+        wsgi.prompt_cache.set(cache_key, processed_prompt)
+        return processed_prompt
+
+    log.warning("prompt processing failed: no text part in response", mode=mode, response=response)
+    return None
+
+
+def _genai_contents(contents: List[Dict[str, Any]]) -> List[types.Content]:
+    """app と同じ形の contents (画像は base64) を google-genai の Content にする"""
+    converted = []
+    for turn in contents:
+        parts = []
+        for part in turn["parts"]:
+            if "text" in part:
+                parts.append(types.Part.from_text(text=part["text"]))
+            else:
+                inline_data = part["inline_data"]
+                parts.append(types.Part.from_bytes(data=base64.b64decode(inline_data["data"]),
+                                                   mime_type=inline_data["mime_type"]))
+        converted.append(types.Content(role=turn["role"], parts=parts))
+    return converted
+
+
+def _reason_name(reason) -> Optional[str]:
+    return getattr(reason, "name", reason) if reason else None
+
+
+async def _iter_stream_results(response_stream):
+    """
+    app._iter_stream_results の asyncio 版
+    google-genai は安全上の停止を例外にしないため、google.generativeai と同じ例外を送出する
+    """
+    try:
+        with span("image_stream") as fields:
+            fields["parts"] = 0
+            async for chunk in response_stream:
+                feedback = getattr(chunk, "prompt_feedback", None)
+                if feedback is not None and feedback.block_reason:
+                    raise BlockedPromptException(f"block_reason: {_reason_name(feedback.block_reason)}")
+                if not chunk.candidates:
+                    log.debug("stream chunk without candidates")
+                    continue
+
+                candidate = chunk.candidates[0]
+                for part in (candidate.content.parts if candidate.content else None) or []:
+                    # 画像はストアへの書き込みがあるためスレッドで処理する
+                    result = await asyncio.to_thread(wsgi._result_from_part, part)
+                    if result:
+                        fields["parts"] += 1
+                        yield result
+                reason = _reason_name(getattr(candidate, "finish_reason", None))
+                if reason and reason not in _NORMAL_FINISH_REASONS:
+                    # 候補全体 (画像のバイト列を含む) ではなく理由だけをメッセージにする
+                    raise StopCandidateException(f"finish_reason: {reason}")
+    finally:
+        aclose = getattr(response_stream, "aclose", None)
+        if aclose:
+            await aclose()
+
+
+async def _stream_generation_events(response_stream, on_complete=None):
+    """app._stream_generation_events の asyncio 版 (イベントの形式は同じ)"""
+    results = []
+    sent = 0
+    try:
+        async for result in _iter_stream_results(response_stream):
+            sent += 1
+            results.append(result)
+            yield wsgi._sse_event(result)
+    except BlockedPromptException as e:
+        log.warning("prompt blocked during stream", error=e)
+        yield wsgi._sse_event({"error": f"リクエストがブロックされました。プロンプトの内容を確認してください。 {e}", "status": 400}, event="error")
+        return
+    except StopCandidateException as e:
+        log.warning("generation stopped during stream", error=e, partial=sent > 0)
+        yield wsgi._sse_event({"error": f"コンテンツ生成が安全上の理由で停止しました。 {e}", "status": 400, "partial": sent > 0}, event="error")
+        return
+    except Exception as e:
+        log.exception("error during streaming")
+        yield wsgi._sse_event({"error": f"ストリーム処理中に予期せぬエラーが発生しました: {str(e)}", "status": 500}, event="error")
+        return
+
+    if not sent:
+        log.warning("no processable content in stream")
+        yield wsgi._sse_event({"error": "モデルから有効な応答が得られませんでした。", "status": 500}, event="error")
+        return
+
+    done = {"count": sent}
+    if on_complete:
+        done.update(await on_complete(results) or {})
+    yield wsgi._sse_event(done, event="done")
+
+
+@_timed("/generate")
+async def generate_image(request: Request):
+    """POST /generate (リクエスト・レスポンスの形式は app.generate_image と同じ)"""
+    try:
+        _admit_client(request)
+        data = await request.json()
+        prompt = data.get('prompt')
+        image_input_data = data.get('image_data')
+        use_conversation, conversation_id, history_data = await asyncio.to_thread(wsgi._generation_history, data)
+        wants_stream = bool(data.get('stream')) or _accept(request).best == 'text/event-stream'
+
+        log.info("generate request", prompt=prompt, history_turns=len(history_data),
+                 conversation_id=conversation_id, has_image=bool(image_input_data), stream=wants_stream)
+
+        if not prompt and not image_input_data:
+            return JSONResponse({"error": "Prompt or image is required"}, 400)
+
+        processed_prompt = None
+        if prompt:
+            try:
+                processed_prompt = await _process_prompt(prompt, bool(image_input_data))
+                if processed_prompt is None:
+                    return JSONResponse({"error": "プロンプトの処理に失敗しました (応答が不正です)"}, 500)
+            except (CircuitOpenError, Overloaded):
+                raise
+            except Exception as e:
+                log.exception("prompt processing failed")
+                return JSONResponse({"error": f"プロンプトの処理中にエラーが発生しました: {e}"}, 500)
+
+        # 入力画像の縮小・再圧縮は CPU を使うためスレッドで行う
+        current_parts_list, user_turn = await asyncio.to_thread(
+            wsgi._user_message, processed_prompt, image_input_data, use_conversation)
+        if not current_parts_list:
+            log.warning("no valid parts to send after processing prompt and image")
+            return JSONResponse({"error": "送信する有効なメッセージパートがありません。"}, 400)
+
+        contents = history_data + [{"role": "user", "parts": current_parts_list}]
+        log.debug("sending contents to Gemini", turns=len(contents),
+                  parts=sum(len(turn["parts"]) for turn in contents))
+
+        # モデルの枠はストリームを読み終えるまで使う (app.generate_image と同じ)
+        with span("image_request"):
+            response_stream = await primed_async(upstream_policy("gemini_image").stream_async(
+                genai_client().aio.models.generate_content_stream,
+                model=wsgi.IMAGE_GENERATION_MODEL,
+                contents=_genai_contents(contents),
+                config=types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"]),
+            ))
+
+        async def save_turns(results):
+            if not use_conversation:
+                return None
+            await asyncio.to_thread(wsgi.conversation_store.append, conversation_id,
+                                    user_turn, wsgi._model_turn(results))
+            return {"conversation_id": conversation_id}
+
+        if wants_stream:
+            # 本文を送る前に接続が切れた場合もストリームを閉じて枠を返す
+            return StreamingResponse(
+                _stream_generation_events(response_stream, on_complete=save_turns),
+                media_type='text/event-stream',
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                background=BackgroundTask(response_stream.aclose),
+            )
+
+        results = []
+        try:
+            async for result in _iter_stream_results(response_stream):
+                results.append(result)
+        except BlockedPromptException as e:
+            log.warning("prompt blocked during stream", error=e)
+            return JSONResponse({"error": f"リクエストがブロックされました。プロンプトの内容を確認してください。 {e}"}, 400)
+        except StopCandidateException as e:
+            log.warning("generation stopped during stream", error=e, partial=bool(results))
+            if not results:
+                return JSONResponse({"error": f"コンテンツ生成が安全上の理由で停止しました。 {e}"}, 400)
+            results.append({"type": "text", "content": wsgi.STOPPED_NOTICE})
+        except Exception as e:
+            log.exception("error during streaming")
+            return JSONResponse({"error": f"ストリーム処理中に予期せぬエラーが発生しました: {str(e)}"}, 500)
+
+        if not results:
+            log.warning("no processable content in stream")
+            return JSONResponse({"error": "モデルから有効な応答が得られませんでした。"}, 500)
+
+        response_data = {"results": results}
+        response_data.update(await save_turns(results) or {})
+        return JSONResponse(response_data)
+
+    except CircuitOpenError as e:
+        log.warning("upstream unavailable", service=e.service, retry_after_s=round(e.retry_after, 1))
+        return _unavailable_response("画像生成サービスが一時的に利用できません。しばらくしてから再度お試しください。",
+                                     e.retry_after)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        log.exception("unexpected error in generate")
+        if "API key not valid" in str(e):
+            return JSONResponse({"error": "無効なGoogle APIキーです。"}, 500)
+        return JSONResponse({"error": f"予期せぬエラーが発生しました: {str(e)}"}, 500)
+
+
+# --- 音声合成・要約 ---
+
+def _tts_unavailable() -> JSONResponse:
+    return JSONResponse({"success": False, "error": "TTS service is not available"}, 503)
+
+
+def _unavailable_response(error: str, retry_after: float, status: int = 503) -> JSONResponse:
+    """app._unavailable_response の ASGI 版"""
+    return JSONResponse({"success": False, "error": error}, status,
+                        headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def _overloaded(e: Overloaded) -> JSONResponse:
+    """app.overloaded の ASGI 版"""
+    if e.scope == "client":
+        return _unavailable_response("リクエストが多すぎます。しばらくしてから再度お試しください。", e.retry_after, 429)
+    return _unavailable_response("サービスが混雑しています。しばらくしてから再度お試しください。", e.retry_after, 429)
+
+
+def _service_error(result: Dict[str, Any], default_error: str) -> JSONResponse:
+    """app._service_error の ASGI 版"""
+    if result.get("retry_after") is not None:
+        return _unavailable_response(result.get("error", default_error), result["retry_after"],
+                                     result.get("status", 503))
+    return JSONResponse({"success": False, "error": result.get("error", default_error)}, 500)
+
+
+async def _audio_response(result: Dict[str, Any], delivery: str) -> Response:
+    """app._audio_response の ASGI 版"""
+    audio_format = result["format"]
+    if delivery == 'json':
+        return JSONResponse({"success": True, "audio_data": result["audio_data"], "format": audio_format})
+    if delivery == 'binary':
+        return Response(result["audio_data"], media_type=mime_type_for(audio_format), headers={
+            "Content-Disposition": f"inline; filename=speech.{audio_format}",
+            "Vary": "Accept",
+        })
+    audio_id = await asyncio.to_thread(wsgi.audio_store.put, result["audio_data"])
+    return JSONResponse({
+        "success": True,
+        "audio_id": audio_id,
+        "audio_url": f"/api/tts/audio/{audio_id}",
+        "format": audio_format
+    })
+
+
+@_timed("/api/tts/generate")
+async def generate_speech(request: Request):
+    """POST /api/tts/generate ("async": true のジョブ登録は Flask 側で処理する)"""
+    if not wsgi.tts_service:
+        return _tts_unavailable()
+    try:
+        data = await request.json()
+        if data.get('async'):
+            return _DelegateToFlask(await request.body())
+        _admit_client(request)
+        text = data.get('text', '')
+        if not text:
+            return JSONResponse({"success": False, "error": "テキストが指定されていません"}, 400)
+
+        delivery, audio_format = wsgi._negotiate_audio(data, _accept(request))
+        error = wsgi._audio_format_error(audio_format)
+        if error:
+            return JSONResponse({"success": False, "error": error}, 400)
+
+        result = await wsgi.tts_service.generate_speech_async(
+            text, data.get('voice_settings', {}), data.get('speaker_mode', 'single'),
+            data.get('style', ''), data.get('rate', 1.0),
+            output="base64" if delivery == "json" else "bytes",
+            audio_format=audio_format, chunked=data.get('chunked'))
+
+        if result.get("success"):
+            return await _audio_response(result, delivery)
+        return _service_error(result, "音声生成に失敗しました")
+
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        log.exception("generate speech error")
+        return JSONResponse({"success": False, "error": f"音声生成エラー: {str(e)}"}, 500)
+
+
+@_timed("/api/tts/summarize")
+async def summarize_text(request: Request):
+    """POST /api/tts/summarize ("async": true のジョブ登録は Flask 側で処理する)"""
+    if not wsgi.tts_service:
+        return JSONResponse({"success": False, "error": "TTS機能が利用できません。システム管理者にお問い合わせください。"}, 503)
+    try:
+        data = await request.json()
+        if data.get('async'):
+            return _DelegateToFlask(await request.body())
+        _admit_client(request)
+        params, error = wsgi._summarize_params(data)
+        if error:
+            return JSONResponse({"success": False, "error": error}, 400)
+
+        result = await wsgi.tts_service.summarize_text_async(
+            params["text"], params["speaker_mode"], mode=params["mode"], section_tokens=params["section_tokens"])
+        if not result.get("success") and result.get("retry_after") is not None:
+            return _service_error(result, "要約に失敗しました")
+        return JSONResponse(result)
+
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        log.exception("summarization endpoint error")
+        return JSONResponse({"success": False, "error": f"要約エラー: {str(e)}"}, 500)
+
+
+app = Starlette(routes=[
+    Route("/generate", generate_image, methods=["POST"]),
+    Route("/api/tts/generate", generate_speech, methods=["POST"]),
+    Route("/api/tts/summarize", summarize_text, methods=["POST"]),
+    Mount("/", app=flask_app),
+])
@@ -0,0 +1,75 @@
+import io
+import os
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+
+from observability import get_logger
+
+log = get_logger("audio_codec")
+
+try:
+    import soundfile as sf
+except (ImportError, OSError) as e:  # libsndfile が無い環境でも WAV は利用可能
+    log.warning("soundfile unavailable, compressed audio formats disabled", error=e)
+    sf = None
+
+# 形式名 -> (libsndfile の format, subtype, MIME タイプ)
+AUDIO_FORMATS: Dict[str, Tuple[str, str, str]] = {
+    "wav": ("WAV", "PCM_16", "audio/wav"),
+    "flac": ("FLAC", "PCM_16", "audio/flac"),
+    "opus": ("OGG", "OPUS", "audio/ogg"),
+    "mp3": ("MP3", "MPEG_LAYER_III", "audio/mpeg"),
+}
+
+# 圧縮処理はリクエストスレッドの外、上限付きのスレッドプールで実行する
+# (libsndfile は cffi 経由で GIL を解放するため他のリクエストを止めない)
+_encode_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("AUDIO_ENCODE_WORKERS", "2")),
+    thread_name_prefix="audio-encode",
+)
+ENCODE_TIMEOUT = float(os.getenv("AUDIO_ENCODE_TIMEOUT", "60"))
+
+
+def mime_type_for(audio_format: str) -> str:
+    return AUDIO_FORMATS[audio_format][2]
+
+
+def supported_formats() -> list:
+    """この環境でエンコード可能な形式の一覧"""
+    formats = ["wav"]
+    if sf is None:
+        return formats
+    available = sf.available_formats()
+    for name, (major, subtype, _) in AUDIO_FORMATS.items():
+        if name == "wav" or major not in available:
+            continue
+        if subtype in sf.available_subtypes(major):
+            formats.append(name)
+    return formats
+
+
+def _encode(pcm_data: bytes, audio_format: str, rate: int, channels: int) -> bytes:
+    major, subtype, _ = AUDIO_FORMATS[audio_format]
+    buffer = io.BytesIO()
+    with sf.SoundFile(buffer, mode="w", samplerate=rate, channels=channels,
+                      format=major, subtype=subtype) as f:
+        f.buffer_write(pcm_data, dtype="int16")
+    return buffer.getvalue()
+
+
+def encode_pcm(pcm_data: bytes, audio_format: str, rate: int = 24000, channels: int = 1) -> bytes:
+    """
+    16bit PCM を圧縮形式 (flac / opus / mp3) にエンコードする
+    WAV はこの関数を使わず wave_file() で組み立てる
+    """
+    if audio_format == "wav" or audio_format not in supported_formats():
+        raise ValueError(f"Unsupported audio format: {audio_format}")
+    future = _encode_pool.submit(_encode, pcm_data, audio_format, rate, channels)
+    return future.result(timeout=ENCODE_TIMEOUT)
+
+
+def read_wav_pcm(wav_data: bytes) -> Tuple[bytes, int, int]:
+    """WAV から (PCM, サンプルレート, チャンネル数) を取り出す"""
+    with wave.open(io.BytesIO(wav_data), "rb") as wf:
+        return wf.readframes(wf.getnframes()), wf.getframerate(), wf.getnchannels()
@@ -0,0 +1,80 @@
+import re
+import hashlib
+from typing import Any, Dict, Optional
+
+from cache import DiskCache
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# 先頭バイトから MIME タイプを判定するためのシグネチャ
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"fLaC", "audio/flac"),
+    (b"OggS", "audio/ogg"),
+    (b"ID3", "audio/mpeg"),
+    (b"\xff\xfb", "audio/mpeg"),
+    (b"\xff\xf3", "audio/mpeg"),
+]
+
+
+def sniff_mime_type(head: bytes) -> str:
+    """ファイル先頭のバイト列から MIME タイプを推定する"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "audio/wav"
+    for signature, mime_type in _SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    return "application/octet-stream"
+
+
+class BlobStore:
+    """
+    SHA-256 をキーにしたコンテンツアドレス型のファイルストア
+    同じ内容は一度だけ書き込まれ、合計サイズの上限を超えると古いものから削除される
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.disk = DiskCache(directory, max_bytes=max_bytes)
+
+    @staticmethod
+    def is_valid_digest(digest: str) -> bool:
+        return bool(_DIGEST_RE.match(digest or ""))
+
+    def put(self, data: bytes) -> str:
+        """データを保存してダイジェストを返す"""
+        digest = hashlib.sha256(data).hexdigest()
+        if self.disk.contains(digest):
+            self.disk.touch(digest)
+        else:
+            self.disk.set(digest, data)
+        return digest
+
+    def path(self, digest: str) -> Optional[str]:
+        """保存済みファイルのパス (存在しなければ None)。アクセス順序も更新する"""
+        if not self.is_valid_digest(digest) or not self.disk.contains(digest):
+            return None
+        self.disk.touch(digest)
+        return self.disk.path_for(digest)
+
+    def get(self, digest: str) -> Optional[bytes]:
+        if not self.is_valid_digest(digest):
+            return None
+        return self.disk.get(digest)
+
+    def mime_type(self, digest: str) -> Optional[str]:
+        """保存済みファイルの MIME タイプ (存在しない・容量の上限で削除された後なら None)"""
+        if not self.is_valid_digest(digest):
+            return None
+        try:
+            with open(self.disk.path_for(digest), "rb") as f:
+                return sniff_mime_type(f.read(16))
+        except FileNotFoundError:
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        return self.disk.stats()
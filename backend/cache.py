@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from observability import get_logger
+
+log = get_logger("cache")
+
+
+def make_cache_key(*parts: Any) -> str:
+    """値の組から安定したキャッシュキー (SHA-256 16進文字列) を作る"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """
+    スレッドセーフなメモリ LRU キャッシュ
+    件数上限・TTL (登録からの秒数)・任意のバイト数上限で古いものから追い出す
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None,
+                 max_bytes: Optional[int] = None, sizeof: Callable[[Any], int] = len):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return  # 1件で上限を超えるものは保持しない
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while self._data and (
+                len(self._data) > self.max_entries
+                or (self.max_bytes and self._bytes > self.max_bytes)
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class DiskCache:
+    """
+    ディレクトリ上のバイト列キャッシュ
+    合計サイズが max_bytes を超えたら最終アクセスが古いファイルから、max_bytes × low_water まで削除する。
+    ttl は最終アクセスからの経過秒数として扱う。
+    合計サイズはこのプロセスの書き込みで見積もり、ディレクトリを共有する他のプロセスの書き込みを含めるため
+    rescan_interval 秒ごと (と削除の前) にディレクトリを走査して数え直す
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024,
+                 ttl: Optional[float] = None, suffix: str = "",
+                 low_water: float = 0.9, rescan_interval: float = 60.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.suffix = suffix
+        self.low_water = low_water
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._bytes = sum(size for _, size, _ in self._scan())
+        self._scanned_at = time.monotonic()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def _scan(self):
+        """(path, size, mtime) を列挙"""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith("."):  # 書き込み中の一時ファイルとロックファイル
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def contains(self, key: str) -> bool:
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            return False
+        if self.ttl is not None and os.path.getmtime(path) + self.ttl < time.time():
+            self.delete(key)
+            return False
+        return True
+
+    def touch(self, key: str) -> None:
+        """LRU 順序を更新 (mtime を現在時刻に)"""
+        try:
+            os.utime(self.path_for(key), None)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.contains(key):
+            self.misses += 1
+            return None
+        try:
+            with open(self.path_for(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.touch(key)
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes) -> str:
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 一時ファイルに書いてから置き換え (書き込み途中のファイルを読ませない)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self._bytes += len(data) - old_size
+            due = self._bytes > self.max_bytes or time.monotonic() - self._scanned_at > self.rescan_interval
+        if due:
+            self._evict(keep=path)
+        return path
+
+    def delete(self, key: str) -> None:
+        path = self.path_for(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._bytes -= size
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, keep: str) -> None:
+        """
+        合計サイズを数え直し、max_bytes を超えていれば low_water まで古い順に削除する
+        走査と削除は同時に 1 つ (プロセス間はロックファイル) だけが行い、他が実行中なら何もしない
+        """
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            with open(os.path.join(self.directory, ".lock"), "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                entries = list(self._scan())
+                total = sum(size for _, size, _ in entries)
+                if total > self.max_bytes:
+                    target = self.max_bytes * self.low_water
+                    for path, size, _ in sorted(entries, key=lambda e: e[2]):
+                        if total <= target:
+                            break
+                        if path == keep:
+                            continue
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            continue
+                        total -= size
+                        self.evictions += 1
+                    log.debug("disk cache evicted", directory=self.directory, bytes=total)
+            with self._lock:
+                self._bytes = total
+                self._scanned_at = time.monotonic()
+        finally:
+            self._evict_lock.release()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class TieredCache:
+    """
+    メモリ LRU の後ろに任意でディスク層を置いた 2 段キャッシュ
+    ディスク層には serialize/deserialize でバイト列に変換して保存する
+    """
+
+    def __init__(self, memory: LRUCache, disk: Optional[DiskCache] = None,
+                 serialize: Callable[[Any], bytes] = None,
+                 deserialize: Callable[[bytes], Any] = None):
+        self.memory = memory
+        self.disk = disk
+        self.serialize = serialize or (lambda v: v)
+        self.deserialize = deserialize or (lambda b: b)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Any:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            raw = self.disk.get(key)
+            if raw is not None:
+                try:
+                    value = self.deserialize(raw)
+                except Exception as e:
+                    log.warning("cache entry decode failed, dropping", key=key, error=e)
+                    self.disk.delete(key)
+                    value = None
+                if value is not None:
+                    self.memory.set(key, value)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, self.serialize(value))
+            except OSError as e:
+                log.warning("disk cache write failed", error=e)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "memory": self.memory.stats(),
+        }
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
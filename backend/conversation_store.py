@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from text_chunker import estimate_tokens
+
+# 画像 1 枚をトークン数に換算した値 (履歴の予算計算用の概算)
+IMAGE_TOKENS = 258
+
+
+def turn_tokens(turn: Dict[str, Any]) -> int:
+    """1 ターンの見積もりトークン数 (テキストは estimate_tokens、画像は IMAGE_TOKENS)"""
+    total = 0
+    for part in turn["parts"]:
+        if "text" in part:
+            total += estimate_tokens(part["text"])
+        elif "image" in part:
+            total += IMAGE_TOKENS
+    return total
+
+
+class ConversationStore:
+    """
+    会話 ID ごとの履歴をサーバー側で保持する
+    ターンは {"role": "user" | "model", "parts": [{"text": ...} | {"image": ダイジェスト, "mime_type": ...}]}
+    画像は中身を持たず、画像ストアのダイジェストで参照する
+    max_turns / max_tokens を超えたら古いターンから削除する。
+    ttl 秒間使われなかった会話は破棄し、db_path を指定すると SQLite にも保存する
+    db_path を指定した場合は読み出しも SQLite から行う (複数のワーカープロセスで同じ会話を扱えるように)
+    期限切れの会話は purge_interval 秒に 1 回、会話の作成時にまとめて削除する
+    """
+
+    def __init__(self, max_turns: int = 40, max_tokens: int = 32000, ttl: float = 24 * 3600,
+                 max_conversations: int = 1000, db_path: Optional[str] = None, purge_interval: float = 600):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.ttl = ttl
+        self.max_conversations = max_conversations
+        self.db_path = db_path
+        self.purge_interval = purge_interval
+        self._conversations: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # id -> {"turns", "updated_at"}
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+        self.trimmed_turns = 0
+        if db_path:
+            self._init_db()
+
+    def create(self) -> str:
+        self._purge_expired()
+        conversation_id = uuid.uuid4().hex
+        with self._lock:
+            self._put(conversation_id, [])
+        self._save(conversation_id, [])
+        return conversation_id
+
+    def exists(self, conversation_id: str) -> bool:
+        return self._get(conversation_id) is not None
+
+    def turns(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """履歴 (古い順)。会話が無ければ空リスト"""
+        entry = self._get(conversation_id)
+        return list(entry["turns"]) if entry else []
+
+    def append(self, conversation_id: str, *turns: Dict[str, Any]) -> None:
+        """ターンを追加し、予算を超えた分を古い順に削除する"""
+        if self.db_path:
+            history = self._append_db(conversation_id, turns)
+            with self._lock:
+                self._put(conversation_id, history)
+            return
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            history = list(entry["turns"]) if entry else []
+            history.extend(turns)
+            history = self._trim(history)
+            self._put(conversation_id, history)
+
+    def delete(self, conversation_id: str) -> None:
+        with self._lock:
+            self._conversations.pop(conversation_id, None)
+        if self.db_path:
+            self._execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "conversations": len(self._conversations),
+                "trimmed_turns": self.trimmed_turns,
+                "max_turns": self.max_turns,
+                "max_tokens": self.max_tokens,
+            }
+
+    def _trim(self, history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """ロック取得済みで呼ぶ"""
+        tokens = sum(turn_tokens(turn) for turn in history)
+        while history and (len(history) > self.max_turns or tokens > self.max_tokens):
+            tokens -= turn_tokens(history.pop(0))
+            self.trimmed_turns += 1
+        # モデルへの入力はユーザーのターンから始める
+        while history and history[0]["role"] != "user":
+            tokens -= turn_tokens(history.pop(0))
+            self.trimmed_turns += 1
+        return history
+
+    def _put(self, conversation_id: str, history: List[Dict[str, Any]]) -> None:
+        """ロック取得済みで呼ぶ"""
+        self._conversations[conversation_id] = {"turns": history, "updated_at": time.time()}
+        self._conversations.move_to_end(conversation_id)
+        while len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)  # SQLite 側には残る
+
+    def _get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        # SQLite に保存している場合は他のプロセスが追加したターンがあるため、メモリ上の履歴を使わない
+        if not self.db_path:
+            with self._lock:
+                entry = self._conversations.get(conversation_id)
+                if entry and entry["updated_at"] + self.ttl < time.time():
+                    del self._conversations[conversation_id]
+                    entry = None
+                if entry:
+                    return entry
+        history = self._load(conversation_id)
+        if history is None:
+            return None
+        with self._lock:
+            self._put(conversation_id, history)
+            return self._conversations[conversation_id]
+
+    def _purge_expired(self) -> None:
+        """ttl を過ぎた会話を削除する (前回から purge_interval 秒経っていなければ何もしない)"""
+        now = time.time()
+        with self._lock:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + self.purge_interval
+            expired = [cid for cid, entry in self._conversations.items() if entry["updated_at"] + self.ttl < now]
+            for conversation_id in expired:
+                del self._conversations[conversation_id]
+        if self.db_path:
+            self._execute("DELETE FROM conversations WHERE updated_at < ?", (now - self.ttl,))
+
+    # --- SQLite persistence ---
+
+    def _connect(self, **kwargs) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10, **kwargs)
+
+    def _execute(self, sql: str, params=()) -> None:
+        with self._connect() as conn:
+            conn.execute(sql, params)
+
+    def _init_db(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, turns TEXT, updated_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)")
+
+    _UPSERT = """INSERT INTO conversations (id, turns, updated_at) VALUES (?, ?, ?)
+                 ON CONFLICT(id) DO UPDATE SET turns = excluded.turns, updated_at = excluded.updated_at"""
+
+    def _save(self, conversation_id: str, history: List[Dict[str, Any]]) -> None:
+        if not self.db_path:
+            return
+        self._execute(self._UPSERT, (conversation_id, json.dumps(history, ensure_ascii=False), time.time()))
+
+    def _row_history(self, row) -> Optional[List[Dict[str, Any]]]:
+        if row is None or row[1] + self.ttl < time.time():
+            return None
+        return json.loads(row[0])
+
+    def _load(self, conversation_id: str) -> Optional[List[Dict[str, Any]]]:
+        if not self.db_path:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT turns, updated_at FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        return self._row_history(row)
+
+    def _append_db(self, conversation_id: str, turns) -> List[Dict[str, Any]]:
+        """
+        読み出し・追加・保存を 1 つの書き込みトランザクション (BEGIN IMMEDIATE) で行う
+        (他のプロセスが同時に追加したターンを上書きで失わないように)
+        """
+        conn = self._connect(isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT turns, updated_at FROM conversations WHERE id = ?", (conversation_id,)
+                ).fetchone()
+                history = self._row_history(row) or []
+                history.extend(turns)
+                with self._lock:
+                    history = self._trim(history)
+                conn.execute(self._UPSERT,
+                             (conversation_id, json.dumps(history, ensure_ascii=False), time.time()))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        return history
@@ -0,0 +1,15 @@
+"""
+開発用サーバー (デバッガー・リローダー付き)
+
+    cd backend
+    python dev_server.py
+
+PDF 抽出のワーカープロセス (forkserver) は起動スクリプトを __mp_main__ として読み込み直すため、
+起動スクリプトはこのように import 以外の処理を持たないモジュールにする
+(app.py を起動スクリプトにすると、ワーカーごとに app の初期化をやり直す)
+"""
+
+if __name__ == "__main__":
+    from app import create_app
+
+    create_app().run(host="0.0.0.0", port=5000, debug=True)
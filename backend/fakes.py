@@ -0,0 +1,258 @@
+"""
+Google Cloud / Gemini クライアントのローカル用の代替実装 (テスト・ベンチマーク用)
+ネットワークや認証情報なしで TTSService や app の処理を通すために使う
+
+    service = TTSService(document_ai_client=FakeDocumentProcessorServiceClient(),
+                         vision_client=FakeImageAnnotatorClient())
+
+Document AI を使う経路は GOOGLE_CLOUD_PROJECT_ID と DOCUMENT_AI_PROCESSOR_ID が設定されているときだけ
+有効になるため、これらの環境変数には任意の値を設定しておく
+
+FakeGenerativeModel (google.generativeai) と FakeGenaiClient (google.genai) は
+決まった文字列・画像・PCM を指定した遅延の後に返す (bench/serve.py で差し替えて使う)。
+failure_rate の割合 (または fail_calls の呼び出し番号) で FakeUpstreamError (503) を送出し、
+上流の障害時の再試行やサーキットブレーカーの動作を再現できる
+"""
+import io
+import asyncio
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Callable, Iterable, Optional
+
+import PyPDF2
+from PIL import Image
+
+
+class FakeDocumentProcessorServiceClient:
+    """
+    documentai.DocumentProcessorServiceClient の代わり
+    process_document は PDF を PyPDF2 で読んでテキストを返す。latency 秒の遅延と、
+    fail_calls に含まれる呼び出し番号 (0 始まり) での失敗を再現できる
+    """
+
+    def __init__(self, latency: float = 0.0, fail_calls: Optional[Iterable[int]] = None,
+                 max_pages: Optional[int] = 15):
+        self.latency = latency
+        self.fail_calls = set(fail_calls or ())
+        self.max_pages = max_pages
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def process_document(self, request=None, **kwargs):
+        with self._lock:
+            call = self.calls
+            self.calls += 1
+        time.sleep(self.latency)
+        if call in self.fail_calls:
+            raise RuntimeError(f"fake Document AI failure (call {call})")
+        reader = PyPDF2.PdfReader(io.BytesIO(request.raw_document.content))
+        if self.max_pages and len(reader.pages) > self.max_pages:
+            # 実際の同期処理と同じくページ数の上限を超えるとエラー
+            raise ValueError(f"Document pages exceed the limit: {len(reader.pages)} > {self.max_pages}")
+        text = "\n".join(page.extract_text() or "" for page in reader.pages)
+        return SimpleNamespace(document=SimpleNamespace(text=text))
+
+
+def _decode_text(content: bytes) -> str:
+    try:
+        return content.decode("utf-8")
+    except UnicodeDecodeError:
+        return ""
+
+
+class FakeImageAnnotatorClient:
+    """
+    vision.ImageAnnotatorClient の代わり (batch_annotate_images のみ)
+    画像の「認識結果」は text_for(content) で決める。既定では内容を UTF-8 として読んだ文字列
+    fail_images に含まれる text_for の結果を持つ画像は画像単位のエラーにする
+    """
+
+    def __init__(self, latency: float = 0.0, text_for: Optional[Callable[[bytes], str]] = None,
+                 fail_images: Optional[Iterable[str]] = None, max_batch: int = 16):
+        self.latency = latency
+        self.text_for = text_for or _decode_text
+        self.fail_images = set(fail_images or ())
+        self.max_batch = max_batch
+        self.calls = 0
+        self.batch_sizes = []
+        self._lock = threading.Lock()
+
+    def batch_annotate_images(self, requests=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.batch_sizes.append(len(requests))
+        if len(requests) > self.max_batch:
+            raise ValueError(f"Too many images in one batch: {len(requests)} > {self.max_batch}")
+        time.sleep(self.latency)
+        responses = []
+        for request in requests:
+            text = self.text_for(request.image.content)
+            if text in self.fail_images:
+                error = SimpleNamespace(message=f"fake Vision failure: {text}")
+                responses.append(SimpleNamespace(error=error, text_annotations=[]))
+                continue
+            annotations = [SimpleNamespace(description=text)] if text else []
+            responses.append(SimpleNamespace(error=SimpleNamespace(message=""), text_annotations=annotations))
+        return SimpleNamespace(responses=responses)
+
+
+def _text_response(text: str):
+    part = SimpleNamespace(text=text, inline_data=None)
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))], text=text)
+
+
+def _canned_reply(prompt) -> str:
+    return f"Fake response: {str(prompt)[-60:].strip()}"
+
+
+_png_lock = threading.Lock()
+_png: Optional[bytes] = None
+
+
+def fake_png() -> bytes:
+    """画像生成の応答として返す PNG (初回に作成)"""
+    global _png
+    with _png_lock:
+        if _png is None:
+            buffer = io.BytesIO()
+            Image.new("RGB", (256, 256), (90, 140, 200)).save(buffer, format="PNG")
+            _png = buffer.getvalue()
+        return _png
+
+
+class FakeUpstreamError(Exception):
+    """上流 API の一時的なエラー (google.genai.errors.ServerError と同じく code を持つ)"""
+
+    def __init__(self, code: int = 503, message: str = "UNAVAILABLE: fake upstream failure"):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeGenerativeModel:
+    """
+    google.generativeai.GenerativeModel の代わり
+    response_modalities に IMAGE を含む呼び出し (画像生成) はテキストと PNG のチャンクを返すストリーム、
+    それ以外 (プロンプト処理・要約) はプロンプトの末尾を含む文字列を返す
+    遅延と失敗率はクラス属性で設定する (app はモデル名だけを渡して生成するため)
+    """
+
+    text_latency = 0.0
+    image_latency = 0.0
+    failure_rate = 0.0
+    calls = 0
+    _lock = threading.Lock()
+
+    def __init__(self, model_name: str = "", **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, contents=None, generation_config=None, stream: bool = False, **kwargs):
+        with FakeGenerativeModel._lock:
+            FakeGenerativeModel.calls += 1
+        if random.random() < self.failure_rate:
+            raise FakeUpstreamError()
+        modalities = (generation_config or {}).get("response_modalities") or []
+        if "IMAGE" not in modalities:
+            time.sleep(self.text_latency)
+            return _text_response(_canned_reply(contents))
+        time.sleep(self.image_latency)
+        chunks = _image_chunks()
+        return iter(chunks) if stream else chunks[0]
+
+
+def _image_chunks():
+    """画像生成のストリームのチャンク (テキスト 1 つと PNG 1 つ)"""
+    text_part = SimpleNamespace(text="Here is the generated image.", inline_data=None)
+    image_part = SimpleNamespace(text=None, inline_data=SimpleNamespace(mime_type="image/png", data=fake_png()))
+    return [SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+            for part in (text_part, image_part)]
+
+
+def _modalities(config):
+    return getattr(config, "response_modalities", None) or []
+
+
+class _FakeGenaiModels:
+    def __init__(self, client: "FakeGenaiClient"):
+        self._client = client
+
+    def _count(self) -> None:
+        """呼び出しを数え、失敗させる呼び出しなら FakeUpstreamError"""
+        with self._client._lock:
+            call = self._client.calls
+            self._client.calls += 1
+        if call in self._client.fail_calls or random.random() < self._client.failure_rate:
+            raise FakeUpstreamError()
+
+    def _latency(self, config) -> float:
+        modalities = _modalities(config)
+        if "AUDIO" in modalities:
+            return self._client.tts_latency
+        if "IMAGE" in modalities:
+            return self._client.image_latency
+        return self._client.text_latency
+
+    def _response(self, contents, config):
+        if "AUDIO" in _modalities(config):
+            # 実際の TTS と同じく 24kHz / 16bit / モノラルの PCM (文字数に比例した長さ)
+            samples = int(len(str(contents)) * self._client.audio_seconds_per_char * 24000)
+            inline_data = SimpleNamespace(mime_type="audio/L16;codec=pcm;rate=24000", data=b"\x00\x00" * samples)
+            part = SimpleNamespace(text=None, inline_data=inline_data)
+            return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+        if "IMAGE" in _modalities(config):
+            return _image_chunks()[-1]
+        return _text_response(_canned_reply(contents))
+
+    def generate_content(self, model: str = "", contents=None, config=None):
+        self._count()
+        time.sleep(self._latency(config))
+        return self._response(contents, config)
+
+    def _chunks(self, contents, config):
+        return _image_chunks() if "IMAGE" in _modalities(config) else [self._response(contents, config)]
+
+    def generate_content_stream(self, model: str = "", contents=None, config=None):
+        """実際のクライアントと同じく、反復を始めたときに呼び出す (遅延と失敗も最初の反復で起きる)"""
+        self._count()
+        time.sleep(self._latency(config))
+        yield from self._chunks(contents, config)
+
+
+class _FakeAsyncGenaiModels(_FakeGenaiModels):
+    """client.aio.models の代わり (遅延は asyncio.sleep で待つため、待ち時間中にスレッドを占有しない)"""
+
+    async def generate_content(self, model: str = "", contents=None, config=None):
+        self._count()
+        await asyncio.sleep(self._latency(config))
+        return self._response(contents, config)
+
+    async def generate_content_stream(self, model: str = "", contents=None, config=None):
+        """実際のクライアントと同じく、返したストリームの最初の反復でリクエストを送る (遅延と失敗もそこで起きる)"""
+        async def stream():
+            self._count()
+            await asyncio.sleep(self._latency(config))
+            for chunk in self._chunks(contents, config):
+                yield chunk
+        return stream()
+
+
+class FakeGenaiClient:
+    """
+    google.genai.Client の代わり (models / aio.models の generate_content と generate_content_stream)
+    fail_calls に含まれる呼び出し番号 (0 始まり) と failure_rate の割合の呼び出しは FakeUpstreamError で失敗する
+    """
+
+    def __init__(self, api_key: Optional[str] = None, text_latency: float = 0.0, tts_latency: float = 0.0,
+                 image_latency: float = 0.0, audio_seconds_per_char: float = 0.1,
+                 fail_calls: Optional[Iterable[int]] = None, failure_rate: float = 0.0, **kwargs):
+        self.fail_calls = set(fail_calls or ())
+        self.failure_rate = failure_rate
+        self.text_latency = text_latency
+        self.tts_latency = tts_latency
+        self.image_latency = image_latency
+        self.audio_seconds_per_char = audio_seconds_per_char
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.models = _FakeGenaiModels(self)
+        self.aio = SimpleNamespace(models=_FakeAsyncGenaiModels(self))
@@ -0,0 +1,91 @@
+"""
+本番用のサーバー設定 (gunicorn)
+
+    gunicorn -c backend/gunicorn.conf.py
+
+リクエストの処理時間の大半は Gemini などの外部 API の応答待ち (I/O) のため、gthread ワーカーを使い、
+プロセス数は CPU 数程度に抑えて各プロセスのスレッドで同時リクエストを受ける
+(gevent は gRPC の Document AI / Vision クライアントとモンキーパッチの相性が悪いため使わない)
+
+アプリはマスタープロセスで 1 度だけ読み込み (preload)、ワーカーは fork で起動する。
+外部 API のクライアントとジョブの実行スレッドは各ワーカーで最初に使うときに作られる
+"""
+import os
+import tempfile
+
+from dotenv import load_dotenv
+
+# 下の既定値より前に .env を読む (app.py の load_dotenv は既に設定済みの値を上書きしない)
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+chdir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = "app:create_app()"
+preload_app = True
+
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", str(max(2, min(4, os.cpu_count() or 1)))))
+# 1 プロセスで同時に処理するリクエスト数 (ほとんどの時間は応答待ちのため CPU 数より大きくする)
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+
+# ワーカーがこの秒数応答しなければ強制終了して起動し直す (gthread ではリクエストを受け付けるループが止まった場合)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+# 停止・再起動 (SIGTERM / SIGHUP) で処理中のリクエストの完了を待つ秒数
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+# 指定するとこの件数を処理したワーカーを入れ替える (0 は無効)
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+# ワーカーのハートビートのファイルはメモリ上に置く (Docker のオーバーレイ FS への書き込みで止まらないように)
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+# 複数のワーカーで会話履歴とジョブを共有する (どのワーカーにリクエストが届いても同じ状態を返す)
+if workers > 1:
+    _state_dir = os.getenv("APP_STATE_DIR", os.path.join(tempfile.gettempdir(), "image-app"))
+    os.environ.setdefault("CONVERSATION_DB_PATH", os.path.join(_state_dir, "conversations.db"))
+    os.environ.setdefault("JOB_DB_PATH", os.path.join(_state_dir, "jobs.db"))
+    # /metrics をどのワーカーが受けても全ワーカーの値を返す
+    os.environ.setdefault("METRICS_DIR", os.path.join(_state_dir, "metrics"))
+
+
+def on_starting(server):
+    """前回の起動で書き出されたメトリクス (終了したワーカーの累計を含む) を消す"""
+    metrics_dir = os.getenv("METRICS_DIR")
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            if name.endswith((".json", ".tmp")):
+                os.remove(os.path.join(metrics_dir, name))
+
+
+def post_worker_init(worker):
+    """
+    ジョブの実行をリクエストを待たずに開始する (停止したワーカーのジョブを引き継ぐため)
+    メトリクスの書き出しもここで開始する (/metrics を受けないワーカーの値も集計されるように)
+    """
+    import app
+    from observability import registry
+
+    app.job_manager.start()
+    registry.start_flusher()
+
+
+def worker_exit(server, worker):
+    """終了するワーカーの最後の値を書き出す (counter と histogram は終了後も集計に含める)"""
+    from observability import registry
+
+    registry.flush()
+
+
+def child_exit(server, worker):
+    """
+    終了したワーカーの値を累計 (retired.json) に移してファイルを消す
+    (ワーカーの入れ替えでファイルが増え続けず、同じ pid の新しいワーカーが古い値を上書きしないように)
+    """
+    from observability import registry
+
+    registry.retire(worker.pid)
@@ -0,0 +1,87 @@
+import io
+import os
+import base64
+import hashlib
+from typing import Any, Dict, Tuple
+
+from PIL import Image, ImageOps
+
+from cache import LRUCache, make_cache_key
+from observability import get_logger, span
+
+log = get_logger("image_preprocess")
+
+# 画像生成モデルに送る画像の長辺の上限 (ピクセル) と JPEG の品質
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+# 同じ画像を何度も編集する場合に変換をやり直さないよう、元画像のハッシュで結果を保持する
+_cache = LRUCache(
+    max_entries=int(os.getenv("IMAGE_PREPROCESS_CACHE_SIZE", "64")),
+    max_bytes=int(os.getenv("IMAGE_PREPROCESS_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    sizeof=lambda entry: len(entry[0]),
+)
+
+_EXIF_ORIENTATION = 0x0112
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def normalize_image(data: bytes, mime_type: str) -> Tuple[bytes, str, Dict[str, Any]]:
+    """
+    画像を EXIF の向きに合わせて回転し、長辺を IMAGE_MAX_EDGE 以下に縮小して再エンコードする
+    透過のある画像は PNG、それ以外は JPEG。変換の必要がなく元の方が小さい場合は元のまま返す
+    戻り値: (画像, MIME タイプ, {"width", "height", "original_bytes", "bytes"})
+    """
+    image = Image.open(io.BytesIO(data))
+    original_size = image.size
+    # JPEG は縮小後のサイズに近い解像度でデコードする (大きな写真のデコード時間とメモリを抑える)
+    image.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+    changed = image.size != original_size or image.getexif().get(_EXIF_ORIENTATION, 1) != 1
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) > IMAGE_MAX_EDGE:
+        image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+        changed = True
+
+    buffer = io.BytesIO()
+    if _has_alpha(image):
+        image.save(buffer, format="PNG", optimize=True)
+        new_mime_type = "image/png"
+    else:
+        image.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        new_mime_type = "image/jpeg"
+    encoded = buffer.getvalue()
+
+    if not changed and len(encoded) >= len(data):
+        encoded, new_mime_type = data, mime_type
+    info = {"width": image.size[0], "height": image.size[1], "original_bytes": len(data), "bytes": len(encoded)}
+    return encoded, new_mime_type, info
+
+
+def normalize_inline_image(image_data: Dict[str, str]) -> Dict[str, str]:
+    """
+    {"mime_type", "data": base64} 形式の画像を normalize_image で変換して同じ形式で返す
+    結果は元画像のハッシュと変換設定をキーにキャッシュする
+    base64 や画像としてデコードできない場合は ValueError (呼び出し元で画像を送らない)
+    """
+    key = make_cache_key(hashlib.sha256(image_data["data"].encode("ascii", "replace")).hexdigest(),
+                         IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY)
+    cached = _cache.get(key)
+    if cached is None:
+        try:
+            with span("image_preprocess"):
+                raw = base64.b64decode(image_data["data"])
+                encoded, mime_type, info = normalize_image(raw, image_data["mime_type"])
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise ValueError(f"画像をデコードできません: {e}") from e
+        log.debug("normalized input image", mime_type=mime_type, **info)
+        cached = (base64.b64encode(encoded).decode("ascii"), mime_type)
+        _cache.set(key, cached)
+    data, mime_type = cached
+    return {"mime_type": mime_type, "data": data}
+
+
+def stats() -> Dict[str, Any]:
+    return _cache.stats()
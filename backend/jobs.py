@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from observability import get_logger
+
+log = get_logger("jobs")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """実行中のジョブが取り消された"""
+
+
+class QueueFull(Exception):
+    """待ち行列が上限に達している"""
+
+
+class Job:
+    """非同期ジョブ 1 件の状態"""
+
+    def __init__(self, kind: str, payload: Dict[str, Any], job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = ""
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.version = 0
+        self._cancel_requested = threading.Event()
+        self._manager: Optional["JobManager"] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def set_progress(self, progress: float, message: str = "") -> None:
+        """ハンドラから進捗 (0.0〜1.0) を報告する。取り消し済みなら JobCancelled を送出"""
+        self.check_cancelled()
+        self.progress = max(0.0, min(1.0, progress))
+        if message:
+            self.message = message
+        if self._manager:
+            self._manager._changed(self)
+
+    def check_cancelled(self) -> None:
+        if self._cancel_requested.is_set() or (self._manager and self._manager._cancel_requested_in_db(self.id)):
+            raise JobCancelled()
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": round(self.progress, 4),
+            "message": self.message,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+        if self.status == SUCCEEDED:
+            data["result"] = self.result
+        if self.error:
+            data["error"] = self.error
+        if self._cancel_requested.is_set() and not self.finished:
+            data["cancel_requested"] = True
+        return data
+
+
+class JobManager:
+    """
+    上限付きワーカープールで長時間処理を実行するジョブキュー
+    結果は ttl 秒間取得可能。db_path を指定すると SQLite に状態を保存し、
+    ワーカーの再起動後も結果の取得と未完了ジョブの再実行ができる
+    (未完了ジョブはハートビートが lease 秒途絶えたら別のプロセスが引き継ぐ)
+    ワーカースレッドとメンテナンススレッドはプロセスごとに最初に使うとき (または start()) に用意する。
+    gunicorn の --preload で読み込んだマスタープロセスではジョブを実行しない
+    """
+
+    def __init__(self, max_workers: int = 2, max_queued: int = 100, ttl: float = 3600,
+                 db_path: Optional[str] = None, lease: float = 30):
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.db_path = db_path
+        self.lease = lease
+        self.max_workers = max_workers
+        self._handlers: Dict[str, Callable[[Dict[str, Any], Job], Dict[str, Any]]] = {}
+        self._pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+        if db_path:
+            self._init_db()
+
+    def start(self) -> None:
+        """
+        このプロセスでジョブを実行する準備をする (2 回目以降は何もしない)
+        fork で作られたプロセスでは親のスレッド・ロック・保持中のジョブを引き継がず、別の owner として作り直す
+        """
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            self._jobs: Dict[str, Job] = {}
+            self._lock = threading.Lock()
+            self._cond = threading.Condition(self._lock)
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+            self._local = threading.local()
+            self._pid = os.getpid()
+            if self.db_path:
+                self._recover_orphans()
+                threading.Thread(target=self._maintenance_loop, name="job-maintenance", daemon=True).start()
+
+    # --- public API ---
+
+    def register(self, kind: str, handler: Callable[[Dict[str, Any], Job], Dict[str, Any]]) -> None:
+        """
+        ジョブ種別とハンドラを登録する
+        ハンドラは {"success": bool, ...} を返す。success が False なら error をジョブのエラーとする
+        """
+        self._handlers[kind] = handler
+        if self._pid == os.getpid() and self.db_path:
+            self._recover_orphans()
+
+    def submit(self, kind: str, payload: Dict[str, Any]) -> Job:
+        self.start()
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        with self._lock:
+            self._purge_expired()
+            queued = sum(1 for job in self._jobs.values() if job.status == QUEUED)
+            if queued >= self.max_queued:
+                raise QueueFull()
+            job = Job(kind, payload)
+            self._attach(job)
+        self._save(job)
+        self._pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.start()
+        with self._lock:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+        if job is None and self.db_path:
+            job = self._load(job_id)
+        return job
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """ジョブを取り消す。待機中なら即座に、実行中なら次の進捗報告の時点で停止する"""
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return job
+        job._cancel_requested.set()
+        if job._manager is None and self.db_path:
+            # 他のプロセスが実行中のジョブ: DB 経由で取り消しを伝える
+            self._execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            return job
+        with self._lock:
+            cancelled = job.status == QUEUED
+            if cancelled:
+                self._finish(job, CANCELLED)
+        if cancelled:
+            self._save(job)
+        return job
+
+    def wait_for_change(self, job_id: str, version: int, timeout: float = 1.0) -> None:
+        """ジョブの状態が version から変わるか timeout まで待つ (SSE 用)"""
+        self.start()
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None and job.version == version:
+                self._cond.wait(timeout)
+            elif job is None:
+                self._cond.wait(timeout)  # 他プロセスのジョブは DB をポーリングする
+
+    def stats(self) -> Dict[str, Any]:
+        self.start()
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"jobs": counts, "max_queued": self.max_queued}
+
+    # --- execution ---
+
+    def _attach(self, job: Job) -> None:
+        job._manager = self
+        self._jobs[job.id] = job
+
+    def _run(self, job: Job) -> None:
+        with self._lock:
+            if job.status != QUEUED:
+                return  # 待機中に取り消された
+            job.status = RUNNING
+            self._touch(job)
+        self._save(job)
+        try:
+            job.check_cancelled()
+            result = self._handlers[job.kind](job.payload, job)
+            job.check_cancelled()
+            with self._lock:
+                if result.get("success", True):
+                    job.result = result
+                    job.progress = 1.0
+                    self._finish(job, SUCCEEDED)
+                else:
+                    job.error = result.get("error", "ジョブの実行に失敗しました")
+                    self._finish(job, FAILED)
+        except JobCancelled:
+            with self._lock:
+                self._finish(job, CANCELLED)
+        except Exception as e:
+            log.exception("job failed", job_id=job.id, kind=job.kind)
+            with self._lock:
+                job.error = str(e)
+                self._finish(job, FAILED)
+        self._save(job)
+
+    def _finish(self, job: Job, status: str) -> None:
+        """ロック取得済みで呼ぶ。SQLite への保存は呼び出し側がロックを外してから行う (_save)"""
+        job.status = status
+        self._touch(job)
+
+    def _touch(self, job: Job) -> None:
+        job.updated_at = time.time()
+        job.version += 1
+        self._cond.notify_all()
+
+    def _changed(self, job: Job) -> None:
+        with self._lock:
+            self._touch(job)
+        self._save(job)
+
+    def _purge_expired(self) -> None:
+        """ロック取得済みで呼ぶ。TTL を過ぎた完了済みジョブを破棄"""
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.updated_at + self.ttl < now]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    # --- SQLite persistence ---
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _conn(self) -> sqlite3.Connection:
+        """スレッドごとに使い回す接続 (進捗報告・取り消しの確認のたびに接続を開かない)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _execute(self, sql: str, params=()) -> int:
+        conn = self._conn()
+        with conn:
+            return conn.execute(sql, params).rowcount
+
+    def _init_db(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, kind TEXT, status TEXT, progress REAL, message TEXT,
+                    payload TEXT, result TEXT, error TEXT, created_at REAL, updated_at REAL,
+                    owner TEXT, heartbeat REAL, cancel_requested INTEGER DEFAULT 0)"""
+            )
+
+    def _save(self, job: Job) -> None:
+        if not self.db_path:
+            return
+        self._execute(
+            """INSERT INTO jobs (id, kind, status, progress, message, payload, result, error,
+                                 created_at, updated_at, owner, heartbeat)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET status = excluded.status, progress = excluded.progress,
+                   message = excluded.message, result = excluded.result, error = excluded.error,
+                   updated_at = excluded.updated_at, owner = excluded.owner, heartbeat = excluded.heartbeat""",
+            (job.id, job.kind, job.status, job.progress, job.message, json.dumps(job.payload, ensure_ascii=False),
+             json.dumps(job.result, ensure_ascii=False) if job.result is not None else None, job.error,
+             job.created_at, job.updated_at, self.owner, time.time()),
+        )
+
+    def _load(self, job_id: str) -> Optional[Job]:
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT id, kind, status, progress, message, payload, result, error, created_at, updated_at "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = self._job_from_row(row)
+        if job.finished and job.updated_at + self.ttl < time.time():
+            return None
+        return job
+
+    @staticmethod
+    def _job_from_row(row) -> Job:
+        job_id, kind, status, progress, message, payload, result, error, created_at, updated_at = row
+        job = Job(kind, json.loads(payload), job_id=job_id)
+        job.status = status
+        job.progress = progress or 0.0
+        job.message = message or ""
+        job.result = json.loads(result) if result else None
+        job.error = error
+        job.created_at = created_at
+        job.updated_at = updated_at
+        return job
+
+    def _cancel_requested_in_db(self, job_id: str) -> bool:
+        if not self.db_path:
+            return False
+        with self._conn() as conn:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def _maintenance_loop(self) -> None:
+        """保持中ジョブのハートビート更新・期限切れ削除・放置されたジョブの引き継ぎ"""
+        while True:
+            time.sleep(max(1.0, self.lease / 3))
+            try:
+                now = time.time()
+                self._execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status IN (?, ?)",
+                    (now, self.owner, QUEUED, RUNNING),
+                )
+                self._execute(
+                    "DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ?",
+                    (*FINISHED_STATES, now - self.ttl),
+                )
+                self._recover_orphans()
+            except Exception:
+                log.exception("job maintenance error")
+
+    def _recover_orphans(self) -> None:
+        """ハートビートが途絶えた未完了ジョブ (プロセス終了・再起動) を引き継いで再実行する"""
+        stale_before = time.time() - self.lease
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT id, kind, heartbeat FROM jobs WHERE status IN (?, ?) AND heartbeat < ? AND owner != ?",
+                (QUEUED, RUNNING, stale_before, self.owner),
+            ).fetchall()
+        for job_id, kind, heartbeat in rows:
+            if kind not in self._handlers:
+                continue
+            # 複数プロセスが同時に引き継がないよう、ハートビートを条件に 1 プロセスだけが取得する
+            claimed = self._execute(
+                "UPDATE jobs SET owner = ?, heartbeat = ?, status = ? WHERE id = ? AND heartbeat = ?",
+                (self.owner, time.time(), QUEUED, job_id, heartbeat),
+            )
+            if not claimed:
+                continue
+            job = self._load(job_id)
+            if job is None:
+                continue
+            job.status = QUEUED
+            job.progress = 0.0
+            with self._lock:
+                self._attach(job)
+            log.info("recovered orphaned job", job_id=job_id, kind=job.kind)
+            self._pool.submit(self._run, job)
@@ -0,0 +1,465 @@
+"""
+ログ・処理時間の計測・メトリクス
+
+    log = get_logger(__name__)
+    log.info("prompt processed", mode="enhance", prompt=prompt)   # 長い値は切り詰めて出力
+
+    with span("synthesis", chars=len(text)) as fields:
+        ...
+        fields["bytes"] = len(pcm)   # 終了時のログに追加する値
+
+span の所要時間は stage_duration_seconds ヒストグラムに記録され、/metrics で Prometheus 形式で公開する
+
+メトリクスはプロセスごとに数える。METRICS_DIR を指定すると各プロセスが定期的に自分の値を
+METRICS_DIR/<pid>.json に書き出し、/metrics はすべてのプロセスの値をまとめて返す
+(counter と histogram は合計、gauge は worker ラベル (プロセス ID) を付けて実行中のプロセスごとに返す)
+"""
+import os
+import sys
+import json
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json: 1 行 1 イベントの JSON / text: 人が読む形式
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# ログに出す値 1 つあたりの最大文字数 (プロンプトや応答の全文・base64 をそのまま出さない)
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "200"))
+
+# 複数のプロセス (gunicorn のワーカー) のメトリクスをまとめるディレクトリ (未指定ならプロセスごとの値を返す)
+METRICS_DIR = os.getenv("METRICS_DIR")
+# METRICS_DIR に値を書き出す間隔 (秒)。他のプロセスの値はこの秒数だけ遅れることがある
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# 終了したプロセスの counter と histogram の累計を置く METRICS_DIR 内のファイル
+RETIRED_FILE = "retired.json"
+
+_ROOT_LOGGER = "image_app"
+
+
+def truncate(value: Any, limit: Optional[int] = None) -> Any:
+    """ログ用に値を短くする。バイト列はサイズだけ、長い文字列は先頭だけを残す"""
+    limit = LOG_MAX_FIELD_CHARS if limit is None else limit
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) > limit:
+        return f"{text[:limit]}...(+{len(text) - limit} chars)"
+    return text
+
+
+class _Formatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", {})
+        if record.exc_info:
+            fields = {**fields, "exc": self.formatException(record.exc_info)}
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+        if LOG_FORMAT == "text":
+            pairs = " ".join(f"{key}={value}" for key, value in fields.items())
+            return f"{timestamp} {record.levelname} {record.name} {record.getMessage()} {pairs}".rstrip()
+        payload = {"ts": timestamp, "level": record.levelname, "logger": record.name,
+                   "event": record.getMessage(), **fields}
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def _configure() -> None:
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(_Formatter())
+        root = logging.getLogger(_ROOT_LOGGER)
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        _configured = True
+
+
+class StructuredLogger:
+    """イベント名とキーワード引数の値を出力するロガー (無効なレベルでは値を整形しない)"""
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+
+    def enabled(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def _log(self, level: int, event: str, fields: Dict[str, Any], exc_info: bool = False) -> None:
+        if not self._logger.isEnabledFor(level):
+            return
+        fields = {key: truncate(value) for key, value in fields.items()}
+        self._logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, event: str, **fields: Any) -> None:
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields: Any) -> None:
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields: Any) -> None:
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields: Any) -> None:
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event: str, **fields: Any) -> None:
+        """例外のスタックトレース付きで ERROR を出す (except 節の中で呼ぶ)"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    _configure()
+    return StructuredLogger(logging.getLogger(f"{_ROOT_LOGGER}.{name}"))
+
+
+# --- メトリクス (Prometheus テキスト形式) ---
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: labels must be {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def export(self) -> List[list]:
+        """ファイルに書き出す値 ([[ラベルの値のリスト, 値], ...])"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merged(self, snapshots: List[Tuple[int, bool, List[list]]]) -> "_Metric":
+        """各プロセスの値 ((pid, 実行中か, export の値) のリスト) をまとめたメトリクス"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+    def merged(self, snapshots: List[Tuple[int, bool, List[list]]]) -> "Counter":
+        """終了したプロセスの分も含めて合計する (ワーカーが入れ替わっても値が減らない)"""
+        merged = Counter(self.name, self.help, self.labelnames)
+        for _, _, values in snapshots:
+            for key, value in values:
+                key = tuple(key)
+                merged._values[key] = merged._values.get(key, 0) + value
+        return merged
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def merged(self, snapshots: List[Tuple[int, bool, List[list]]]) -> "Gauge":
+        """実行中のプロセスの値を worker ラベルを付けて返す (状態の値は合計すると意味が変わるため)"""
+        merged = Gauge(self.name, self.help, self.labelnames + ("worker",))
+        for pid, alive, values in snapshots:
+            if alive:
+                for key, value in values:
+                    merged._values[tuple(key) + (str(pid),)] = value
+        return merged
+
+
+# 秒単位。外部 API 呼び出し (数百ミリ秒〜数十秒) を想定した区切り
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # ラベル -> [バケットごとの件数..., 合計, 件数]
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels: Any) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return int(state[-1]) if state else 0
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {int(state[-1])}")
+        return lines
+
+    def merged(self, snapshots: List[Tuple[int, bool, List[list]]]) -> "Histogram":
+        merged = Histogram(self.name, self.help, self.labelnames, self.buckets[:-1])
+        for _, _, values in snapshots:
+            for key, state in values:
+                if len(state) != len(self.buckets) + 2:
+                    continue  # 区切りが異なる版のプロセスの値
+                total = merged._values.setdefault(tuple(key), [0] * len(state))
+                for i, value in enumerate(state):
+                    total[i] += value
+        return merged
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsRegistry:
+    """
+    メトリクスを名前で登録する。同じ名前で再度登録すると既存のものを返す
+    directory を指定すると、そこに書き出された他のプロセスの値もまとめて render する
+    """
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self._flusher_pid: Optional[int] = None
+
+    def _register(self, cls, name: str, help_text: str, labelnames: Sequence[str], **kwargs) -> Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with a different type or labels")
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def _sorted(self) -> List[_Metric]:
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+    def flush(self) -> None:
+        """このプロセスの値を directory/<pid>.json に書き出す"""
+        if not self.directory:
+            return
+        self._write(f"{os.getpid()}.json", {metric.name: metric.export() for metric in self._sorted()})
+
+    def _write(self, name: str, data: Dict[str, Any]) -> None:
+        """
+        directory/name に書き出す (読み手が書きかけを読まないよう置き換える)
+        一時ファイルはスレッドごとに分ける (定期 flush と終了時の flush が重なっても互いの一時ファイルを置き換えない)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def start_flusher(self) -> None:
+        """flush_interval 秒ごとに flush するスレッドを開始する (fork 後の各プロセスで呼ぶ)"""
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except OSError as e:
+                    get_logger("metrics").warning("metrics flush failed", error=e)
+        threading.Thread(target=run, name="metrics-flush", daemon=True).start()
+
+    def retire(self, pid: int) -> None:
+        """
+        終了したプロセスの値を directory/retired.json の累計に加え、<pid>.json を消す
+        (counter と histogram は終了後も合計に含めたまま、同じ pid の新しいプロセスに上書きさせない)
+        マスタープロセスから子プロセスの終了後に呼ぶ (gunicorn の child_exit)
+        """
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f"{pid}.json")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            data, mtime = {}, None
+        retired = _read_json(os.path.join(self.directory, RETIRED_FILE)).get("metrics", {})
+        totals = {metric.name: metric.merged([(0, False, retired.get(metric.name, [])),
+                                              (pid, False, data.get(metric.name, []))]).export()
+                  for metric in self._sorted()}
+        # 書き込みから削除までの間に読んだプロセスが二重に数えないよう、移したファイルを記録する
+        self._write(RETIRED_FILE, {"metrics": totals, "folded": [pid, mtime]})
+        os.remove(path)
+
+    def _snapshots(self) -> List[Tuple[int, bool, Dict[str, List[list]]]]:
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or not name[:-5].isdigit():
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                with open(path) as f:
+                    files.append((int(name[:-5]), mtime, json.load(f)))
+            except (OSError, ValueError):
+                continue
+        # 各プロセスのファイルより後に読む (読んだファイルが累計に移っていれば folded で分かる)
+        retired = _read_json(os.path.join(self.directory, RETIRED_FILE))
+        folded = retired.get("folded")
+        snapshots = [(0, False, retired.get("metrics", {}))]
+        for pid, mtime, data in files:
+            if folded and [pid, mtime] == folded:
+                continue
+            snapshots.append((pid, _alive(pid), data))
+        return snapshots
+
+    def render(self) -> str:
+        metrics = self._sorted()
+        if self.directory:
+            self.flush()
+            snapshots = self._snapshots()
+            metrics = [metric.merged([(pid, alive, data.get(metric.name, [])) for pid, alive, data in snapshots])
+                       for metric in metrics]
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+registry = MetricsRegistry(METRICS_DIR)
+
+STAGE_SECONDS = registry.histogram(
+    "stage_duration_seconds", "Duration of processing stages", ("stage", "outcome"))
+UPSTREAM_ERRORS = registry.counter(
+    "upstream_errors_total", "Errors returned by upstream APIs", ("service", "error"))
+
+_span_log = get_logger("span")
+
+
+@contextmanager
+def span(stage: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+    """
+    処理段階の所要時間を計測して STAGE_SECONDS に記録し、DEBUG ログに出す
+    outcome は正常終了で ok、例外で error、ジェネレーターの途中終了で cancelled
+    失敗を戻り値で返す処理は fields["outcome"] = "failed" のように正常終了時の outcome を変えられる
+    """
+    started = time.perf_counter()
+    outcome = None
+    try:
+        yield fields
+    except GeneratorExit:
+        outcome = "cancelled"
+        raise
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        outcome = outcome or fields.pop("outcome", "ok")
+        fields.pop("outcome", None)
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage, outcome=outcome)
+        _span_log.debug("span", stage=stage, outcome=outcome, ms=round(elapsed * 1000, 1), **fields)
+
+
+def record_upstream_error(service: str, error: BaseException) -> None:
+    """外部 API (Gemini・Document AI・Vision など) のエラーを種類ごとに数える"""
+    UPSTREAM_ERRORS.inc(service=service, error=type(error).__name__)
@@ -0,0 +1,142 @@
+import io
+import os
+import mmap
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import PyPDF2
+
+# これ未満のページ数ならプロセスプールを使わずその場で抽出する (起動・転送のコストの方が大きい)
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "8"))
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 1 タスクで担当するページ数 (ワーカーごとに PDF を開き直すため、小さすぎると解析が重複する)
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _mp_context():
+    """
+    ワーカープロセスは forkserver から起動する (リクエスト処理のスレッドが動いているプロセスを fork しない)
+    forkserver にはこのモジュールを読み込ませておく。ただし各ワーカーは起動スクリプト (__main__) を
+    __mp_main__ として実行し直すため、起動スクリプトには import 以外の処理を置かない
+    (gunicorn の起動スクリプト・dev_server.py・bench/serve.py。app.py を直接実行した場合は dev_server.py から起動し直す)
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """プロセスプールは初回利用時に作る (import 時に子プロセスを起動しない)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS, mp_context=_mp_context())
+        return _pool
+
+
+@contextmanager
+def _open_pdf(source: Union[str, bytes]) -> Iterator[PyPDF2.PdfReader]:
+    """
+    source はファイルパスかバイト列。パスは mmap で開く
+    (ワーカープロセスにはパスだけを渡し、PDF 全体をプロセス間でコピーしない)
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield PyPDF2.PdfReader(mapped)
+    else:
+        yield PyPDF2.PdfReader(io.BytesIO(source))
+
+
+def _extract_pages(source: Union[str, bytes], page_numbers: List[int]) -> List[Tuple[int, str]]:
+    """ワーカープロセスで実行: 指定ページのテキストを (ページ番号, テキスト) で返す"""
+    with _open_pdf(source) as reader:
+        return [(n, reader.pages[n].extract_text() or "") for n in page_numbers]
+
+
+def parse_page_range(spec: Optional[str], page_count: int) -> List[int]:
+    """
+    "1-3,5,8-" のようなページ指定 (1 始まり) を 0 始まりのページ番号のリストにする
+    未指定なら全ページ。範囲外のページは無視する
+    """
+    if not spec or not spec.strip():
+        return list(range(page_count))
+    pages = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            first = int(start) if start.strip() else 1
+            last = int(end) if end.strip() else page_count
+        else:
+            first = last = int(part)
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid page range: {part}")
+        pages.update(range(first - 1, min(last, page_count)))
+    return sorted(pages)
+
+
+def _tasks(page_numbers: List[int]) -> List[List[int]]:
+    return [page_numbers[i:i + PDF_PAGES_PER_TASK] for i in range(0, len(page_numbers), PDF_PAGES_PER_TASK)]
+
+
+def iter_pdf_pages(source: Union[str, bytes], pages: Optional[str] = None) -> Iterator[Dict[str, object]]:
+    """
+    PDF (ファイルパスかバイト列) のページテキストを抽出が終わった順に返す
+    {"page": 1 始まりのページ番号, "text": ..., "total": 対象ページ数}
+    """
+    with _open_pdf(source) as reader:
+        page_numbers = parse_page_range(pages, len(reader.pages))
+        total = len(page_numbers)
+        if total < PDF_PARALLEL_MIN_PAGES or PDF_EXTRACT_WORKERS <= 1:
+            for n in page_numbers:
+                yield {"page": n + 1, "text": reader.pages[n].extract_text() or "", "total": total}
+            return
+
+    pool = _get_pool()
+    futures = [pool.submit(_extract_pages, source, task) for task in _tasks(page_numbers)]
+    try:
+        for future in as_completed(futures):
+            for n, text in future.result():
+                yield {"page": n + 1, "text": text, "total": total}
+    finally:
+        # 途中で打ち切られた場合は未着手のタスクを取り消す
+        for future in futures:
+            future.cancel()
+
+
+def extract_pdf_text(source: Union[str, bytes], pages: Optional[str] = None) -> Tuple[str, int]:
+    """PDF のテキストをページ順に連結して (テキスト, 抽出したページ数) を返す"""
+    by_page = {item["page"]: item["text"] for item in iter_pdf_pages(source, pages)}
+    text = "\n".join(by_page[page] for page in sorted(by_page))
+    return text, len(by_page)
+
+
+def pdf_page_count(source: Union[str, bytes]) -> int:
+    with _open_pdf(source) as reader:
+        return len(reader.pages)
+
+
+def split_pdf(source: Union[str, bytes], page_numbers: List[int],
+              pages_per_shard: int) -> List[Tuple[List[int], bytes]]:
+    """指定ページを pages_per_shard ページずつの PDF に分割して (ページ番号, PDF バイト列) のリストを返す"""
+    shards = []
+    with _open_pdf(source) as reader:
+        for i in range(0, len(page_numbers), pages_per_shard):
+            shard_pages = page_numbers[i:i + pages_per_shard]
+            writer = PyPDF2.PdfWriter()
+            for n in shard_pages:
+                writer.add_page(reader.pages[n])
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            shards.append((shard_pages, buffer.getvalue()))
+    return shards
@@ -0,0 +1,558 @@
+"""
+外部 API (Gemini) 呼び出しの共通ポリシー: 再試行・再試行予算・ヘッジ・サーキットブレーカー
+
+    response = upstream_policy("gemini_tts").call(client.models.generate_content, model=..., contents=...)
+    response = await upstream_policy("gemini_tts").call_async(client.aio.models.generate_content, ...)
+    for chunk in primed(upstream_policy("gemini_image").stream(model.generate_content, ..., stream=True)): ...
+
+- 再試行: 一時的なエラー (429・5xx・接続エラー・タイムアウト) だけを、指数バックオフ + ジッターの間隔で再試行する
+- 再試行予算: 直近の呼び出し数に対する再試行の割合を制限する (障害時に再試行で上流の負荷を増やさない)
+- ヘッジ: hedge_after 秒経っても応答が無ければ同じ呼び出しをもう 1 件送り、先に成功した方を使う (既定は無効)
+- サーキットブレーカー: 一時的なエラーが続いたら一定時間は呼び出さずに CircuitOpenError を送出する
+- 同時呼び出し数: 1 回の試行ごとに admission のモデルごとのゲートの枠を使う (空かなければ Overloaded)
+  ストリーミングの呼び出し (stream / stream_async) はストリームを読み終えるまで枠を使う
+
+設定は UPSTREAM_* の環境変数。サービス名を付けた UPSTREAM_MAX_ATTEMPTS_GEMINI_TTS などで個別に上書きできる
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, Iterator, Optional
+
+from admission import ModelGate, upstream_gate
+from observability import get_logger, record_upstream_error, registry
+
+log = get_logger("resilience")
+
+# 再試行する HTTP ステータス (google-genai の APIError・google.api_core の例外の code)
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+# code を持たない例外 (gRPC など) はメッセージで判定する
+RETRYABLE_MARKERS = ("INTERNAL", "UNAVAILABLE", "RESOURCE_EXHAUSTED", "DEADLINE_EXCEEDED")
+
+RETRIES = registry.counter("upstream_retries_total", "Retried upstream calls", ("service",))
+HEDGES = registry.counter("upstream_hedged_requests_total", "Hedged upstream requests sent", ("service",))
+SHORT_CIRCUITS = registry.counter(
+    "upstream_circuit_open_total", "Upstream calls rejected by an open circuit breaker", ("service",))
+CIRCUIT_STATE = registry.gauge(
+    "upstream_circuit_state", "Circuit breaker state (0 = closed, 1 = half-open, 2 = open)", ("service",))
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため呼び出さなかった (retry_after 秒後に再試行できる)"""
+
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(f"{service} is temporarily unavailable (circuit open, retry after {retry_after:.0f}s)")
+        self.service = service
+        self.retry_after = retry_after
+
+
+def is_retryable(error: BaseException) -> bool:
+    """一時的なエラー (再試行すれば成功する見込みがあり、上流の不調を示すもの) か"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS
+    try:
+        import httpx
+        if isinstance(error, httpx.TransportError):
+            return True
+    except ImportError:
+        pass
+    message = str(error)
+    return any(marker in message for marker in RETRYABLE_MARKERS)
+
+
+def _setting(name: str, service: str, default: Optional[str]) -> Optional[str]:
+    return os.getenv(f"{name}_{service.upper()}", os.getenv(name, default))
+
+
+class RetryBudget:
+    """
+    直近 window 秒の再試行を「min_retries + 呼び出し数 × ratio」件までに制限する
+    (ヘッジで送る追加のリクエストも同じ予算から使う)
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10, window: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._clock = clock
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float) -> None:
+        for events in (self._requests, self._retries):
+            while events and events[0] <= now - self.window:
+                events.popleft()
+
+    def record_request(self) -> None:
+        with self._lock:
+            now = self._clock()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_acquire(self) -> bool:
+        """再試行してよければ予算を 1 件使って True"""
+        with self._lock:
+            now = self._clock()
+            self._trim(now)
+            if len(self._retries) >= self.min_retries + len(self._requests) * self.ratio:
+                return False
+            self._retries.append(now)
+            return True
+
+
+class CircuitBreaker:
+    """
+    一時的なエラーが failure_threshold 回続いたら開き、reset_timeout 秒の間は呼び出しを拒否する
+    その後は 1 件だけ試し (half-open)、成功すれば閉じ、失敗すればまた開く
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(self, service: str, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """
+        呼び出してよいか確認する。拒否する場合は CircuitOpenError
+        half-open の試行を任されたら True (結果を記録せずに終わる場合に備えて end_probe に渡す)
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.reset_timeout - self._clock()
+                if remaining > 0:
+                    SHORT_CIRCUITS.inc(service=self.service)
+                    raise CircuitOpenError(self.service, remaining)
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    SHORT_CIRCUITS.inc(service=self.service)
+                    raise CircuitOpenError(self.service, 1.0)
+                self._probing = True
+                return True
+        return False
+
+    def end_probe(self, probe: bool) -> None:
+        """
+        before_call で任された試行を終える (試行が結果を記録せずに中断された場合に half-open のまま止まらないように、
+        呼び出し元の finally で呼ぶ)
+        """
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                log.info("circuit closed", service=self.service)
+                self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    log.warning("circuit opened", service=self.service, failures=self._failures,
+                                reset_timeout_s=self.reset_timeout)
+                self._opened_at = self._clock()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state: str) -> None:
+        """ロック取得済みで呼ぶ"""
+        self.state = state
+        CIRCUIT_STATE.set((self.CLOSED, self.HALF_OPEN, self.OPEN).index(state), service=self.service)
+
+
+# ヘッジしたリクエストを実行するスレッド (同期の呼び出し用)
+_hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("UPSTREAM_HEDGE_WORKERS", "16")),
+                                 thread_name_prefix="hedge")
+
+
+class UpstreamPolicy:
+    """
+    1 つの外部サービス (service はメトリクスとログのラベル) への呼び出しポリシー
+    sleep (同期の呼び出しの再試行の待ち) と rand はテストで差し替える
+    """
+
+    def __init__(self, service: str, max_attempts: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 hedge_after: Optional[float] = None, budget: Optional[RetryBudget] = None,
+                 breaker: Optional[CircuitBreaker] = None, gate: Optional[ModelGate] = None,
+                 sleep: Callable[[float], None] = time.sleep, rand: Callable[[], float] = random.random):
+        self.service = service
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker(service)
+        self.gate = gate
+        self._sleep = sleep
+        self._rand = rand
+
+    @classmethod
+    def from_env(cls, service: str) -> "UpstreamPolicy":
+        hedge_after = _setting("UPSTREAM_HEDGE_AFTER", service, None)
+        return cls(
+            service,
+            max_attempts=int(_setting("UPSTREAM_MAX_ATTEMPTS", service, "3")),
+            backoff_base=float(_setting("UPSTREAM_BACKOFF_BASE", service, "0.5")),
+            backoff_max=float(_setting("UPSTREAM_BACKOFF_MAX", service, "8")),
+            hedge_after=float(hedge_after) if hedge_after else None,
+            budget=RetryBudget(
+                ratio=float(_setting("UPSTREAM_RETRY_BUDGET_RATIO", service, "0.2")),
+                min_retries=int(_setting("UPSTREAM_RETRY_BUDGET_MIN", service, "10")),
+            ),
+            breaker=CircuitBreaker(
+                service,
+                failure_threshold=int(_setting("UPSTREAM_BREAKER_FAILURES", service, "5")),
+                reset_timeout=float(_setting("UPSTREAM_BREAKER_RESET", service, "30")),
+            ),
+            gate=upstream_gate(service),
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """attempt 回目 (0 始まり) の失敗の後に待つ秒数 (full jitter: 0〜上限の一様乱数)"""
+        return self._rand() * min(self.backoff_max, self.backoff_base * (2 ** attempt))
+
+    def _hedge_allowed(self) -> bool:
+        """ヘッジを送れるなら予算とゲートの枠を確保して True (ゲートの空きは待たない)"""
+        if self.gate and not self.gate.try_acquire():
+            return False
+        if not self.budget.try_acquire():
+            self._release()
+            return False
+        return True
+
+    def _release(self) -> None:
+        if self.gate:
+            self.gate.release()
+
+    def _record_failure(self, error: BaseException) -> bool:
+        """失敗をメトリクスとブレーカーに記録し、一時的なエラーなら True"""
+        record_upstream_error(self.service, error)
+        if not is_retryable(error):
+            self.breaker.record_success()  # 上流は応答している (リクエスト側の問題)
+            return False
+        self.breaker.record_failure()
+        return True
+
+    def _failed(self, error: BaseException, attempt: int) -> bool:
+        """失敗を記録し、再試行するなら True"""
+        if not self._record_failure(error):
+            return False
+        if attempt + 1 >= self.max_attempts:
+            return False
+        if not self.budget.try_acquire():
+            log.warning("retry budget exhausted", service=self.service, error=error)
+            return False
+        RETRIES.inc(service=self.service)
+        return True
+
+    def _retry_delay(self, attempt: int, error: BaseException) -> float:
+        delay = self.backoff(attempt)
+        log.info("retrying upstream call", service=self.service, attempt=attempt + 1,
+                 delay_s=round(delay, 3), error=error)
+        return delay
+
+    # --- 同期 ---
+
+    def _enter(self) -> bool:
+        """
+        ブレーカーを確認してゲートの枠を確保する (拒否なら CircuitOpenError / Overloaded)
+        half-open の試行を任されたら True (終わったら breaker.end_probe に渡す)
+        """
+        probe = self.breaker.before_call()
+        if self.gate:
+            try:
+                self.gate.acquire()
+            except BaseException:
+                self.breaker.end_probe(probe)
+                raise
+        return probe
+
+    def call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            probe = self._enter()
+            try:
+                result = self._attempt(fn, args, kwargs)
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                error = e
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                self.breaker.end_probe(probe)
+            self._sleep(self._retry_delay(attempt, error))
+            attempt += 1
+
+    def stream(self, fn: Callable[..., Iterable[Any]], *args: Any, **kwargs: Any) -> Iterator[Any]:
+        """
+        fn の戻り値 (ストリーム) のチャンクを返すジェネレーター (ヘッジはしない)
+        ゲートの枠はストリームを読み終えるか閉じるまで使う。最初のチャンクより前の失敗は call と同じく再試行し、
+        途中の失敗は記録して送出する (渡し済みのチャンクがあるため再試行しない)
+        """
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            probe = self._enter()
+            started = False
+            try:
+                for chunk in fn(*args, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if started:
+                    self._record_failure(e)
+                    raise
+                if not self._failed(e, attempt):
+                    raise
+                error = e
+            else:
+                self.breaker.record_success()
+                return
+            finally:
+                self._release()
+                self.breaker.end_probe(probe)
+            self._sleep(self._retry_delay(attempt, error))
+            attempt += 1
+
+    def _holding_slot(self, fn, args, kwargs) -> Any:
+        """確保済みの枠を fn が終わるまで使う (ヘッジで負けた試行も終わるまで枠を返さない)"""
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._release()
+
+    def _attempt(self, fn, args, kwargs) -> Any:
+        """1 回の試行。_enter で確保した枠はこの試行 (ヘッジしたならそれぞれのリクエスト) が終わったときに返す"""
+        if self.hedge_after is None:
+            return self._holding_slot(fn, args, kwargs)
+        try:
+            primary = _hedge_pool.submit(self._holding_slot, fn, args, kwargs)
+        except BaseException:
+            self._release()
+            raise
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done or not self._hedge_allowed():
+            return primary.result()
+        HEDGES.inc(service=self.service)
+        log.debug("sending hedged request", service=self.service, after_s=self.hedge_after)
+        pending = {primary, _hedge_pool.submit(self._holding_slot, fn, args, kwargs)}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()  # 遅い方の結果は捨てる
+                error = error or future.exception()
+        raise error
+
+    # --- asyncio ---
+
+    async def _enter_async(self) -> bool:
+        probe = self.breaker.before_call()
+        if self.gate:
+            try:
+                await self.gate.acquire_async()
+            except BaseException:
+                self.breaker.end_probe(probe)
+                raise
+        return probe
+
+    async def call_async(self, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            probe = await self._enter_async()
+            try:
+                result = await self._attempt_async(fn, args, kwargs)
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                error = e
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                self.breaker.end_probe(probe)
+            await asyncio.sleep(self._retry_delay(attempt, error))
+            attempt += 1
+
+    async def stream_async(self, fn: Callable[..., Awaitable[AsyncIterable[Any]]],
+                           *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        """
+        stream の asyncio 版 (fn は反復できるストリームを返すコルーチン)
+        google-genai の非同期ストリームは最初の反復でリクエストを送るため、反復全体をポリシーの内側で行う
+        """
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            probe = await self._enter_async()
+            started = False
+            try:
+                async for chunk in await fn(*args, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if started:
+                    self._record_failure(e)
+                    raise
+                if not self._failed(e, attempt):
+                    raise
+                error = e
+            else:
+                self.breaker.record_success()
+                return
+            finally:
+                self._release()
+                self.breaker.end_probe(probe)
+            await asyncio.sleep(self._retry_delay(attempt, error))
+            attempt += 1
+
+    async def _holding_slot_async(self, fn, args, kwargs) -> Any:
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            self._release()
+
+    async def _attempt_async(self, fn, args, kwargs) -> Any:
+        if self.hedge_after is None:
+            return await self._holding_slot_async(fn, args, kwargs)
+        primary = asyncio.ensure_future(self._holding_slot_async(fn, args, kwargs))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_after)
+            if done or not self._hedge_allowed():
+                return await primary
+            HEDGES.inc(service=self.service)
+            log.debug("sending hedged request", service=self.service, after_s=self.hedge_after)
+            pending.add(asyncio.ensure_future(self._holding_slot_async(fn, args, kwargs)))
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()  # 負けた試行は取り消され、終わったときに枠を返す
+
+
+_EMPTY = object()
+
+
+class _Primed:
+    """primed の戻り値。読み始める前に close() しても元のストリームを閉じる (モデルの枠をすぐ返す)"""
+
+    def __init__(self, first: Any, stream: Iterator[Any]):
+        self._first = first
+        self._stream = stream
+
+    def __iter__(self) -> "_Primed":
+        return self
+
+    def __next__(self) -> Any:
+        if self._first is not _EMPTY:
+            first, self._first = self._first, _EMPTY
+            return first
+        return next(self._stream)
+
+    def close(self) -> None:
+        self._first = _EMPTY
+        close = getattr(self._stream, "close", None)
+        if close:
+            close()
+
+
+class _PrimedAsync:
+    """primed_async の戻り値 (_Primed の asyncio 版)"""
+
+    def __init__(self, first: Any, stream: AsyncIterator[Any]):
+        self._first = first
+        self._stream = stream
+
+    def __aiter__(self) -> "_PrimedAsync":
+        return self
+
+    async def __anext__(self) -> Any:
+        if self._first is not _EMPTY:
+            first, self._first = self._first, _EMPTY
+            return first
+        return await self._stream.__anext__()
+
+    async def aclose(self) -> None:
+        self._first = _EMPTY
+        aclose = getattr(self._stream, "aclose", None)
+        if aclose:
+            await aclose()
+
+
+def primed(stream: Iterator[Any]) -> _Primed:
+    """
+    ストリームを最初のチャンクまで読み進めて、同じ内容を最初から返すイテレーターにする
+    (上流の失敗や受け付けの拒否を、レスポンスを返し始める前に送出させる)
+    読み終えずに捨てる場合は close() を呼ぶ (元のストリームを閉じて、使っているモデルの枠を返す)
+    """
+    try:
+        first = next(stream)
+    except StopIteration:
+        first = _EMPTY
+    return _Primed(first, stream)
+
+
+async def primed_async(stream: AsyncIterator[Any]) -> _PrimedAsync:
+    """primed の asyncio 版 (読み終えずに捨てる場合は aclose() を呼ぶ)"""
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = _EMPTY
+    return _PrimedAsync(first, stream)
+
+
+_policies: Dict[str, UpstreamPolicy] = {}
+_policies_lock = threading.Lock()
+
+
+def upstream_policy(service: str) -> UpstreamPolicy:
+    """サービスごとに共有するポリシー (初回に環境変数から作る)"""
+    with _policies_lock:
+        policy = _policies.get(service)
+        if policy is None:
+            policy = _policies[service] = UpstreamPolicy.from_env(service)
+        return policy
+
+
+def set_upstream_policy(service: str, policy: UpstreamPolicy) -> None:
+    """ポリシーを差し替える (テストで sleep を差し替える場合など)"""
+    with _policies_lock:
+        _policies[service] = policy
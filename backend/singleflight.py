@@ -0,0 +1,88 @@
+"""
+同じキーの処理が同時に複数来たら 1 回だけ実行し、待っていた呼び出しにも同じ結果を返す (single-flight)
+
+    speech_flight = SingleFlight("speech")
+    pcm = speech_flight.do(cache_key, synthesize, text)                # スレッドから
+    pcm = await speech_flight.do_async(cache_key, synthesize_async, text)  # asyncio から
+
+実行中の処理だけをまとめる (終わった結果は覚えない。結果の再利用はキャッシュで行う)。
+実行した処理が例外を送出した場合は、待っていた呼び出しにも同じ例外を送出する。
+結果のオブジェクトは呼び出し元の間で共有されるため、呼び出し元で変更しない
+"""
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from observability import get_logger, registry
+
+log = get_logger("singleflight")
+
+SHARED = registry.counter("singleflight_shared_total",
+                          "Calls that waited for an identical in-flight call instead of running their own", ("name",))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """name はメトリクスとログのラベル"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, _Call] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """key の処理が実行中ならその完了を待って結果を返し、無ければ fn を実行する (スレッド間でまとめる)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            SHARED.inc(name=self.name)
+            log.debug("waiting for in-flight call", name=self.name, key=key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: str, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """
+        do の asyncio 版 (同じイベントループのタスク間でまとめる)
+        処理は独立したタスクで実行するため、最初の呼び出しが取り消されても待っている呼び出しには結果が届く
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._tasks.get(key)
+            shared = task is not None and task.get_loop() is loop
+            if not shared:
+                task = self._tasks[key] = loop.create_task(fn(*args, **kwargs))
+                task.add_done_callback(lambda t: self._finished(key, t))
+        if shared:
+            SHARED.inc(name=self.name)
+            log.debug("waiting for in-flight call", name=self.name, key=key)
+        return await asyncio.shield(task)
+
+    def _finished(self, key: str, task: asyncio.Task) -> None:
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # 待っている呼び出しが無くても「取り出されなかった例外」の警告を出さない
@@ -0,0 +1,5 @@
+"""backend のモジュールを (起動時と同じく) トップレベルのモジュールとして import できるようにする"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+import pytest
+
+from admission import ClientRateLimiter, ModelGate, Overloaded, TokenBucket
+
+
+def test_token_bucket_refills():
+    now = [0.0]
+    bucket = TokenBucket(rate=1.0, burst=2, clock=lambda: now[0])
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(1.0)
+    now[0] = 1.0
+    assert bucket.take() == 0
+
+
+def test_client_rate_limiter_is_per_client():
+    limiter = ClientRateLimiter(per_minute=60, burst=1, clock=lambda: 0.0)
+    limiter.check("a")
+    limiter.check("b")
+    with pytest.raises(Overloaded) as info:
+        limiter.check("a")
+    assert info.value.reason == "rate_limited"
+
+
+def test_gate_rejects_when_queue_is_full():
+    gate = ModelGate("test", limit=1, max_queue=0)
+    gate.acquire()
+    with pytest.raises(Overloaded) as info:
+        gate.acquire()
+    assert info.value.reason == "queue_full"
+    gate.release()
+    gate.acquire()
+
+
+def test_gate_rejects_after_max_wait():
+    gate = ModelGate("test", limit=1, max_queue=1, max_wait=0.05, retry_after=3)
+    gate.acquire()
+    with pytest.raises(Overloaded) as info:
+        gate.acquire()
+    assert info.value.reason == "wait_timeout"
+    assert info.value.retry_after == 3
+    assert not gate._waiters
+
+
+def test_gate_hands_slot_to_waiter():
+    gate = ModelGate("test", limit=1, max_queue=1, max_wait=5)
+    gate.acquire()
+    acquired = threading.Event()
+
+    def waiter():
+        with gate.slot():
+            acquired.set()
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    assert not acquired.wait(0.05)
+    gate.release()
+    thread.join(5)
+    assert acquired.is_set()
+    assert gate._active == 0
+
+
+def test_gate_async_wait_timeout():
+    gate = ModelGate("test", limit=1, max_queue=1, max_wait=0.05)
+
+    async def run():
+        await gate.acquire_async()
+        with pytest.raises(Overloaded) as info:
+            await gate.acquire_async()
+        assert info.value.reason == "wait_timeout"
+        gate.release()
+    asyncio.run(run())
+    assert gate._active == 0
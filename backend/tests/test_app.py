@@ -0,0 +1,65 @@
+import base64
+import io
+
+import pytest
+
+from fakes import FakeGenerativeModel, fake_png
+
+NOT_AN_IMAGE = base64.b64encode(b"hello world, not an image").decode("ascii")
+
+
+class _RecordingModel(FakeGenerativeModel):
+    contents = []
+
+    def generate_content(self, contents=None, **kwargs):
+        _RecordingModel.contents.append(contents)
+        return super().generate_content(contents, **kwargs)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    for name in ("IMAGE_STORE_DIR", "AUDIO_STORE_DIR", "TTS_CACHE_DIR", "EXTRACT_CACHE_DIR"):
+        monkeypatch.setenv(name, str(tmp_path / name.lower()))
+    import app
+    monkeypatch.setattr(app.genai, "GenerativeModel", _RecordingModel)
+    _RecordingModel.contents = []
+    return app.app.test_client()
+
+
+def _inline_parts():
+    """画像生成の呼び出しで送った画像 (プロンプト処理の呼び出しは文字列を送る)"""
+    return [part for contents in _RecordingModel.contents if isinstance(contents, list)
+            for turn in contents for part in turn["parts"] if "inline_data" in part]
+
+
+def test_generate_rejects_base64_that_is_not_an_image(client):
+    response = client.post("/generate", json={"image_data": {"mime_type": "image/png", "data": NOT_AN_IMAGE}})
+    assert response.status_code == 400
+    assert _RecordingModel.contents == []
+
+
+def test_generate_drops_base64_that_is_not_an_image_and_sends_the_prompt(client):
+    response = client.post("/generate", json={
+        "prompt": "猫", "image_data": {"mime_type": "image/png", "data": NOT_AN_IMAGE}})
+    assert response.status_code == 200
+    assert any(isinstance(contents, list) for contents in _RecordingModel.contents)
+    assert _inline_parts() == []
+
+
+def test_generate_sends_a_valid_image(client):
+    data = base64.b64encode(fake_png()).decode("ascii")
+    response = client.post("/generate", json={"prompt": "猫", "image_data": {"mime_type": "image/png", "data": data}})
+    assert response.status_code == 200
+    assert len(_inline_parts()) == 1
+
+
+def test_extract_stream_closes_the_upload_when_the_body_is_never_read(client):
+    from uploads import accounting
+    in_flight = accounting.in_flight
+    response = client.post("/api/tts/extract-text/stream", buffered=False, data={
+        "file": (io.BytesIO(b"%PDF-1.4\n" + b"0" * 200_000), "doc.pdf", "application/pdf")})
+    assert response.status_code == 200
+    assert accounting.in_flight == in_flight + 1
+    response.close()
+    assert accounting.in_flight == in_flight
@@ -0,0 +1,12 @@
+import os
+
+from blob_store import BlobStore
+
+
+def test_mime_type_of_missing_blob_is_none(tmp_path):
+    store = BlobStore(str(tmp_path))
+    digest = store.put(b"\x89PNG\r\n\x1a\n" + b"\x00" * 8)
+    assert store.mime_type(digest) == "image/png"
+    os.remove(store.disk.path_for(digest))  # 容量の上限で削除された場合
+    assert store.mime_type(digest) is None
+    assert store.mime_type("../etc/passwd") is None
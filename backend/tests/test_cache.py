@@ -0,0 +1,31 @@
+import os
+
+from cache import DiskCache
+
+
+def _disk_usage(directory):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(directory) for name in files if not name.startswith("."))
+
+
+def test_evicts_oldest_down_to_low_water(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1000, low_water=0.5)
+    for i in range(10):
+        cache.set(f"{i:02d}key", b"x" * 100)
+        os.utime(cache.path_for(f"{i:02d}key"), (i, i))  # 書き込み順を最終アクセス順にする
+    assert cache.evictions == 0
+    cache.set("10key", b"x" * 100)
+    assert cache.evictions == 6
+    assert _disk_usage(tmp_path) == 500
+    assert cache.stats()["bytes"] == 500
+    assert cache.get("10key") is not None
+    assert cache.get("00key") is None
+    assert cache.get("09key") is not None
+
+
+def test_cap_holds_across_processes_sharing_the_directory(tmp_path):
+    # ワーカーごとのインスタンスは他のワーカーの書き込みを走査で数え直す
+    workers = [DiskCache(str(tmp_path), max_bytes=1000, rescan_interval=0) for _ in range(3)]
+    for i in range(30):
+        workers[i % 3].set(f"{i:02d}key", b"x" * 100)
+    assert _disk_usage(tmp_path) <= 1000
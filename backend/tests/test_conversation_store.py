@@ -0,0 +1,51 @@
+import sqlite3
+import threading
+import time
+
+from conversation_store import ConversationStore
+
+
+def _turn(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
+
+def test_concurrent_appends_from_several_processes_keep_every_turn(tmp_path):
+    db_path = str(tmp_path / "conversations.db")
+    # ワーカープロセスごとのストア (メモリ上の状態とロックは共有しない)
+    stores = [ConversationStore(max_turns=1000, max_tokens=10 ** 6, db_path=db_path) for _ in range(4)]
+    conversation_id = stores[0].create()
+
+    def worker(store, n):
+        for i in range(10):
+            store.append(conversation_id, _turn("user", f"{n}-{i}"), _turn("model", "ok"))
+    threads = [threading.Thread(target=worker, args=(store, n)) for n, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    turns = stores[0].turns(conversation_id)
+    assert len(turns) == 80
+    assert {turn["parts"][0]["text"] for turn in turns if turn["role"] == "user"} == \
+        {f"{n}-{i}" for n in range(4) for i in range(10)}
+
+
+def test_expired_conversations_are_purged(tmp_path):
+    db_path = str(tmp_path / "conversations.db")
+    store = ConversationStore(ttl=60, db_path=db_path, purge_interval=0)
+    old = store.create()
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (time.time() - 120, old))
+    new = store.create()
+    with sqlite3.connect(db_path) as conn:
+        ids = {row[0] for row in conn.execute("SELECT id FROM conversations")}
+    assert ids == {new}
+    assert not store.exists(old)
+
+
+def test_append_trims_to_budget_in_memory():
+    store = ConversationStore(max_turns=2)
+    conversation_id = store.create()
+    for i in range(3):
+        store.append(conversation_id, _turn("user", str(i)), _turn("model", "ok"))
+    assert [turn["parts"][0]["text"] for turn in store.turns(conversation_id)] == ["2", "ok"]
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from jobs import CANCELLED, SUCCEEDED, JobManager
+
+
+def _wait_finished(manager, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = manager.get(job_id)
+        if job.finished:
+            return job
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_progress_reports_reuse_one_connection_per_thread(tmp_path):
+    manager = JobManager(db_path=str(tmp_path / "jobs.db"))
+    connects = []
+    connect = manager._connect
+    manager._connect = lambda: connects.append(threading.current_thread().name) or connect()
+
+    def handler(payload, job):
+        for i in range(50):
+            job.set_progress(i / 50)
+        return {"success": True}
+    manager.register("count", handler)
+    job = manager.submit("count", {})
+
+    assert _wait_finished(manager, job.id).status == SUCCEEDED
+    job_threads = [name for name in connects if name.startswith("job")]
+    assert len(job_threads) == len(set(job_threads)) == 1
+
+
+def test_sqlite_writes_happen_outside_the_manager_lock(tmp_path):
+    manager = JobManager(db_path=str(tmp_path / "jobs.db"))
+    manager.register("noop", lambda payload, job: {"success": True})
+    manager.start()
+    held = []
+    execute = manager._execute
+
+    def checked_execute(sql, params=()):
+        if sql.lstrip().startswith("INSERT"):
+            held.append(manager._lock.locked())
+        return execute(sql, params)
+    manager._execute = checked_execute
+
+    job = manager.submit("noop", {})
+    assert _wait_finished(manager, job.id).status == SUCCEEDED
+    assert held and not any(held)
+
+
+def test_cancel_from_another_process_stops_the_job(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    runner, other = JobManager(db_path=db_path), JobManager(db_path=db_path)
+    started = threading.Event()
+
+    def handler(payload, job):
+        started.set()
+        while True:
+            job.set_progress(0.5)
+            time.sleep(0.01)
+    runner.register("loop", handler)
+    job = runner.submit("loop", {})
+    assert started.wait(5)
+
+    other.cancel(job.id)
+    assert _wait_finished(runner, job.id).status == CANCELLED
@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+
+from observability import MetricsRegistry
+
+
+def _registry(directory):
+    registry = MetricsRegistry(str(directory))
+    requests = registry.counter("requests_total", "Requests", ("endpoint",))
+    in_flight = registry.gauge("in_flight", "In flight")
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    return registry, requests, in_flight, latency
+
+
+def test_render_merges_other_workers(tmp_path):
+    registry, requests, in_flight, latency = _registry(tmp_path)
+    requests.inc(endpoint="/generate")
+    in_flight.set(2)
+    latency.observe(0.05)
+    # 実行中の別のワーカー (この親プロセス) と終了したワーカーの値
+    other = {"requests_total": [[["/generate"], 3]], "in_flight": [[[], 5]],
+             "latency_seconds": [[[], [0, 1, 0, 0.5, 1]]]}
+    (tmp_path / f"{os.getppid()}.json").write_text(json.dumps(other))
+    (tmp_path / "999999999.json").write_text(json.dumps(other))
+
+    lines = registry.render().splitlines()
+    assert 'requests_total{endpoint="/generate"} 7' in lines
+    assert f'in_flight{{worker="{os.getpid()}"}} 2' in lines
+    assert f'in_flight{{worker="{os.getppid()}"}} 5' in lines
+    assert not any('worker="999999999"' in line for line in lines)
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 3' in lines
+    assert "latency_seconds_count 3" in lines
+    assert (tmp_path / f"{os.getpid()}.json").exists()
+
+
+def test_render_without_directory_is_per_process():
+    registry = MetricsRegistry()
+    registry.gauge("in_flight", "In flight").set(1)
+    assert "in_flight 1" in registry.render().splitlines()
+
+
+def test_retired_worker_is_folded_into_totals(tmp_path):
+    registry, requests, _, _ = _registry(tmp_path)
+    requests.inc(endpoint="/generate")
+    dead = {"requests_total": [[["/generate"], 3]], "in_flight": [[[], 5]],
+            "latency_seconds": [[[], [0, 1, 0, 0.5, 1]]]}
+    for _ in range(2):  # 同じ pid が再利用されても前のワーカーの値は残る
+        (tmp_path / "999999999.json").write_text(json.dumps(dead))
+        registry.retire(999999999)
+        assert not (tmp_path / "999999999.json").exists()
+
+    lines = registry.render().splitlines()
+    assert 'requests_total{endpoint="/generate"} 7' in lines
+    assert "latency_seconds_count 2" in lines
+    assert not any(line.startswith("in_flight{") and 'worker="999999999"' in line for line in lines)
+
+
+def test_file_already_folded_is_not_counted_twice(tmp_path):
+    registry, requests, _, _ = _registry(tmp_path)
+    dead = {"requests_total": [[["/generate"], 3]]}
+    path = tmp_path / "999999999.json"
+    path.write_text(json.dumps(dead))
+    registry.retire(999999999)
+    # 累計を書いてからファイルを消すまでの間に読んだ場合
+    path.write_text(json.dumps(dead))
+    os.utime(path, ns=(0, json.loads((tmp_path / "retired.json").read_text())["folded"][1]))
+
+    assert 'requests_total{endpoint="/generate"} 3' in registry.render().splitlines()
+
+
+def test_concurrent_flushes_do_not_collide(tmp_path):
+    registry, requests, _, _ = _registry(tmp_path)
+    requests.inc(endpoint="/generate")
+    errors = []
+
+    def flush():
+        try:
+            for _ in range(200):
+                registry.flush()
+        except OSError as e:
+            errors.append(e)
+
+    # 定期 flush のスレッドと終了時の flush が重なる場合
+    threads = [threading.Thread(target=flush) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sorted(os.listdir(tmp_path)) == [f"{os.getpid()}.json"]
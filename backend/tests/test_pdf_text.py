@@ -0,0 +1,24 @@
+import pytest
+
+from pdf_text import parse_page_range
+
+
+@pytest.mark.parametrize("spec, expected", [
+    (None, [0, 1, 2, 3, 4]),
+    ("  ", [0, 1, 2, 3, 4]),
+    ("1-3", [0, 1, 2]),
+    ("2,4", [1, 3]),
+    ("4-", [3, 4]),
+    ("-2", [0, 1]),
+    ("3,1-2,3", [0, 1, 2]),
+    ("4-10", [3, 4]),
+    ("9", []),
+])
+def test_parse_page_range(spec, expected):
+    assert parse_page_range(spec, 5) == expected
+
+
+@pytest.mark.parametrize("spec", ["0", "3-1", "a", "1-b"])
+def test_parse_page_range_rejects_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_page_range(spec, 5)
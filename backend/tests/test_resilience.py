@@ -0,0 +1,218 @@
+import asyncio
+
+import pytest
+
+from admission import ModelGate
+from fakes import FakeGenaiClient, FakeUpstreamError
+from resilience import (CircuitBreaker, CircuitOpenError, RetryBudget, UpstreamPolicy, is_retryable, primed,
+                        primed_async)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StatusError(Exception):
+    def __init__(self, code):
+        super().__init__(f"{code} error")
+        self.code = code
+
+
+def policy(**kwargs):
+    kwargs.setdefault("sleep", lambda seconds: None)
+    kwargs.setdefault("rand", lambda: 1.0)
+    return UpstreamPolicy("test", **kwargs)
+
+
+@pytest.mark.parametrize("error, expected", [
+    (StatusError(429), True),
+    (StatusError(503), True),
+    (StatusError(400), False),
+    (StatusError(404), False),
+    (ConnectionError("reset"), True),
+    (TimeoutError(), True),
+    (Exception("14 UNAVAILABLE: upstream connect error"), True),
+    (Exception("invalid argument"), False),
+    (CircuitOpenError("test", 1.0), False),
+])
+def test_is_retryable(error, expected):
+    assert is_retryable(error) is expected
+
+
+def test_backoff_is_capped_full_jitter():
+    p = policy(backoff_base=0.5, backoff_max=4.0)
+    assert [p.backoff(n) for n in range(5)] == [0.5, 1.0, 2.0, 4.0, 4.0]
+    assert policy(rand=lambda: 0.0).backoff(3) == 0.0
+
+
+def test_call_retries_transient_errors_with_backoff():
+    sleeps = []
+    client = FakeGenaiClient(fail_calls=[0, 1])
+    p = policy(sleep=sleeps.append)
+    assert p.call(client.models.generate_content, contents="hi") is not None
+    assert client.calls == 3
+    assert sleeps == [0.5, 1.0]
+
+
+def test_call_does_not_retry_client_errors():
+    calls = []
+
+    def bad_request():
+        calls.append(1)
+        raise StatusError(400)
+    with pytest.raises(StatusError):
+        policy().call(bad_request)
+    assert len(calls) == 1
+
+
+def test_call_gives_up_after_max_attempts():
+    client = FakeGenaiClient(failure_rate=1.0)
+    with pytest.raises(FakeUpstreamError):
+        policy(max_attempts=2).call(client.models.generate_content, contents="hi")
+    assert client.calls == 2
+
+
+def test_retry_budget_limits_retries():
+    clock = Clock()
+    budget = RetryBudget(ratio=0.5, min_retries=1, window=10, clock=clock)
+    budget.record_request()
+    budget.record_request()
+    assert budget.try_acquire()
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+    clock.now = 11
+    assert budget.try_acquire()
+
+
+def test_breaker_opens_half_opens_and_closes():
+    clock = Clock()
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30, clock=clock)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as info:
+        breaker.before_call()
+    assert info.value.retry_after == 30
+
+    clock.now = 31
+    assert breaker.before_call() is True  # half-open の試行は 1 件だけ
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.before_call() is False
+
+
+def test_breaker_reopens_when_probe_fails():
+    clock = Clock()
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=5, clock=clock)
+    breaker.record_failure()
+    clock.now = 6
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_interrupted_probe_does_not_leave_breaker_stuck():
+    clock = Clock()
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=5, clock=clock)
+    breaker.record_failure()
+    clock.now = 6
+
+    def interrupted():
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        policy(breaker=breaker).call(interrupted)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert policy(breaker=breaker).call(lambda: "ok") == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_call_short_circuits_while_open():
+    client = FakeGenaiClient(failure_rate=1.0)
+    p = policy(max_attempts=1, breaker=CircuitBreaker("test", failure_threshold=2))
+    for _ in range(2):
+        with pytest.raises(FakeUpstreamError):
+            p.call(client.models.generate_content, contents="hi")
+    with pytest.raises(CircuitOpenError):
+        p.call(client.models.generate_content, contents="hi")
+    assert client.calls == 2
+
+
+def test_stream_retries_before_first_chunk_and_holds_slot():
+    gate = ModelGate("test", limit=1, max_queue=0)
+    client = FakeGenaiClient(fail_calls=[0])
+    stream = primed(policy(gate=gate).stream(client.models.generate_content_stream, contents="hi"))
+    assert client.calls == 2
+    assert gate._active == 1
+    assert len(list(stream)) == 1
+    assert gate._active == 0
+
+
+def test_stream_failure_after_first_chunk_is_not_retried():
+    breaker = CircuitBreaker("test", failure_threshold=1)
+    calls = []
+
+    def broken_stream():
+        calls.append(1)
+        yield "chunk"
+        raise StatusError(503)
+    stream = primed(policy(breaker=breaker).stream(broken_stream))
+    with pytest.raises(StatusError):
+        list(stream)
+    assert len(calls) == 1
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_closing_stream_releases_slot():
+    gate = ModelGate("test", limit=1, max_queue=0)
+    stream = primed(policy(gate=gate).stream(iter, ["a", "b"]))
+    next(stream)
+    stream.close()
+    assert gate._active == 0
+
+
+def test_closing_stream_before_reading_releases_slot():
+    gate = ModelGate("test", limit=1, max_queue=0)
+    inner = policy(gate=gate).stream(iter, ["a", "b"])  # 参照を残して GC による解放に頼らない
+    stream = primed(inner)
+    assert gate._active == 1
+    stream.close()
+    assert gate._active == 0
+
+
+def test_closing_async_stream_before_reading_releases_slot():
+    gate = ModelGate("test", limit=1, max_queue=0)
+    client = FakeGenaiClient()
+
+    async def run():
+        p = UpstreamPolicy("test", gate=gate, backoff_base=0)
+        inner = p.stream_async(client.aio.models.generate_content_stream, contents="hi")
+        stream = await primed_async(inner)
+        assert gate._active == 1
+        await stream.aclose()
+        assert gate._active == 0
+    asyncio.run(run())
+
+
+def test_async_stream_holds_slot_until_iterated():
+    gate = ModelGate("test", limit=1, max_queue=0)
+    client = FakeGenaiClient(fail_calls=[0])
+
+    async def run():
+        p = UpstreamPolicy("test", gate=gate, backoff_base=0)
+        stream = await primed_async(p.stream_async(client.aio.models.generate_content_stream, contents="hi"))
+        assert client.calls == 2
+        assert gate._active == 1
+        return [chunk async for chunk in stream]
+    assert len(asyncio.run(run())) == 1
+    assert gate._active == 0
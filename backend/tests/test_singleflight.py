@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+from singleflight import SingleFlight
+
+
+def _run_concurrently(flight, fn, count=5):
+    results, errors = [], []
+
+    def worker():
+        try:
+            results.append(flight.do("key", fn))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results, errors
+
+
+def test_concurrent_calls_share_result():
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return object()
+    results, errors = _run_concurrently(SingleFlight("test"), slow)
+    assert len(calls) == 1
+    assert not errors
+    assert len(results) == 5 and all(result is results[0] for result in results)
+
+
+def test_concurrent_calls_share_exception():
+    calls = []
+
+    def failing():
+        calls.append(1)
+        time.sleep(0.1)
+        raise ValueError("boom")
+    results, errors = _run_concurrently(SingleFlight("test"), failing)
+    assert len(calls) == 1
+    assert not results
+    assert len(errors) == 5 and all(isinstance(e, ValueError) for e in errors)
+
+
+def test_finished_calls_are_not_remembered():
+    flight = SingleFlight("test")
+    counter = iter(range(10))
+    assert flight.do("key", lambda: next(counter)) == 0
+    assert flight.do("key", lambda: next(counter)) == 1
+
+
+def test_async_calls_share_result_and_exception():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def slow(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        if value == "bad":
+            raise ValueError(value)
+        return value
+
+    async def run():
+        results = await asyncio.gather(*(flight.do_async("a", slow, "ok") for _ in range(3)))
+        errors = await asyncio.gather(*(flight.do_async("b", slow, "bad") for _ in range(3)),
+                                      return_exceptions=True)
+        return results, errors
+    results, errors = asyncio.run(run())
+    assert results == ["ok"] * 3
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert calls == ["ok", "bad"]
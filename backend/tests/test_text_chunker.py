@@ -0,0 +1,40 @@
+from text_chunker import chunk_by_tokens, chunk_sentences, chunk_speaker_turns, estimate_tokens, split_sentences
+
+
+def test_split_sentences_keeps_punctuation():
+    assert split_sentences("今日は晴れ。明日は雨！本当?\n次の行") == ["今日は晴れ。", "明日は雨！", "本当?", "次の行"]
+
+
+def test_estimate_tokens_counts_wide_chars_individually():
+    assert estimate_tokens("日本語") == 3
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("") == 0
+
+
+def test_chunk_sentences_respects_limits():
+    text = "一二三。" * 10
+    chunks = chunk_sentences(text, max_chars=12, first_max_chars=4)
+    assert chunks[0] == "一二三。"
+    assert all(len(chunk) <= 12 for chunk in chunks)
+    assert "".join(chunks) == text
+
+
+def test_chunk_sentences_cuts_long_sentence():
+    chunks = chunk_sentences("あ" * 25, max_chars=10)
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+
+
+def test_chunk_speaker_turns_splits_only_between_turns():
+    dialogue = "話者A: こんにちは\n続きの行\n話者B: どうも\n話者A: " + "長い" * 20
+    chunks = chunk_speaker_turns(dialogue, max_chars=20)
+    assert chunks[0] == "話者A: こんにちは\n続きの行"
+    assert chunks[-1].startswith("話者A: 長い")
+    assert all(chunk.split("\n")[0].startswith("話者") for chunk in chunks)
+
+
+def test_chunk_by_tokens_respects_estimate():
+    text = "\n".join("これは段落です。" * 5 for _ in range(6))
+    chunks = chunk_by_tokens(text, max_tokens=50)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 50 for chunk in chunks)
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
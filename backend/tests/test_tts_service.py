@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from fakes import FakeGenaiClient, FakeGenerativeModel, _text_response
+from jobs import JobCancelled
+import tts_service
+from tts_service import TTSService
+
+TEXT = "\n".join("これは段落です。" * 20 for _ in range(4))
+
+
+class _BlockingModel:
+    """最初の呼び出しを release まで止める要約モデル"""
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def generate_content(self, prompt, **kwargs):
+        self.entered.set()
+        self.release.wait(5)
+        return _text_response("要約")
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    service = TTSService()
+    model = _BlockingModel()
+    monkeypatch.setattr(service, "_summary_model", lambda: model)
+    return service, model
+
+
+def test_cancelling_a_job_does_not_fail_an_identical_summary(service):
+    service, model = service
+
+    def cancelled(progress, message):
+        raise JobCancelled()
+
+    outcome = {}
+
+    def job():
+        try:
+            outcome["job"] = service.summarize_text(TEXT, mode="hierarchical", section_tokens=50,
+                                                    on_progress=cancelled)
+        except JobCancelled:
+            outcome["job"] = "cancelled"
+
+    def request():
+        outcome["request"] = service.summarize_text(TEXT, mode="hierarchical", section_tokens=50)
+
+    job_thread = threading.Thread(target=job)
+    job_thread.start()
+    assert model.entered.wait(5)
+    request_thread = threading.Thread(target=request)
+    request_thread.start()
+    time.sleep(0.1)
+    model.release.set()
+    job_thread.join(5)
+    request_thread.join(5)
+
+    assert outcome["job"] == "cancelled"
+    assert outcome["request"]["success"] is True
+    assert outcome["request"]["summary"] == "要約"
+
+
+@pytest.fixture
+def fake_service(monkeypatch, tmp_path):
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    monkeypatch.setenv("TTS_CACHE_DIR", str(tmp_path / "tts-cache"))
+    service = TTSService(genai_client=FakeGenaiClient())
+    monkeypatch.setattr(service, "_summary_model", lambda: FakeGenerativeModel())
+    return service
+
+
+def _without_timings(result):
+    return {key: value for key, value in result.items() if key != "timings"}
+
+
+def test_sync_and_async_summaries_match(fake_service):
+    sync = fake_service.summarize_text(TEXT, mode="hierarchical", section_tokens=50)
+    async_ = asyncio.run(fake_service.summarize_text_async(TEXT, mode="hierarchical", section_tokens=50))
+    assert sync["success"] is True
+    assert sync["timings"]["sections"] == async_["timings"]["sections"] > 1
+    assert _without_timings(sync) == _without_timings(async_)
+
+
+def test_sync_and_async_chunked_speech_match(fake_service, monkeypatch):
+    monkeypatch.setattr(tts_service, "TTS_CHUNK_MAX_CHARS", 200)
+    sync = fake_service.generate_speech(TEXT, {"voice_name": "Kore"}, chunked=True)
+    # キャッシュを空にして asyncio 版でも合成させる
+    monkeypatch.setattr(fake_service.speech_cache, "get", lambda key: None)
+    calls = fake_service.client.calls
+    async_ = asyncio.run(fake_service.generate_speech_async(TEXT, {"voice_name": "Kore"}, chunked=True))
+    assert fake_service.client.calls - calls > 1
+    assert sync["success"] is True
+    assert sync == async_
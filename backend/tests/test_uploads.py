@@ -0,0 +1,20 @@
+import pytest
+
+from uploads import MemoryBudgetExceeded, Upload, accounting
+
+
+def test_reading_an_in_memory_upload_charges_the_copy():
+    with Upload.from_bytes(b"x" * 1000) as upload:
+        charged = accounting.memory_bytes
+        with upload.open() as f:
+            assert accounting.memory_bytes == charged + 1000
+            assert f.read() == b"x" * 1000
+        assert accounting.memory_bytes == charged
+
+
+def test_reading_an_in_memory_upload_respects_the_budget(monkeypatch):
+    with Upload.from_bytes(b"x" * 1000) as upload:
+        monkeypatch.setattr(accounting, "memory_budget", accounting.memory_bytes + 500)
+        with pytest.raises(MemoryBudgetExceeded):
+            with upload.open():
+                pass
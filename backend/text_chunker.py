@@ -0,0 +1,105 @@
+import re
+from typing import Callable, List, Optional
+
+# 日本語の文末 (。！？ と半角 !?) と改行で区切る。句読点は前の文に残す
+_SENTENCE_RE = re.compile(r"[^。！？!?\n]*(?:[。！？!?]+|\n|$)")
+# 「話者A:」「田中：」「Speaker1:」のような発言の先頭ラベル
+_SPEAKER_LABEL_RE = re.compile(r"^[^\s:：]{1,20}[:：]")
+# トークン数の見積もりで 1 文字 1 トークンと数える文字 (かな・漢字・全角記号など)
+_WIDE_CHAR_RE = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def split_sentences(text: str) -> List[str]:
+    """テキストを文単位に分割 (空の文は除く)"""
+    sentences = []
+    for match in _SENTENCE_RE.finditer(text):
+        sentence = match.group(0).strip()
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の概算 (API を呼ばずに見積もる)
+    日本語などの全角文字は 1 文字 1 トークン、それ以外は 4 文字 1 トークンとして数える
+    """
+    wide = len(_WIDE_CHAR_RE.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _pack(units: List[str], max_chars: int, separator: str,
+          first_max_chars: Optional[int] = None, size: Callable[[str], int] = len) -> List[str]:
+    """
+    単位 (文や発言) を max_chars 以内のチャンクに詰める。単位自体は分割しない
+    first_max_chars を指定すると先頭チャンクだけ上限を小さくできる
+    size で大きさの測り方 (既定は文字数) を変えられる
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    length = 0
+    for unit in units:
+        limit = first_max_chars if first_max_chars and not chunks else max_chars
+        added = size(unit) + (size(separator) if current else 0)
+        if current and length + added > limit:
+            chunks.append(separator.join(current))
+            current, length = [], 0
+            added = size(unit)
+        current.append(unit)
+        length += added
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
+
+
+def chunk_sentences(text: str, max_chars: int, first_max_chars: Optional[int] = None) -> List[str]:
+    """文の境界でテキストを max_chars 以内のチャンクに分割する"""
+    sentences = []
+    for sentence in split_sentences(text):
+        # 句点のない極端に長い文は文字数で切る
+        while len(sentence) > max_chars:
+            sentences.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if sentence:
+            sentences.append(sentence)
+    return _pack(sentences, max_chars, "", first_max_chars)
+
+
+def chunk_speaker_turns(dialogue: str, max_chars: int, first_max_chars: Optional[int] = None) -> List[str]:
+    """
+    「話者X: 発言」形式の会話を発言の境目でだけ分割する
+    1 つの発言が max_chars を超える場合もその発言単独のチャンクにする
+    """
+    turns: List[str] = []
+    for line in dialogue.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        # 話者ラベルで始まらない行は直前の発言の続きとして扱う
+        if turns and not _SPEAKER_LABEL_RE.match(line):
+            turns[-1] += "\n" + line
+        else:
+            turns.append(line)
+    return _pack(turns, max_chars, "\n", first_max_chars)
+
+
+def chunk_by_tokens(text: str, max_tokens: int) -> List[str]:
+    """
+    段落・文の境界でテキストを概算 max_tokens 以内のセクションに分割する (要約の map 段階用)
+    """
+    sentences = []
+    for paragraph in text.split("\n"):
+        paragraph_sentences = []
+        for sentence in split_sentences(paragraph):
+            # 極端に長い文は見積もりトークン数で切る
+            while estimate_tokens(sentence) > max_tokens:
+                cut = max(1, len(sentence) * max_tokens // estimate_tokens(sentence))
+                paragraph_sentences.append(sentence[:cut])
+                sentence = sentence[cut:]
+            if sentence:
+                paragraph_sentences.append(sentence)
+        if paragraph_sentences:
+            # 段落の区切り (改行) は段落最後の文に付けて残す
+            paragraph_sentences[-1] += "\n"
+            sentences.extend(paragraph_sentences)
+    return [chunk.strip() for chunk in _pack(sentences, max_tokens, "", size=estimate_tokens)]
@@ -1,20 +1,72 @@
 import os
 import io
 import base64
+import asyncio
+import json
 import tempfile
-import traceback
+import threading
+import time
 import wave
-from typing import Dict, Any, Optional, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, Callable, Iterator, List, Optional, Union
 from google import genai
 from google.genai import types
 from google.cloud import documentai
 from google.cloud import vision
-import PyPDF2
 import docx
 from pptx import Presentation
 from PIL import Image
 import speech_recognition as sr
 
+from audio_codec import encode_pcm
+from observability import get_logger, record_upstream_error, span
+from resilience import CircuitOpenError, upstream_policy
+from admission import Overloaded
+from jobs import JobCancelled
+from singleflight import SingleFlight
+from cache import LRUCache, DiskCache, TieredCache, make_cache_key
+from pdf_text import extract_pdf_text, parse_page_range, pdf_page_count, split_pdf
+from uploads import MemoryBudgetExceeded, Upload, accounting as upload_accounting
+from text_chunker import chunk_by_tokens, chunk_sentences, chunk_speaker_turns, estimate_tokens
+
+log = get_logger("tts_service")
+
+TTS_MODEL = "gemini-2.5-flash-preview-tts"
+
+# 外部サービスを使わない抽出方法 (ファイル形式 -> 結果の "method")
+EXTRACTORS_BY_TYPE = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': "python-docx",
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation': "python-pptx",
+    'text/plain': "text-decode",
+}
+# 抽出処理を変えたら上げる (古いキャッシュを使わないように)
+EXTRACT_CACHE_VERSION = 1
+# Vision API の batch_annotate_images 1 回あたりの上限 (画像数・画像の合計バイト数)
+VISION_BATCH_SIZE = int(os.getenv("VISION_BATCH_SIZE", "16"))
+VISION_BATCH_MAX_BYTES = int(os.getenv("VISION_BATCH_MAX_BYTES", str(8 * 1024 * 1024)))
+VISION_WORKERS = int(os.getenv("VISION_WORKERS", "4"))
+# Document AI の同期処理 1 回あたりのページ数 (これを超える PDF は分割して並列に処理)
+DOCUMENT_AI_SHARD_PAGES = int(os.getenv("DOCUMENT_AI_SHARD_PAGES", "15"))
+
+# TTS モデルが返す PCM の形式 (24kHz / 16bit / モノラル)
+PCM_SAMPLE_RATE = 24000
+PCM_SAMPLE_WIDTH = 2
+
+# 長文の分割合成: 1 チャンクの最大文字数とチャンク間に挟む無音 (ミリ秒)
+TTS_CHUNK_MAX_CHARS = int(os.getenv("TTS_CHUNK_MAX_CHARS", "1000"))
+TTS_CHUNK_SILENCE_MS = int(os.getenv("TTS_CHUNK_SILENCE_MS", "250"))
+# 分割合成で同時に投げる TTS 呼び出し数の上限
+TTS_CHUNK_WORKERS = int(os.getenv("TTS_CHUNK_WORKERS", "4"))
+# ストリーミング再生用のセグメントの最大文字数 (小さいほど最初の音声が早く届く)
+TTS_STREAM_SEGMENT_CHARS = int(os.getenv("TTS_STREAM_SEGMENT_CHARS", "120"))
+TTS_STREAM_FIRST_SEGMENT_CHARS = int(os.getenv("TTS_STREAM_FIRST_SEGMENT_CHARS", "40"))
+
+SUMMARY_MODEL = "gemini-2.0-flash"
+# 見積もりトークン数がこれを超える文書はセクションに分けて並列に要約する (map-reduce)
+SUMMARY_MAP_REDUCE_THRESHOLD = int(os.getenv("SUMMARY_MAP_REDUCE_THRESHOLD", "12000"))
+SUMMARY_SECTION_TOKENS = int(os.getenv("SUMMARY_SECTION_TOKENS", "6000"))
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "4"))
+
 def wave_file(pcm_data, channels=1, rate=24000, sample_width=2):
     """
     PCMデータをWAVファイル形式に変換
@@ -29,92 +81,280 @@ def wave_file(pcm_data, channels=1, rate=24000, sample_width=2):
     return wav_buffer.getvalue()
 
 class TTSService:
-    def __init__(self):
+    def __init__(self, document_ai_client=None, vision_client=None, genai_client=None):
+        """
+        document_ai_client / vision_client / genai_client: Google Cloud・Gemini のクライアントを
+        差し替える場合に指定 (テスト用の fakes.py など)
+        """
         # Configure Gemini API
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             raise ValueError("GOOGLE_API_KEY environment variable not set.")
         
-        # Initialize Gemini client
-        self.client = genai.Client(api_key=api_key)
+        self.api_key = api_key
         
-        # Initialize Document AI client if available
-        self.document_ai_client = None
-        try:
-            if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-                self.document_ai_client = documentai.DocumentProcessorServiceClient()
-                self.project_id = os.getenv("GOOGLE_CLOUD_PROJECT_ID")
-                self.processor_id = os.getenv("DOCUMENT_AI_PROCESSOR_ID")
-                self.location = os.getenv("DOCUMENT_AI_LOCATION", "us")
-        except Exception as e:
-            print(f"Document AI initialization failed: {e}")
+        # Gemini / Document AI / Vision のクライアントはプロセスごとに最初に使うときに作成する
+        # (gunicorn の --preload で fork する前に接続や gRPC のスレッドを作らない)
+        self._injected_clients = {"document_ai": document_ai_client, "vision": vision_client,
+                                  "gemini": genai_client}
+        self._clients: Dict[str, Any] = {}
+        self._clients_pid: Optional[int] = None
+        self._clients_lock = threading.Lock()
         
-        # Initialize Vision API client if available
-        self.vision_client = None
-        try:
-            if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-                self.vision_client = vision.ImageAnnotatorClient()
-        except Exception as e:
-            print(f"Vision API initialization failed: {e}")
+        self.project_id = os.getenv("GOOGLE_CLOUD_PROJECT_ID")
+        self.processor_id = os.getenv("DOCUMENT_AI_PROCESSOR_ID")
+        self.location = os.getenv("DOCUMENT_AI_LOCATION", "us")
+        # 大きい PDF はページ単位のシャードに分けて並列に処理する
+        self.document_ai_pool = ThreadPoolExecutor(
+            max_workers=int(os.getenv("DOCUMENT_AI_WORKERS", "4")),
+            thread_name_prefix="document-ai",
+        )
+        
+        # 複数ファイルの一括抽出用スレッドプール
+        self.extraction_pool = ThreadPoolExecutor(
+            max_workers=int(os.getenv("EXTRACT_BATCH_WORKERS", "4")),
+            thread_name_prefix="extract",
+        )
+        # 複数画像の OCR はバッチに分けて並列に送る
+        self.vision_pool = ThreadPoolExecutor(
+            max_workers=VISION_WORKERS,
+            thread_name_prefix="vision",
+        )
+        
+        # 長文の分割合成用スレッドプール (同時に投げる TTS 呼び出し数の上限)
+        self.synthesis_pool = ThreadPoolExecutor(
+            max_workers=TTS_CHUNK_WORKERS,
+            thread_name_prefix="tts-chunk",
+        )
+        
+        # 長文要約のセクション並列要約用スレッドプール
+        self.summary_pool = ThreadPoolExecutor(
+            max_workers=SUMMARY_WORKERS,
+            thread_name_prefix="summary",
+        )
+        
+        # テキスト抽出結果のキャッシュ: ファイルの SHA-256 + 形式 + 抽出方法 (+ ページ指定) がキー
+        self.extraction_cache = TieredCache(
+            LRUCache(max_entries=int(os.getenv("EXTRACT_CACHE_SIZE", "128"))),
+            disk=DiskCache(
+                os.getenv("EXTRACT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "image-app", "extract-cache")),
+                max_bytes=int(os.getenv("EXTRACT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+                suffix=".json",
+            ),
+            serialize=lambda result: json.dumps(result, ensure_ascii=False).encode("utf-8"),
+            deserialize=lambda raw: json.loads(raw.decode("utf-8")),
+        )
+        
+        # 音声合成結果 (PCM) のキャッシュ: メモリ LRU + ディスク
+        self.speech_cache = TieredCache(
+            LRUCache(
+                max_entries=int(os.getenv("TTS_CACHE_SIZE", "256")),
+                max_bytes=int(os.getenv("TTS_CACHE_MAX_BYTES", str(128 * 1024 * 1024))),
+            ),
+            disk=DiskCache(
+                os.getenv("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "image-app", "tts-cache")),
+                max_bytes=int(os.getenv("TTS_CACHE_DISK_MAX_BYTES", str(2 * 1024 * 1024 * 1024))),
+            ),
+        )
+        
+        # 同じ内容の音声合成・要約が同時に来たらモデルの呼び出しを 1 回にまとめる
+        self.speech_flight = SingleFlight("speech")
+        self.summary_flight = SingleFlight("summary")
+
+    def _process_client(self, name: str, create: Callable[[], Any]) -> Any:
+        """
+        このプロセスのクライアント (最初に使うときに create で作成し、失敗したら None)
+        fork した子プロセスでは親が作ったクライアントを使わず作り直す
+        """
+        if self._clients_pid != os.getpid():
+            self._clients = {}
+            self._clients_lock = threading.Lock()
+            self._clients_pid = os.getpid()
+        if name not in self._clients:
+            with self._clients_lock:
+                if name not in self._clients:
+                    try:
+                        self._clients[name] = create()
+                    except Exception as e:
+                        log.warning("client initialization failed", client=name, error=e)
+                        self._clients[name] = None
+        return self._clients[name]
+
+    def _google_cloud_client(self, name: str, create: Callable[[], Any]) -> Any:
+        """Document AI / Vision: 差し替え用に渡されたもの、なければ認証情報があるときだけ作成する"""
+        if self._injected_clients[name] is not None:
+            return self._injected_clients[name]
+        if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+            return None
+        return self._process_client(name, create)
+
+    @property
+    def client(self):
+        """Gemini (google-genai) のクライアント"""
+        if self._injected_clients["gemini"] is not None:
+            return self._injected_clients["gemini"]
+        return self._process_client("gemini", lambda: genai.Client(api_key=self.api_key))
+
+    @property
+    def document_ai_client(self):
+        return self._google_cloud_client("document_ai", documentai.DocumentProcessorServiceClient)
+
+    @document_ai_client.setter
+    def document_ai_client(self, client) -> None:
+        self._injected_clients["document_ai"] = client
+
+    @property
+    def vision_client(self):
+        return self._google_cloud_client("vision", vision.ImageAnnotatorClient)
+
+    @vision_client.setter
+    def vision_client(self, client) -> None:
+        self._injected_clients["vision"] = client
+
+    def _extraction_method(self, file_type: str) -> Optional[str]:
+        """そのファイル形式に今の設定で使われる抽出方法 (結果の "method" と同じ名前)"""
+        if file_type == 'application/pdf':
+            if self._document_ai_available():
+                return "Document AI"
+            return "PyPDF2"
+        if file_type in ['image/jpeg', 'image/png']:
+            return "Vision API OCR" if self.vision_client else None
+        return EXTRACTORS_BY_TYPE.get(file_type)
+
+    def _extraction_cache_key(self, file_hash: str, file_type: str, pages: Optional[str]) -> Optional[str]:
+        method = self._extraction_method(file_type)
+        if method is None:
+            return None
+        page_spec = (pages or "").replace(" ", "") if file_type == 'application/pdf' else ""
+        return make_cache_key("extract", EXTRACT_CACHE_VERSION, file_hash, file_type, method, page_spec)
+
+    def lookup_extraction(self, file_hash: str, file_type: str, pages: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """ファイルの SHA-256 から抽出済みの結果を探す (アップロード前の確認用)"""
+        key = self._extraction_cache_key(file_hash.lower(), file_type, pages)
+        if key is None:
+            return None
+        cached = self.extraction_cache.get(key)
+        if cached is None:
+            return None
+        return {**cached, "cached": True, "file_hash": file_hash.lower()}
 
-    def extract_text_from_file(self, file_content: bytes, file_type: str, filename: str) -> Dict[str, Any]:
+    def extract_text_from_file(self, file_content: Union[bytes, Upload], file_type: str, filename: str,
+                               pages: Optional[str] = None) -> Dict[str, Any]:
         """
         ファイルからテキストを抽出します
+        file_content: バイト列、または一時ファイルに受信済みの Upload (メモリに読み込まずに処理する)
+        pages: PDF の抽出対象ページ ("1-3,5" 形式、1 始まり)。未指定なら全ページ
+        同じ内容・同じ抽出方法の結果はキャッシュから返す
         """
+        upload = file_content if isinstance(file_content, Upload) else None
         try:
-            if file_type == 'application/pdf':
-                return self._extract_from_pdf(file_content)
-            elif file_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-                return self._extract_from_docx(file_content)
-            elif file_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
-                return self._extract_from_pptx(file_content)
-            elif file_type == 'text/plain':
-                return self._extract_from_txt(file_content)
-            elif file_type in ['image/jpeg', 'image/png']:
-                return self._extract_from_image(file_content)
-            else:
-                raise ValueError(f"Unsupported file type: {file_type}")
+            if upload is None:
+                upload = Upload.from_bytes(file_content, filename, file_type)
+            file_hash = upload.sha256
+            cached = self.lookup_extraction(file_hash, file_type, pages)
+            if cached is not None:
+                return cached
+            
+            with span("extraction", file_type=file_type, bytes=upload.size) as fields:
+                if file_type == 'application/pdf':
+                    result = self._extract_from_pdf(upload, pages)
+                elif file_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+                    result = self._extract_from_docx(upload)
+                elif file_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
+                    result = self._extract_from_pptx(upload)
+                elif file_type == 'text/plain':
+                    result = self._extract_from_txt(upload)
+                elif file_type in ['image/jpeg', 'image/png']:
+                    result = self._extract_from_image(upload)
+                else:
+                    raise ValueError(f"Unsupported file type: {file_type}")
+                fields["method"] = result.get("method")
+                if not result.get("success"):
+                    fields["outcome"] = "failed"
+            
+            # キーは結果の method で作る (Document AI 失敗時のフォールバック結果などを別の方法として保存しない)
+            key = self._extraction_cache_key(file_hash, file_type, pages)
+            if result.get("success") and key and result.get("method") == self._extraction_method(file_type):
+                self.extraction_cache.set(key, result)
+            return {**result, "cached": False, "file_hash": file_hash}
                 
+        except MemoryBudgetExceeded:
+            raise
         except Exception as e:
-            print(f"Text extraction error: {e}")
-            traceback.print_exc()
+            log.exception("text extraction error", file_type=file_type, filename=filename)
             return {
                 "success": False,
                 "error": f"テキスト抽出に失敗しました: {str(e)}"
             }
+        finally:
+            # バイト列から作った Upload はここで解放する (呼び出し元の Upload は呼び出し元が閉じる)
+            if upload is not None and upload is not file_content:
+                upload.close()
+
+    def _extract_timed(self, index: int, upload: Union[bytes, Upload], file_type: str, filename: str,
+                       submitted: float) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            result = self.extract_text_from_file(upload, file_type, filename)
+        except MemoryBudgetExceeded as e:
+            result = {"success": False, "error": str(e)}
+        finished = time.perf_counter()
+        return {
+            "index": index,
+            "filename": filename,
+            **result,
+            "queued_ms": round((started - submitted) * 1000, 1),
+            "elapsed_ms": round((finished - started) * 1000, 1),
+        }
+
+    def iter_extract_files(self, files) -> Iterator[Dict[str, Any]]:
+        """
+        複数ファイル [(内容 or Upload, 形式, ファイル名), ...] を並列に抽出し、終わった順に結果を返す
+        各結果には入力順の index、待ち時間 queued_ms、処理時間 elapsed_ms が付く
+        """
+        submitted = time.perf_counter()
+        futures = [
+            self.extraction_pool.submit(self._extract_timed, i, content, file_type, filename, submitted)
+            for i, (content, file_type, filename) in enumerate(files)
+        ]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # クライアントが切断した場合は未着手のファイルを取り消す
+            for future in futures:
+                future.cancel()
 
-    def _extract_from_pdf(self, file_content: bytes) -> Dict[str, Any]:
+    def _extract_from_pdf(self, upload: Upload, pages: Optional[str] = None) -> Dict[str, Any]:
         """PDFファイルからテキストを抽出"""
         try:
             # Document AI使用を優先
-            if self.document_ai_client and self.project_id and self.processor_id:
-                return self._extract_with_document_ai(file_content, "application/pdf")
-            
-            # フォールバック: PyPDF2を使用
-            text = ""
-            pdf_file = io.BytesIO(file_content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
+            if self._document_ai_available():
+                return self._extract_with_document_ai(upload, pages)
             
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
+            # フォールバック: PyPDF2を使用 (ページ単位でプロセスプールに分散。一時ファイルはパスで渡す)
+            text, page_count = extract_pdf_text(upload.source(), pages)
             
             return {
                 "success": True,
                 "text": text.strip(),
-                "method": "PyPDF2"
+                "method": "PyPDF2",
+                "pages": page_count
             }
             
+        except MemoryBudgetExceeded:
+            raise
         except Exception as e:
             return {
                 "success": False,
                 "error": f"PDF処理エラー: {str(e)}"
             }
 
-    def _extract_from_docx(self, file_content: bytes) -> Dict[str, Any]:
+    def _extract_from_docx(self, upload: Upload) -> Dict[str, Any]:
         """DOCXファイルからテキストを抽出"""
         try:
-            doc_file = io.BytesIO(file_content)
-            doc = docx.Document(doc_file)
+            with upload.open() as doc_file:
+                doc = docx.Document(doc_file)
             
             text = ""
             for paragraph in doc.paragraphs:
@@ -139,11 +379,11 @@ class TTSService:
                 "error": f"DOCX処理エラー: {str(e)}"
             }
 
-    def _extract_from_pptx(self, file_content: bytes) -> Dict[str, Any]:
+    def _extract_from_pptx(self, upload: Upload) -> Dict[str, Any]:
         """PPTXファイルからテキストを抽出"""
         try:
-            ppt_file = io.BytesIO(file_content)
-            presentation = Presentation(ppt_file)
+            with upload.open() as ppt_file:
+                presentation = Presentation(ppt_file)
             
             text = ""
             for slide in presentation.slides:
@@ -163,9 +403,10 @@ class TTSService:
                 "error": f"PPTX処理エラー: {str(e)}"
             }
 
-    def _extract_from_txt(self, file_content: bytes) -> Dict[str, Any]:
+    def _extract_from_txt(self, upload: Upload) -> Dict[str, Any]:
         """TXTファイルからテキストを抽出"""
         try:
+            file_content = upload.read_bytes()
             # UTF-8でデコードを試行
             try:
                 text = file_content.decode('utf-8')
@@ -182,18 +423,20 @@ class TTSService:
                 "method": "text-decode"
             }
             
+        except MemoryBudgetExceeded:
+            raise
         except Exception as e:
             return {
                 "success": False,
                 "error": f"TXT処理エラー: {str(e)}"
             }
 
-    def _extract_from_image(self, file_content: bytes) -> Dict[str, Any]:
+    def _extract_from_image(self, upload: Upload) -> Dict[str, Any]:
         """画像ファイルからOCRでテキストを抽出"""
         try:
             # Vision API使用を優先
             if self.vision_client:
-                return self._extract_with_vision_api(file_content)
+                return self._extract_with_vision_api(upload.read_bytes())
             
             # フォールバック（基本OCRライブラリがあれば）
             return {
@@ -201,55 +444,108 @@ class TTSService:
                 "error": "OCR機能が利用できません。Google Cloud Vision APIの設定が必要です。"
             }
             
+        except MemoryBudgetExceeded:
+            raise
         except Exception as e:
             return {
                 "success": False,
                 "error": f"画像処理エラー: {str(e)}"
             }
 
-    def _extract_with_document_ai(self, file_content: bytes, mime_type: str) -> Dict[str, Any]:
-        """Google Cloud Document AIを使用してテキストを抽出"""
+    def _document_ai_available(self) -> bool:
+        return bool(self.document_ai_client and self.project_id and self.processor_id)
+
+    def _process_with_document_ai(self, file_content: bytes, mime_type: str) -> str:
+        """Document AI の同期処理 (process_document) を 1 回呼んでテキストを返す"""
+        # Document AI processor name
+        name = f"projects/{self.project_id}/locations/{self.location}/processors/{self.processor_id}"
+        
+        # Raw document
+        raw_document = documentai.RawDocument(content=file_content, mime_type=mime_type)
+        
+        # Process request
+        request = documentai.ProcessRequest(name=name, raw_document=raw_document)
+        with span("document_ai", bytes=len(file_content)):
+            try:
+                result = self.document_ai_client.process_document(request=request)
+            except Exception as e:
+                record_upstream_error("document_ai", e)
+                raise
+        return result.document.text
+
+    def _process_pdf_shard(self, index: int, shard_content: bytes):
+        """シャード 1 つを Document AI で処理する。失敗したらそのシャードだけ PyPDF2 で抽出"""
         try:
-            # Document AI processor name
-            name = f"projects/{self.project_id}/locations/{self.location}/processors/{self.processor_id}"
-            
-            # Raw document
-            raw_document = documentai.RawDocument(content=file_content, mime_type=mime_type)
-            
-            # Process request
-            request = documentai.ProcessRequest(name=name, raw_document=raw_document)
-            result = self.document_ai_client.process_document(request=request)
+            return self._process_with_document_ai(shard_content, "application/pdf"), False
+        except Exception as e:
+            log.warning("Document AI shard failed, falling back to PyPDF2", shard=index, error=e)
+            text, _ = extract_pdf_text(shard_content)
+            return text, True
+
+    def _extract_with_document_ai(self, upload: Upload, pages: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Google Cloud Document AIを使用してテキストを抽出
+        DOCUMENT_AI_SHARD_PAGES ページを超える PDF はシャードに分割して並列に処理し、ページ順に結合する
+        """
+        charged = 0
+        try:
+            source = upload.source()
+            page_numbers = parse_page_range(pages, pdf_page_count(source))
+            if len(page_numbers) <= DOCUMENT_AI_SHARD_PAGES and not pages:
+                shards = [(page_numbers, upload.read_bytes())]
+            else:
+                shards = split_pdf(source, page_numbers, DOCUMENT_AI_SHARD_PAGES)
+                charged = sum(len(content) for _, content in shards)
+                upload_accounting.charge(charged)
             
-            # Extract text
-            text = result.document.text
+            futures = [
+                self.document_ai_pool.submit(self._process_pdf_shard, i, content)
+                for i, (_, content) in enumerate(shards)
+            ]
+            texts = []
+            fallback_shards = []
+            for i, future in enumerate(futures):
+                text, fell_back = future.result()
+                texts.append(text.strip())
+                if fell_back:
+                    fallback_shards.append(i)
             
-            return {
+            result = {
                 "success": True,
-                "text": text.strip(),
-                "method": "Document AI"
+                "text": "\n".join(texts).strip(),
+                "method": "Document AI",
+                "pages": len(page_numbers),
+                "shards": len(shards)
             }
+            if fallback_shards:
+                # 一部を PyPDF2 で抽出した結果は Document AI の結果としてキャッシュしない
+                result["method"] = "Document AI + PyPDF2"
+                result["fallback_shards"] = fallback_shards
+            return result
             
+        except MemoryBudgetExceeded:
+            raise
         except Exception as e:
             return {
                 "success": False,
                 "error": f"Document AI処理エラー: {str(e)}"
             }
+        finally:
+            if charged:
+                upload_accounting.release(charged)
 
     def _extract_with_vision_api(self, file_content: bytes) -> Dict[str, Any]:
         """Google Cloud Vision APIを使用してOCR"""
         try:
-            image = vision.Image(content=file_content)
-            response = self.vision_client.text_detection(image=image)
+            image = self._annotate_batch([file_content])[0]
             
-            if response.error.message:
-                raise Exception(f"Vision API error: {response.error.message}")
+            if image.get("error"):
+                raise Exception(f"Vision API error: {image['error']}")
             
-            texts = response.text_annotations
-            if texts:
-                text = texts[0].description
+            if image["text"]:
                 return {
                     "success": True,
-                    "text": text.strip(),
+                    "text": image["text"],
                     "method": "Vision API OCR"
                 }
             else:
@@ -266,298 +562,833 @@ class TTSService:
                 "error": f"Vision API処理エラー: {str(e)}"
             }
 
-    def summarize_text(self, text: str, speaker_mode: str = "single") -> Dict[str, Any]:
+    def _annotate_batch(self, images) -> list:
+        """batch_annotate_images を 1 回呼び、画像ごとの {"text", "error"} を入力順に返す"""
+        requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+            )
+            for content in images
+        ]
+        with span("vision_ocr", images=len(images)):
+            try:
+                response = self.vision_client.batch_annotate_images(requests=requests)
+            except Exception as e:
+                record_upstream_error("vision", e)
+                raise
+        results = []
+        for image_response in response.responses:
+            if image_response.error.message:
+                results.append({"text": "", "error": image_response.error.message})
+            elif image_response.text_annotations:
+                results.append({"text": image_response.text_annotations[0].description.strip()})
+            else:
+                results.append({"text": ""})
+        return results
+
+    def _plan_vision_batches(self, sizes) -> list:
         """
-        テキストを要約します（話者モードに応じて）
+        画像をバッチに分ける (各バッチは入力順の連続した範囲)
+        上限 (VISION_BATCH_SIZE 枚・VISION_BATCH_MAX_BYTES) を守りつつ、
+        並列数ぶんのバッチに均等に割り振って一番遅いバッチの待ち時間を短くする
         """
+        count = len(sizes)
+        batch_count = max(-(-count // VISION_BATCH_SIZE), min(VISION_WORKERS, count))
+        per_batch = -(-count // batch_count) if count else 0
+        batches = []
+        current: List[int] = []
+        current_bytes = 0
+        for i, size in enumerate(sizes):
+            if current and (len(current) >= per_batch or current_bytes + size > VISION_BATCH_MAX_BYTES):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(i)
+            current_bytes += size
+        if current:
+            batches.append(current)
+        return batches
+
+    def ocr_images(self, images) -> Dict[str, Any]:
+        """
+        複数の画像 (撮影した資料のページなど) をまとめて OCR し、入力順に連結したテキストを返す
+        画像はバッチに分けて batch_annotate_images で並列に送る
+        """
+        if not self.vision_client:
+            return {
+                "success": False,
+                "error": "OCR機能が利用できません。Google Cloud Vision APIの設定が必要です。"
+            }
         try:
-            # テキスト要約用には従来のGenerativeModelを使用
-            import google.generativeai as genai_classic
-            genai_classic.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-            model = genai_classic.GenerativeModel("gemini-2.0-flash")
-            
-            if speaker_mode == "single":
-                # 単一話者用要約
-                prompt = f"""
-                以下の文書の内容を、音声読み上げに適した形で要約してください。
-                
-                要約の条件:
-                1. 重要なポイントを漏らさずに簡潔にまとめる
-                2. 音声で聞いた時に理解しやすい構造にする
-                3. 専門用語は必要に応じて説明を加える
-                4. 自然な日本語で、読み上げに適した文体にする
-                5. 一人の話者が読み上げる形式で要約する
-                6. 要約内容のみを出力し、説明文や前置きは不要
-                7. 「要約します」「以下のような内容です」等の文言は含めない
-                
-                文書内容:
-                {text}
-                """
-            else:
-                # 複数話者用要約（会話形式）
-                prompt = f"""
-                以下の文書の内容を、2人の話者（話者A、話者B）が会話する形式で要約してください。
-                
-                要約の条件:
-                1. 文書の重要なポイントを会話形式で分かりやすく説明
-                2. 話者A と 話者B が交互に話す自然な会話形式
-                3. 専門用語や重要な概念は会話の中で説明
-                4. 各発言は1〜2文程度で簡潔に
-                5. 文書の内容を正確に反映した会話内容
-                6. 音声読み上げに適した自然な日本語
-                
-                出力形式:
-                話者A: [発言内容]
-                話者B: [発言内容]
-                話者A: [発言内容]
-                ...
-                
-                文書内容:
-                {text}
-                """
+            batches = self._plan_vision_batches([len(content) for content in images])
+            futures = [
+                self.vision_pool.submit(self._annotate_batch, [images[i] for i in batch])
+                for batch in batches
+            ]
+            pages = []
+            for batch, future in zip(batches, futures):
+                for i, page in zip(batch, future.result()):
+                    pages.append({"index": i, **page})
             
-            response = model.generate_content(prompt)
+            failed = [page for page in pages if page.get("error")]
+            if failed and len(failed) == len(pages):
+                raise Exception(f"Vision API error: {failed[0]['error']}")
+            
+            return {
+                "success": True,
+                "text": "\n\n".join(page["text"] for page in pages if page["text"]),
+                "method": "Vision API OCR",
+                "images": pages,
+                "batches": len(batches)
+            }
             
-            if (response.candidates and 
-                response.candidates[0].content and 
-                response.candidates[0].content.parts and 
-                response.candidates[0].content.parts[0].text):
-                
-                summary = response.candidates[0].content.parts[0].text.strip()
-                
-                return {
-                    "success": True,
-                    "summary": summary,
-                    "speaker_mode": speaker_mode
-                }
-            else:
-                return {
-                    "success": False,
-                    "error": "要約の生成に失敗しました"
-                }
-                
         except Exception as e:
-            print(f"Summarization error: {e}")
-            traceback.print_exc()
             return {
                 "success": False,
-                "error": f"要約生成エラー: {str(e)}"
+                "error": f"Vision API処理エラー: {str(e)}"
             }
 
-    def generate_speech(self, text: str, voice_settings: Dict[str, Any], 
-                       speaker_mode: str = "single", style: str = "", 
-                       rate: float = 1.0) -> Union[bytes, Dict[str, Any]]:
+    @staticmethod
+    def _summary_prompt(text: str, speaker_mode: str) -> str:
+        """最終的な要約 (reduce 段階) のプロンプト"""
+        if speaker_mode == "single":
+            # 単一話者用要約
+            return f"""
+            以下の文書の内容を、音声読み上げに適した形で要約してください。
+            
+            要約の条件:
+            1. 重要なポイントを漏らさずに簡潔にまとめる
+            2. 音声で聞いた時に理解しやすい構造にする
+            3. 専門用語は必要に応じて説明を加える
+            4. 自然な日本語で、読み上げに適した文体にする
+            5. 一人の話者が読み上げる形式で要約する
+            6. 要約内容のみを出力し、説明文や前置きは不要
+            7. 「要約します」「以下のような内容です」等の文言は含めない
+            
+            文書内容:
+            {text}
+            """
+        # 複数話者用要約（会話形式）
+        return f"""
+            以下の文書の内容を、2人の話者（話者A、話者B）が会話する形式で要約してください。
+            
+            要約の条件:
+            1. 文書の重要なポイントを会話形式で分かりやすく説明
+            2. 話者A と 話者B が交互に話す自然な会話形式
+            3. 専門用語や重要な概念は会話の中で説明
+            4. 各発言は1〜2文程度で簡潔に
+            5. 文書の内容を正確に反映した会話内容
+            6. 音声読み上げに適した自然な日本語
+            
+            出力形式:
+            話者A: [発言内容]
+            話者B: [発言内容]
+            話者A: [発言内容]
+            ...
+            
+            文書内容:
+            {text}
+            """
+
+    @staticmethod
+    def _section_summary_prompt(section: str, index: int, total: int) -> str:
+        """長い文書の一部分を要約する (map 段階) プロンプト"""
+        return f"""
+            以下は長い文書を {total} 個に分けたうちの {index} 番目の部分です。
+            この部分の内容を、後で全体の要約を作るための中間要約としてまとめてください。
+            
+            要約の条件:
+            1. 重要な事実・数値・固有名詞・結論を漏らさない
+            2. 元の順序を保ち、箇条書きではなく文章で書く
+            3. 要約内容のみを出力し、説明文や前置きは不要
+            
+            文書内容:
+            {section}
+            """
+
+    def _summary_model(self):
+        # テキスト要約用には従来のGenerativeModelを使用
+        import google.generativeai as genai_classic
+        genai_classic.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        return genai_classic.GenerativeModel(SUMMARY_MODEL)
+
+    @staticmethod
+    def _summary_call(model, prompt: str, stage: str):
+        """要約モデルを呼ぶ (stage は summary_section / summary_reduce。一時的なエラーは再試行する)"""
+        with span(stage, chars=len(prompt)):
+            return upstream_policy("gemini_summary").call(model.generate_content, prompt)
+
+    @staticmethod
+    def _response_text(response) -> Optional[str]:
+        if (response.candidates and
+            response.candidates[0].content and
+            response.candidates[0].content.parts and
+            response.candidates[0].content.parts[0].text):
+            return response.candidates[0].content.parts[0].text.strip()
+        return None
+
+    def _map_sections(self, model, sections, on_progress: Optional[Callable[[float, str], None]] = None,
+                      progress_range=(0.0, 0.8)):
         """
-        正しいGemini 2.5 TTS APIを使用してテキストから音声を生成します
+        セクションを並列に要約して元の順序で返す
+        1 つでも失敗したら None を返す (残りの呼び出しは取り消す)
         """
+        total = len(sections)
+        start, end = progress_range
+        futures = {
+            self.summary_pool.submit(
+                self._summary_call, model, self._section_summary_prompt(section, i + 1, total), "summary_section"
+            ): i
+            for i, section in enumerate(sections)
+        }
+        summaries = [None] * total
         try:
-            print(f"TTS生成開始: speaker_mode={speaker_mode}, voice_settings={voice_settings}")
-            print(f"テキスト: '{text}', スタイル: '{style}', レート: {rate}")
+            done = 0
+            for future in as_completed(futures):
+                text = self._response_text(future.result())
+                if not text:
+                    return None
+                summaries[futures[future]] = text
+                done += 1
+                if on_progress:
+                    on_progress(start + (end - start) * done / total, f"セクション要約 {done}/{total}")
+        finally:
+            for future in futures:
+                future.cancel()
+        return summaries
+
+    @staticmethod
+    def _summary_key(text: str, speaker_mode: str, mode: str, section_tokens: Optional[int]) -> str:
+        return make_cache_key("summary", text, speaker_mode, mode, section_tokens or SUMMARY_SECTION_TOKENS)
+
+    def summarize_text(self, text: str, speaker_mode: str = "single", mode: str = "auto",
+                       section_tokens: Optional[int] = None,
+                       on_progress: Optional[Callable[[float, str], None]] = None) -> Dict[str, Any]:
+        """
+        テキストを要約します（話者モードに応じて）
+        mode: "direct" は全文を 1 回で要約、"hierarchical" はセクションごとに並列要約してから
+        まとめる (map-reduce)。"auto" は見積もりトークン数が SUMMARY_MAP_REDUCE_THRESHOLD を
+        超えたときだけ hierarchical にする
+        同じ内容の要約が実行中ならその結果を待って返す
+        on_progress を指定した呼び出し (ジョブ) はまとめずに実行する
+        (on_progress が送出する JobCancelled で、同じ要約を待つ他の呼び出しまで失敗させない)
+        """
+        if on_progress:
+            return self._summarize_text(text, speaker_mode, mode, section_tokens, on_progress)
+        return self.summary_flight.do(self._summary_key(text, speaker_mode, mode, section_tokens),
+                                      self._summarize_text, text, speaker_mode, mode, section_tokens, None)
+
+    def _summarize_text(self, text: str, speaker_mode: str, mode: str, section_tokens: Optional[int],
+                        on_progress: Optional[Callable[[float, str], None]]) -> Dict[str, Any]:
+        try:
+            model = self._summary_model()
+
+            def perform(step, arg):
+                if step == "map":
+                    return self._map_sections(model, arg, on_progress)
+                return self._summary_call(model, arg, "summary_reduce")
+
+            return self._run_steps(self._summary_steps(text, speaker_mode, mode, section_tokens, on_progress),
+                                   perform)
+        except JobCancelled:
+            raise
+        except (CircuitOpenError, Overloaded) as e:
+            return self._unavailable_result(e, "要約")
+        except Exception as e:
+            log.exception("summarization error")
+            return {
+                "success": False,
+                "error": f"要約生成エラー: {str(e)}"
+            }
+
+    def _summary_steps(self, text: str, speaker_mode: str, mode: str, section_tokens: Optional[int],
+                       on_progress: Optional[Callable[[float, str], None]] = None):
+        """
+        要約の手順 (map-reduce にするかの判断・分割・各段の計測・結果の組み立て)。同期版と asyncio 版で共有する
+        モデルの呼び出しは yield で呼び出し側 (_run_steps / _run_steps_async) に任せ、結果を受け取る
+            ("map", セクションのリスト) -> セクションごとの要約のリスト (失敗したら None)
+            ("reduce", プロンプト) -> モデルのレスポンス
+        """
+        started = time.perf_counter()
+        timings: Dict[str, Any] = {}
+        section_tokens = section_tokens or SUMMARY_SECTION_TOKENS
+        
+        if mode == "auto":
+            mode = "hierarchical" if estimate_tokens(text) > SUMMARY_MAP_REDUCE_THRESHOLD else "direct"
+        
+        if mode == "hierarchical":
+            stage_start = time.perf_counter()
+            sections = chunk_by_tokens(text, section_tokens)
+            timings["split_ms"] = round((time.perf_counter() - stage_start) * 1000, 1)
+            timings["sections"] = len(sections)
             
-            # 音声生成の設定
-            if speaker_mode == "single":
-                # 単一話者モード
-                voice_name = voice_settings.get('voice', 'Kore')
-                
-                # プロンプトにスタイル指示を含める
-                prompt = text
-                if style:
-                    prompt = f"音声スタイル: {style}\n\n{text}"
-                
-                print(f"単一話者モード: voice={voice_name}, prompt='{prompt}'")
-                
-                try:
-                    response = self.client.models.generate_content(
-                        model="gemini-2.5-flash-preview-tts",
-                        contents=prompt,
-                        config=types.GenerateContentConfig(
-                            response_modalities=["AUDIO"],
-                            speech_config=types.SpeechConfig(
-                                voice_config=types.VoiceConfig(
-                                    prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                        voice_name=voice_name
-                                    )
-                                )
-                            )
+            # map: セクションを並列に要約。まとめた結果がまだ大きければもう一段まとめる
+            stage_start = time.perf_counter()
+            rounds = 0
+            while len(sections) > 1:
+                rounds += 1
+                summaries = yield ("map", sections)
+                if summaries is None:
+                    return {
+                        "success": False,
+                        "error": "セクション要約の生成に失敗しました"
+                    }
+                text = "\n\n".join(summaries)
+                if estimate_tokens(text) <= SUMMARY_MAP_REDUCE_THRESHOLD:
+                    break
+                sections = chunk_by_tokens(text, section_tokens)
+                if len(sections) >= len(summaries):
+                    break  # 要約しても縮まない場合は打ち切って reduce に進む
+            timings["map_ms"] = round((time.perf_counter() - stage_start) * 1000, 1)
+            timings["map_rounds"] = rounds
+            if on_progress:
+                on_progress(0.8, "全体の要約を作成中")
+        
+        # reduce (direct の場合は全文の要約)
+        stage_start = time.perf_counter()
+        response = yield ("reduce", self._summary_prompt(text, speaker_mode))
+        summary = self._response_text(response)
+        timings["reduce_ms"] = round((time.perf_counter() - stage_start) * 1000, 1)
+        timings["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        
+        if summary:
+            return {
+                "success": True,
+                "summary": summary,
+                "speaker_mode": speaker_mode,
+                "mode": mode,
+                "timings": timings
+            }
+        return {
+            "success": False,
+            "error": "要約の生成に失敗しました"
+        }
+
+    @staticmethod
+    def _run_steps(steps, perform: Callable[[str, Any], Any]) -> Any:
+        """
+        手順のジェネレーター (_summary_steps / _speech_steps) を最後まで進めて戻り値を返す
+        yield された (手順, 引数) は perform で実行し、その結果をジェネレーターに送る
+        """
+        try:
+            request = next(steps)
+            while True:
+                request = steps.send(perform(*request))
+        except StopIteration as done:
+            return done.value
+
+    def _build_speech_request(self, text: str, voice_settings: Dict[str, Any],
+                              speaker_mode: str = "single", style: str = ""):
+        """
+        話者モードに応じた TTS プロンプトと GenerateContentConfig を組み立てます
+        """
+        if speaker_mode == "single":
+            # 単一話者モード
+            voice_name = voice_settings.get('voice', 'Kore')
+
+            # プロンプトにスタイル指示を含める
+            prompt = text
+            if style:
+                prompt = f"音声スタイル: {style}\n\n{text}"
+
+            log.debug("single speaker request", voice=voice_name, prompt=prompt)
+
+            config = types.GenerateContentConfig(
+                response_modalities=["AUDIO"],
+                speech_config=types.SpeechConfig(
+                    voice_config=types.VoiceConfig(
+                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                            voice_name=voice_name
                         )
                     )
-                    print(f"単一話者 API応答受信: {type(response)}")
-                except Exception as api_error:
-                    print(f"単一話者 API呼び出しエラー: {api_error}")
-                    # 500エラーの場合は再試行
-                    if "500" in str(api_error) or "INTERNAL" in str(api_error):
-                        print("500エラー検出、3秒後に再試行...")
-                        import time
-                        time.sleep(3)
-                        try:
-                            response = self.client.models.generate_content(
-                                model="gemini-2.5-flash-preview-tts",
-                                contents=prompt,
-                                config=types.GenerateContentConfig(
-                                    response_modalities=["AUDIO"],
-                                    speech_config=types.SpeechConfig(
-                                        voice_config=types.VoiceConfig(
-                                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                                voice_name=voice_name
-                                            )
-                                        )
-                                    )
+                )
+            )
+            return prompt, config
+
+        # 複数話者モード
+        voice_a = voice_settings.get('voiceA', 'Kore')
+        voice_b = voice_settings.get('voiceB', 'Puck')
+
+        # 複数話者用のプロンプト - フォーマットを改善
+        speaker_text = self._format_dialogue(text)
+
+        prompt = f"以下の会話を2人の話者で読み上げてください:\n{speaker_text}"
+        if style:
+            prompt = f"音声スタイル: {style}\n\n{prompt}"
+
+        log.debug("multi speaker request", voice_a=voice_a, voice_b=voice_b, prompt=prompt)
+
+        config = types.GenerateContentConfig(
+            response_modalities=["AUDIO"],
+            speech_config=types.SpeechConfig(
+                multi_speaker_voice_config=types.MultiSpeakerVoiceConfig(
+                    speaker_voice_configs=[
+                        types.SpeakerVoiceConfig(
+                            speaker='話者A',
+                            voice_config=types.VoiceConfig(
+                                prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                                    voice_name=voice_a
                                 )
                             )
-                            print("再試行成功")
-                        except Exception as retry_error:
-                            print(f"再試行も失敗: {retry_error}")
-                            raise retry_error
-                    else:
-                        raise api_error
-                        
-            else:
-                # 複数話者モード
-                voice_a = voice_settings.get('voiceA', 'Kore')
-                voice_b = voice_settings.get('voiceB', 'Puck')
-                
-                # 複数話者用のプロンプト - フォーマットを改善
-                speaker_text = text
-                if not any(keyword in text for keyword in [':', '：', '話者', 'Speaker']):
-                    # 話者指定がない場合は自動的に分割
-                    lines = text.split('\n')
-                    formatted_lines = []
-                    for i, line in enumerate(lines):
-                        if line.strip():
-                            speaker = '話者A' if i % 2 == 0 else '話者B'
-                            formatted_lines.append(f"{speaker}: {line.strip()}")
-                    speaker_text = '\n'.join(formatted_lines)
-                
-                prompt = f"以下の会話を2人の話者で読み上げてください:\n{speaker_text}"
-                if style:
-                    prompt = f"音声スタイル: {style}\n\n{prompt}"
-                
-                print(f"複数話者モード: voiceA={voice_a}, voiceB={voice_b}")
-                print(f"複数話者プロンプト: '{prompt}'")
-                
-                try:
-                    response = self.client.models.generate_content(
-                        model="gemini-2.5-flash-preview-tts",
-                        contents=prompt,
-                        config=types.GenerateContentConfig(
-                            response_modalities=["AUDIO"],
-                            speech_config=types.SpeechConfig(
-                                multi_speaker_voice_config=types.MultiSpeakerVoiceConfig(
-                                    speaker_voice_configs=[
-                                        types.SpeakerVoiceConfig(
-                                            speaker='話者A',
-                                            voice_config=types.VoiceConfig(
-                                                prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                                    voice_name=voice_a
-                                                )
-                                            )
-                                        ),
-                                        types.SpeakerVoiceConfig(
-                                            speaker='話者B',
-                                            voice_config=types.VoiceConfig(
-                                                prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                                    voice_name=voice_b
-                                                )
-                                            )
-                                        )
-                                    ]
+                        ),
+                        types.SpeakerVoiceConfig(
+                            speaker='話者B',
+                            voice_config=types.VoiceConfig(
+                                prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                                    voice_name=voice_b
                                 )
                             )
                         )
-                    )
-                    print(f"複数話者 API応答受信: {type(response)}")
-                except Exception as api_error:
-                    print(f"複数話者 API呼び出しエラー: {api_error}")
-                    raise api_error
-            
-            # 音声データを取得
-            print("レスポンス解析開始...")
-            print(f"レスポンス全体: {response}")
-            
-            if response and hasattr(response, 'candidates') and response.candidates:
-                print(f"candidates数: {len(response.candidates)}")
-                candidate = response.candidates[0]
-                print(f"candidate: {candidate}")
-                
-                if hasattr(candidate, 'content') and candidate.content:
-                    print(f"content: {candidate.content}")
-                    print(f"content parts数: {len(candidate.content.parts) if candidate.content.parts else 0}")
-                    
-                    if candidate.content.parts and len(candidate.content.parts) > 0:
-                        part = candidate.content.parts[0]
-                        print(f"part: {part}")
-                        print(f"part type: {type(part)}")
-                        print(f"part attributes: {dir(part)}")
-                        
-                        if hasattr(part, 'inline_data') and part.inline_data:
-                            print(f"inline_data found: {type(part.inline_data)}")
-                            print(f"inline_data attributes: {dir(part.inline_data)}")
-                            
-                            # PCMデータを取得
-                            pcm_data = part.inline_data.data
-                            print(f"PCMデータサイズ: {len(pcm_data)} bytes")
-                            
-                            # PCMデータをWAVファイル形式に変換
-                            wav_data = wave_file(pcm_data)
-                            print(f"WAVデータサイズ: {len(wav_data)} bytes")
-                            
-                            # base64エンコードして返す
-                            wav_data_b64 = base64.b64encode(wav_data).decode('utf-8')
-                            
-                            return {
-                                "success": True,
-                                "audio_data": wav_data_b64,
-                                "format": "wav"
-                            }
-                        elif hasattr(part, 'text') and part.text:
-                            print(f"テキストレスポンス発見: {part.text}")
-                            print("音声データではなくテキストレスポンスが返されました")
-                        else:
-                            print("inline_data が見つかりません")
-                            print(f"part 内容: {part}")
-                    else:
-                        print("parts が空またはありません")
-                else:
-                    print("content が見つかりません")
-            else:
-                print("candidates が見つかりません")
-            
-            print("音声データの取得に失敗: 期待されるデータ構造が見つかりませんでした")
+                    ]
+                )
+            )
+        )
+        return prompt, config
+
+    @staticmethod
+    def _format_dialogue(text: str) -> str:
+        """話者指定がない会話テキストに、改行ごとに 話者A / 話者B を交互に割り当てます"""
+        if any(keyword in text for keyword in [':', '：', '話者', 'Speaker']):
+            return text
+        # 話者指定がない場合は自動的に分割
+        lines = text.split('\n')
+        formatted_lines = []
+        for i, line in enumerate(lines):
+            if line.strip():
+                speaker = '話者A' if i % 2 == 0 else '話者B'
+                formatted_lines.append(f"{speaker}: {line.strip()}")
+        return '\n'.join(formatted_lines)
+
+    def _call_tts_model(self, prompt: str, config, speaker_mode: str = "single"):
+        """
+        TTS モデルを呼び出します (synthesis として計測。一時的なエラーの再試行とサーキットブレーカーは
+        resilience.upstream_policy("gemini_tts") による)
+        """
+        with span("synthesis", speaker_mode=speaker_mode, chars=len(prompt)):
+            return upstream_policy("gemini_tts").call(
+                self.client.models.generate_content,
+                model=TTS_MODEL,
+                contents=prompt,
+                config=config
+            )
+
+    @staticmethod
+    def _unavailable_result(error: Union[CircuitOpenError, Overloaded], feature: str) -> Dict[str, Any]:
+        """
+        外部 API を呼べなかった場合の結果 (retry_after 秒後に再試行できる)
+        サーキットブレーカーが開いている間は status 503、同時呼び出し数の上限 (admission) を超えたら 429
+        """
+        if isinstance(error, Overloaded):
+            log.warning("upstream overloaded", model=error.scope, reason=error.reason)
+            message, status = f"{feature}サービスが混雑しています。しばらくしてから再度お試しください。", 429
+        else:
+            log.warning("upstream unavailable", service=error.service, retry_after_s=round(error.retry_after, 1))
+            message, status = f"{feature}サービスが一時的に利用できません。しばらくしてから再度お試しください。", 503
+        return {
+            "success": False,
+            "error": message,
+            "retry_after": error.retry_after,
+            "status": status
+        }
+
+    def _extract_pcm(self, response) -> Optional[bytes]:
+        """TTS レスポンスから PCM データを取り出します（見つからなければ None）"""
+        candidate = response.candidates[0] if response and getattr(response, 'candidates', None) else None
+        content = getattr(candidate, 'content', None)
+        if not content or not content.parts:
+            log.warning("TTS response has no content parts", finish_reason=getattr(candidate, 'finish_reason', None))
+            return None
+
+        part = content.parts[0]
+        if getattr(part, 'inline_data', None):
+            pcm_data = part.inline_data.data
+            log.debug("TTS response received", mime_type=part.inline_data.mime_type, bytes=len(pcm_data))
+            return pcm_data
+        if getattr(part, 'text', None):
+            # 音声データではなくテキストレスポンスが返された
+            log.warning("TTS response contains text instead of audio", text=part.text)
+        else:
+            log.warning("TTS response part has no inline_data", part=part)
+        return None
+
+    def _speech_cache_key(self, text: str, voice_settings: Dict[str, Any],
+                          speaker_mode: str, style: str) -> str:
+        """音声合成キャッシュのキー (テキスト・話者モード・音声・スタイルを正規化)"""
+        text = "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").split("\n")).strip()
+        if speaker_mode == "single":
+            voices = (voice_settings.get('voice', 'Kore'),)
+        else:
+            voices = (voice_settings.get('voiceA', 'Kore'), voice_settings.get('voiceB', 'Puck'))
+        return make_cache_key(TTS_MODEL, text, speaker_mode, voices, (style or "").strip())
+
+    def _synthesize_pcm(self, text: str, voice_settings: Dict[str, Any],
+                        speaker_mode: str = "single", style: str = "") -> Optional[bytes]:
+        """
+        テキストを PCM に合成します（キャッシュ済みならモデルを呼ばない）
+        同じ内容の合成が実行中ならその結果を待ちます。レスポンスに音声が含まれない場合は None を返します
+        """
+        cache_key = self._speech_cache_key(text, voice_settings, speaker_mode, style)
+        pcm_data = self._cached_pcm(cache_key)
+        if pcm_data is not None:
+            return pcm_data
+        return self.speech_flight.do(cache_key, self._synthesize_uncached,
+                                     cache_key, text, voice_settings, speaker_mode, style)
+
+    def _synthesize_uncached(self, cache_key: str, text: str, voice_settings: Dict[str, Any],
+                             speaker_mode: str, style: str) -> Optional[bytes]:
+        # 直前まで実行されていた同じ合成の結果がキャッシュに入っていればそれを使う
+        pcm_data = self.speech_cache.get(cache_key)
+        if pcm_data is not None:
+            return pcm_data
+        prompt, config = self._build_speech_request(text, voice_settings, speaker_mode, style)
+        return self._store_pcm(cache_key, self._call_tts_model(prompt, config, speaker_mode))
+
+    def _cached_pcm(self, cache_key: str) -> Optional[bytes]:
+        pcm_data = self.speech_cache.get(cache_key)
+        if pcm_data is not None:
+            log.debug("speech cache hit", bytes=len(pcm_data))
+        return pcm_data
+
+    def _store_pcm(self, cache_key: str, response) -> Optional[bytes]:
+        """レスポンスの PCM を取り出してキャッシュに入れる (音声が無ければ None)"""
+        pcm_data = self._extract_pcm(response)
+        if pcm_data is not None:
+            self.speech_cache.set(cache_key, pcm_data)
+        return pcm_data
+
+    def _split_for_synthesis(self, text: str, speaker_mode: str):
+        """長文を合成用のチャンクに分割します（複数話者は発言の境目でのみ分割）"""
+        if speaker_mode == "single":
+            return chunk_sentences(text, TTS_CHUNK_MAX_CHARS)
+        # 話者の自動割り当ては全文に対して行ってから分割する（チャンクごとの交互割り当てを防ぐ）
+        return chunk_speaker_turns(self._format_dialogue(text), TTS_CHUNK_MAX_CHARS)
+
+    def _synthesize_chunked(self, chunks, voice_settings: Dict[str, Any],
+                            speaker_mode: str = "single", style: str = "",
+                            on_progress: Optional[Callable[[float], None]] = None) -> Optional[bytes]:
+        """
+        チャンクを並列に合成し、短い無音を挟んで順番通りに連結します
+        いずれかのチャンクで音声が得られなければ None を返します
+        """
+        log.info("chunked synthesis", chunks=len(chunks))
+        futures = [
+            self.synthesis_pool.submit(self._synthesize_pcm, chunk, voice_settings, speaker_mode, style)
+            for chunk in chunks
+        ]
+        try:
+            if on_progress:
+                for completed, _ in enumerate(as_completed(futures), 1):
+                    on_progress(completed / len(futures))
+            pcm_parts = [future.result() for future in futures]
+        finally:
+            # 途中で失敗・取り消しされた場合は未着手のチャンクを実行しない
+            for future in futures:
+                future.cancel()
+        return self._stitch(pcm_parts)
+
+    def _stitch(self, pcm_parts) -> Optional[bytes]:
+        """チャンクの PCM を順番通りに連結します (1 つでも音声が得られなかったら None)"""
+        if any(part is None for part in pcm_parts):
+            return None
+        return self.join_pcm(pcm_parts)
+
+    @staticmethod
+    def join_pcm(pcm_parts) -> bytes:
+        """PCM の断片を短い無音を挟んで連結します"""
+        silence = b"\x00" * (PCM_SAMPLE_RATE * PCM_SAMPLE_WIDTH * TTS_CHUNK_SILENCE_MS // 1000)
+        return silence.join(pcm_parts)
+
+    def iter_speech_segments(self, text: str, voice_settings: Dict[str, Any],
+                             speaker_mode: str = "single", style: str = "",
+                             audio_format: str = "wav") -> Iterator[Dict[str, Any]]:
+        """
+        テキストを文（複数話者は発言）単位の短いセグメントに分けて並列に合成し、
+        先頭から順に完成したものを返します。最初のセグメントが揃った時点で再生を始められます。
+        各セグメントには合成時間 (synth_ms) と開始からの経過時間 (elapsed_ms) を含めます。
+        """
+        started = time.monotonic()
+        # 先頭セグメントは 1 文程度に抑えて最初の音声を早く返す
+        if speaker_mode == "single":
+            segments = chunk_sentences(text, TTS_STREAM_SEGMENT_CHARS, TTS_STREAM_FIRST_SEGMENT_CHARS)
+        else:
+            segments = chunk_speaker_turns(self._format_dialogue(text), TTS_STREAM_SEGMENT_CHARS,
+                                           TTS_STREAM_FIRST_SEGMENT_CHARS)
+
+        def synthesize(segment):
+            segment_started = time.monotonic()
+            pcm_data = self._synthesize_pcm(segment, voice_settings, speaker_mode, style)
+            return pcm_data, (time.monotonic() - segment_started) * 1000
+
+        futures = [self.synthesis_pool.submit(synthesize, segment) for segment in segments]
+        try:
+            for index, future in enumerate(futures):
+                try:
+                    pcm_data, synth_ms = future.result()
+                except (CircuitOpenError, Overloaded) as e:
+                    yield {"index": index, **self._unavailable_result(e, "音声合成")}
+                    return
+                except Exception as e:
+                    log.exception("segment synthesis error", index=index)
+                    yield {"success": False, "index": index, "error": f"音声生成エラー: {str(e)}"}
+                    return
+                if pcm_data is None:
+                    yield {"success": False, "index": index,
+                           "error": "音声データの生成に失敗しました - レスポンス構造が不正です"}
+                    return
+                audio_data = self._encode_audio(pcm_data, audio_format)
+                yield {
+                    "success": True,
+                    "index": index,
+                    "total": len(segments),
+                    "text": segments[index],
+                    "pcm": pcm_data,
+                    "audio_data": base64.b64encode(audio_data).decode('utf-8'),
+                    "format": audio_format,
+                    "synth_ms": round(synth_ms, 1),
+                    "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+                }
+        finally:
+            # クライアントが切断した場合などは未着手のセグメントを取り消す
+            for future in futures:
+                future.cancel()
+
+    def _encode_audio(self, pcm_data: bytes, audio_format: str) -> bytes:
+        """PCM データを指定形式 (wav / flac / opus / mp3) の音声ファイルに変換します"""
+        with span("encoding", format=audio_format, pcm_bytes=len(pcm_data)):
+            if audio_format == "wav":
+                # PCMデータをWAVファイル形式に変換
+                return wave_file(pcm_data)
+            return encode_pcm(pcm_data, audio_format)
+
+    def generate_speech(self, text: str, voice_settings: Dict[str, Any], 
+                       speaker_mode: str = "single", style: str = "", 
+                       rate: float = 1.0, output: str = "base64",
+                       audio_format: str = "wav", chunked: Optional[bool] = None,
+                       on_progress: Optional[Callable[[float], None]] = None) -> Union[bytes, Dict[str, Any]]:
+        """
+        正しいGemini 2.5 TTS APIを使用してテキストから音声を生成します
+        output="bytes" の場合は audio_data を base64 ではなくバイト列で返します
+        chunked=None の場合、TTS_CHUNK_MAX_CHARS を超えるテキストは文単位に分割して並列合成します
+        on_progress には分割合成の進捗 (0.0〜1.0) が通知されます
+        """
+        def perform(step, arg):
+            if step == "chunks":
+                return self._synthesize_chunked(arg, voice_settings, speaker_mode, style, on_progress)
+            if step == "text":
+                return self._synthesize_pcm(arg, voice_settings, speaker_mode, style)
+            return self._encode_audio(arg, audio_format)
+
+        try:
+            return self._run_steps(self._speech_steps(text, voice_settings, speaker_mode, style, rate,
+                                                      output, audio_format, chunked), perform)
+        except (CircuitOpenError, Overloaded) as e:
+            return self._unavailable_result(e, "音声合成")
+        except Exception as e:
+            log.exception("speech generation error")
             return {
                 "success": False,
-                "error": "音声データの生成に失敗しました - レスポンス構造が不正です"
+                "error": f"音声生成エラー: {str(e)}"
             }
-                
-        except Exception as e:
-            print(f"Speech generation error: {e}")
-            traceback.print_exc()
+
+    def _speech_steps(self, text: str, voice_settings: Dict[str, Any], speaker_mode: str, style: str,
+                      rate: float, output: str, audio_format: str, chunked: Optional[bool]):
+        """
+        音声生成の手順 (分割するかの判断・結果の組み立て)。同期版と asyncio 版で共有する
+        合成とエンコードは yield で呼び出し側 (_run_steps / _run_steps_async) に任せ、結果を受け取る
+            ("chunks", チャンクのリスト) / ("text", テキスト) -> PCM (音声が得られなければ None)
+            ("encode", PCM) -> audio_format の音声ファイル
+        """
+        log.info("speech generation", speaker_mode=speaker_mode, voice_settings=voice_settings,
+                 chars=len(text), style=style, rate=rate)
+        log.debug("speech text", text=text)
+        
+        # 音声データを取得
+        chunks = self._speech_chunks(text, speaker_mode, chunked)
+        pcm_data = yield ("chunks", chunks) if len(chunks) > 1 else ("text", text)
+        if pcm_data is None:
             return {
                 "success": False,
-                "error": f"音声生成エラー: {str(e)}"
+                "error": "音声データの生成に失敗しました - レスポンス構造が不正です"
             }
+        
+        audio_data = yield ("encode", pcm_data)
+        return self._speech_result(audio_data, audio_format, output)
+
+    def _speech_chunks(self, text: str, speaker_mode: str, chunked: Optional[bool]) -> List[str]:
+        """chunked が None のときは TTS_CHUNK_MAX_CHARS を超える場合だけ分割する"""
+        if chunked or (chunked is None and len(text) > TTS_CHUNK_MAX_CHARS):
+            return self._split_for_synthesis(text, speaker_mode)
+        return [text]
+
+    @staticmethod
+    def _speech_result(audio_data: bytes, audio_format: str, output: str) -> Dict[str, Any]:
+        """output="bytes" 以外は base64 エンコードして返す"""
+        log.debug("speech encoded", format=audio_format, bytes=len(audio_data))
+        if output != "bytes":
+            audio_data = base64.b64encode(audio_data).decode('utf-8')
+        return {
+            "success": True,
+            "audio_data": audio_data,
+            "format": audio_format
+        }
 
     def preview_voice(self, voice: str, text: str = "こんにちは。これは音声のプレビューです。", 
-                     style: str = "", rate: float = 1.0) -> Union[bytes, Dict[str, Any]]:
+                     style: str = "", rate: float = 1.0, output: str = "base64",
+                     audio_format: str = "wav") -> Union[bytes, Dict[str, Any]]:
         """
         音声のプレビューを生成します
         """
         try:
             # プレビュー用のテキストで音声生成
             voice_settings = {'voice': voice}
-            result = self.generate_speech(text, voice_settings, "single", style, rate)
+            result = self.generate_speech(text, voice_settings, "single", style, rate,
+                                          output=output, audio_format=audio_format)
             
             if result.get("success"):
                 return {
                     "success": True,
                     "audio_data": result["audio_data"],
-                    "format": "wav"
+                    "format": result["format"]
                 }
             else:
                 return result
             
         except Exception as e:
-            print(f"Voice preview error: {e}")
+            log.exception("voice preview error")
             return {
                 "success": False,
                 "error": f"音声プレビューエラー: {str(e)}"
-            } 
\ No newline at end of file
+            } 
+
+    # --- asyncio 版 (asgi.py から使う) ---
+    # google-genai の非同期クライアント (self.client.aio) で呼び出し、待ち時間中にスレッドを占有しない
+
+    async def _call_tts_model_async(self, prompt: str, config, speaker_mode: str = "single"):
+        with span("synthesis", speaker_mode=speaker_mode, chars=len(prompt)):
+            return await upstream_policy("gemini_tts").call_async(
+                self.client.aio.models.generate_content,
+                model=TTS_MODEL,
+                contents=prompt,
+                config=config
+            )
+
+    async def _synthesize_pcm_async(self, text: str, voice_settings: Dict[str, Any],
+                                    speaker_mode: str = "single", style: str = "") -> Optional[bytes]:
+        cache_key = self._speech_cache_key(text, voice_settings, speaker_mode, style)
+        pcm_data = self._cached_pcm(cache_key)
+        if pcm_data is not None:
+            return pcm_data
+        return await self.speech_flight.do_async(cache_key, self._synthesize_uncached_async,
+                                                 cache_key, text, voice_settings, speaker_mode, style)
+
+    async def _synthesize_uncached_async(self, cache_key: str, text: str, voice_settings: Dict[str, Any],
+                                         speaker_mode: str, style: str) -> Optional[bytes]:
+        pcm_data = self.speech_cache.get(cache_key)
+        if pcm_data is not None:
+            return pcm_data
+        prompt, config = self._build_speech_request(text, voice_settings, speaker_mode, style)
+        return self._store_pcm(cache_key, await self._call_tts_model_async(prompt, config, speaker_mode))
+
+    async def _synthesize_chunked_async(self, chunks, voice_settings: Dict[str, Any],
+                                        speaker_mode: str = "single", style: str = "") -> Optional[bytes]:
+        """チャンクを TTS_CHUNK_WORKERS 件ずつ並行に合成して順番通りに連結する"""
+        log.info("chunked synthesis", chunks=len(chunks))
+        semaphore = asyncio.Semaphore(TTS_CHUNK_WORKERS)
+
+        async def synthesize(chunk):
+            async with semaphore:
+                return await self._synthesize_pcm_async(chunk, voice_settings, speaker_mode, style)
+
+        tasks = [asyncio.ensure_future(synthesize(chunk)) for chunk in chunks]
+        try:
+            pcm_parts = await asyncio.gather(*tasks)
+        finally:
+            # 1 つでも失敗したら残りの呼び出しを取り消す
+            for task in tasks:
+                task.cancel()
+        return self._stitch(pcm_parts)
+
+    async def generate_speech_async(self, text: str, voice_settings: Dict[str, Any],
+                                    speaker_mode: str = "single", style: str = "",
+                                    rate: float = 1.0, output: str = "base64",
+                                    audio_format: str = "wav", chunked: Optional[bool] = None) -> Dict[str, Any]:
+        """generate_speech の asyncio 版 (圧縮形式へのエンコードはスレッドで行う)"""
+        async def perform(step, arg):
+            if step == "chunks":
+                return await self._synthesize_chunked_async(arg, voice_settings, speaker_mode, style)
+            if step == "text":
+                return await self._synthesize_pcm_async(arg, voice_settings, speaker_mode, style)
+            return await asyncio.to_thread(self._encode_audio, arg, audio_format)
+
+        try:
+            return await self._run_steps_async(self._speech_steps(text, voice_settings, speaker_mode, style, rate,
+                                                                  output, audio_format, chunked), perform)
+        except (CircuitOpenError, Overloaded) as e:
+            return self._unavailable_result(e, "音声合成")
+        except Exception as e:
+            log.exception("speech generation error")
+            return {
+                "success": False,
+                "error": f"音声生成エラー: {str(e)}"
+            }
+
+    @staticmethod
+    async def _run_steps_async(steps, perform) -> Any:
+        """_run_steps の asyncio 版 (perform はコルーチン関数)"""
+        try:
+            request = next(steps)
+            while True:
+                request = steps.send(await perform(*request))
+        except StopIteration as done:
+            return done.value
+
+    async def _summary_call_async(self, prompt: str, stage: str):
+        with span(stage, chars=len(prompt)):
+            return await upstream_policy("gemini_summary").call_async(
+                self.client.aio.models.generate_content, model=SUMMARY_MODEL, contents=prompt)
+
+    async def _map_sections_async(self, sections) -> Optional[List[str]]:
+        """セクションを SUMMARY_WORKERS 件ずつ並行に要約して元の順序で返す (1 つでも失敗したら None)"""
+        total = len(sections)
+        semaphore = asyncio.Semaphore(SUMMARY_WORKERS)
+
+        async def summarize(index, section):
+            async with semaphore:
+                prompt = self._section_summary_prompt(section, index + 1, total)
+                return self._response_text(await self._summary_call_async(prompt, "summary_section"))
+
+        tasks = [asyncio.ensure_future(summarize(i, section)) for i, section in enumerate(sections)]
+        try:
+            summaries = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if not all(summaries):
+            return None
+        return list(summaries)
+
+    async def summarize_text_async(self, text: str, speaker_mode: str = "single", mode: str = "auto",
+                                   section_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """summarize_text の asyncio 版 (モデルの呼び出しは google-genai の非同期クライアント)"""
+        return await self.summary_flight.do_async(self._summary_key(text, speaker_mode, mode, section_tokens),
+                                                  self._summarize_text_async, text, speaker_mode, mode,
+                                                  section_tokens)
+
+    async def _summarize_text_async(self, text: str, speaker_mode: str, mode: str,
+                                    section_tokens: Optional[int]) -> Dict[str, Any]:
+        async def perform(step, arg):
+            if step == "map":
+                return await self._map_sections_async(arg)
+            return await self._summary_call_async(arg, "summary_reduce")
+
+        try:
+            return await self._run_steps_async(self._summary_steps(text, speaker_mode, mode, section_tokens),
+                                               perform)
+        except (CircuitOpenError, Overloaded) as e:
+            return self._unavailable_result(e, "要約")
+        except Exception as e:
+            log.exception("summarization error")
+            return {
+                "success": False,
+                "error": f"要約生成エラー: {str(e)}"
+            }
@@ -0,0 +1,176 @@
+import io
+import os
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Union
+
+from flask import Request
+
+# アップロードの合計サイズ上限 (超えると 413)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# これ以下のアップロードはメモリに置き、超えるものは一時ファイルに書き出す
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(64 * 1024)))
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR") or None
+# 同時に処理中のアップロードがメモリ上に持てる合計バイト数
+UPLOAD_MEMORY_BUDGET = int(os.getenv("UPLOAD_MEMORY_BUDGET", str(256 * 1024 * 1024)))
+
+_READ_CHUNK = 1024 * 1024
+
+
+class MemoryBudgetExceeded(Exception):
+    """処理中のアップロードのメモリ使用量が上限を超える"""
+
+
+class UploadAccounting:
+    """処理中のアップロードのメモリ・ディスク使用量を数える (プロセス全体)"""
+
+    def __init__(self, memory_budget: int):
+        self.memory_budget = memory_budget
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.disk_bytes = 0
+        self.memory_bytes = 0
+        self.peak_memory_bytes = 0
+        self.rejected = 0
+
+    def charge(self, nbytes: int) -> None:
+        with self._lock:
+            if self.memory_bytes + nbytes > self.memory_budget:
+                self.rejected += 1
+                raise MemoryBudgetExceeded("処理中のファイルが多すぎます。しばらくしてから再度お試しください")
+            self.memory_bytes += nbytes
+            self.peak_memory_bytes = max(self.peak_memory_bytes, self.memory_bytes)
+
+    def release(self, nbytes: int) -> None:
+        with self._lock:
+            self.memory_bytes -= nbytes
+
+    def opened(self, disk_bytes: int) -> None:
+        with self._lock:
+            self.in_flight += 1
+            self.disk_bytes += disk_bytes
+
+    def closed(self, disk_bytes: int) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.disk_bytes -= disk_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "disk_bytes": self.disk_bytes,
+                "memory_bytes": self.memory_bytes,
+                "peak_memory_bytes": self.peak_memory_bytes,
+                "memory_budget": self.memory_budget,
+                "rejected": self.rejected,
+            }
+
+
+accounting = UploadAccounting(UPLOAD_MEMORY_BUDGET)
+
+
+class SpoolingRequest(Request):
+    """
+    multipart のファイルを最初から名前付き一時ファイルに受信する Request
+    (Werkzeug 既定の 500KB までメモリに置く動作を UPLOAD_SPOOL_BYTES に変え、
+    ファイルパスで抽出処理やワーカープロセスに渡せるようにする)
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_BYTES:
+            return io.BytesIO()
+        return tempfile.NamedTemporaryFile("w+b", prefix="upload-", dir=UPLOAD_TMP_DIR)
+
+
+class Upload:
+    """
+    アップロードされたファイル 1 件
+    大きいものは一時ファイル上に置いたままファイルオブジェクトかパスで抽出処理に渡し、
+    バイト列が必要な処理 (外部 API への送信) だけがメモリにコピーする
+    コピーした量は accounting に計上され、close() で解放される
+    """
+
+    def __init__(self, stream: BinaryIO, filename: str = "", content_type: str = ""):
+        self.stream = stream
+        self.filename = filename
+        self.content_type = content_type
+        stream.seek(0, io.SEEK_END)
+        self.size = stream.tell()
+        stream.seek(0)
+        self._sha256: Optional[str] = None
+        self._charged = 0
+        self._disk = self.path is not None
+        if not self._disk:
+            self._charge(self.size)  # メモリ上のアップロードはそのまま計上
+        accounting.opened(self.size if self._disk else 0)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, filename: str = "", content_type: str = "") -> "Upload":
+        return cls(io.BytesIO(data), filename, content_type)
+
+    @classmethod
+    def from_file_storage(cls, file_storage) -> "Upload":
+        return cls(file_storage.stream, file_storage.filename or "", file_storage.content_type or "")
+
+    @property
+    def path(self) -> Optional[str]:
+        """一時ファイルのパス (メモリ上のアップロードなら None)"""
+        name = getattr(self.stream, "name", None)
+        return name if isinstance(name, str) and os.path.isfile(name) else None
+
+    @property
+    def sha256(self) -> str:
+        if self._sha256 is None:
+            digest = hashlib.sha256()
+            with self.open() as f:
+                for chunk in iter(lambda: f.read(_READ_CHUNK), b""):
+                    digest.update(chunk)
+            self._sha256 = digest.hexdigest()
+        return self._sha256
+
+    @contextmanager
+    def open(self) -> Iterator[BinaryIO]:
+        """読み取り専用のファイルオブジェクト (呼び出しごとに独立した読み取り位置)"""
+        if self._disk:
+            with open(self.path, "rb") as f:
+                yield f
+        else:
+            # メモリ上のアップロードは読み取り用のコピーを作るため、閉じるまでその分も計上する
+            accounting.charge(self.size)
+            try:
+                yield io.BytesIO(self.stream.getvalue())
+            finally:
+                accounting.release(self.size)
+
+    def read_bytes(self) -> bytes:
+        """内容をバイト列で返す (API に送る場合など)。一時ファイル上のものはコピー分を計上する"""
+        if not self._disk:
+            return self.stream.getvalue()
+        self._charge(self.size)
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def source(self) -> Union[str, bytes]:
+        """ワーカープロセスに渡す形: 一時ファイルならパス、メモリ上ならバイト列"""
+        return self.path or self.stream.getvalue()
+
+    def _charge(self, nbytes: int) -> None:
+        accounting.charge(nbytes)
+        self._charged += nbytes
+
+    def close(self) -> None:
+        if self._charged:
+            accounting.release(self._charged)
+            self._charged = 0
+        if self.stream is not None:
+            accounting.closed(self.size if self._disk else 0)
+            self.stream = None
+
+    def __enter__(self) -> "Upload":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,283 @@
+"""
+負荷をかけてスループットとレイテンシ (p50 / p95 / p99) を測り、結果を JSON で出力する
+
+    # 偽のクライアントを使うサーバーをこのプロセス内で起動して全シナリオを実行
+    python bench/loadgen.py --concurrency 16 --requests 200 --output results.json
+
+    # asyncio の経路 (backend/asgi.py) を uvicorn でプロセス内に起動して実行
+    python bench/loadgen.py --asgi --scenario generate summarize tts --concurrency 200
+
+    # 起動済みのサーバーに対して実行し、前回の結果と比較 (悪化していれば終了コード 1)
+    python bench/loadgen.py --url http://127.0.0.1:5001 --scenario generate tts --baseline results.json
+
+リクエストの内容は毎回変える (プロンプト・テキスト・文書に連番を埋め込む)。キャッシュに当たる場合を
+測るときは --repeat を付ける
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import argparse
+import platform
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from samples import SAMPLES, sample_text  # noqa: E402
+
+# リクエスト: (パス, ボディ, Content-Type)
+RequestSpec = Tuple[str, bytes, str]
+
+
+def _json_request(path: str, payload: Dict[str, Any]) -> RequestSpec:
+    return path, json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json"
+
+
+def _multipart_request(path: str, field: str, filename: str, content: bytes, content_type: str) -> RequestSpec:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8") + content + f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return path, body, f"multipart/form-data; boundary={boundary}"
+
+
+def generate_request(n: int) -> RequestSpec:
+    return _json_request("/generate", {"prompt": f"夕焼けの海辺を歩く猫の絵 ({n})"})
+
+
+def summarize_request(n: int) -> RequestSpec:
+    return _json_request("/api/tts/summarize", {"text": sample_text(n, paragraphs=40), "speaker_mode": "single"})
+
+
+def tts_request(n: int) -> RequestSpec:
+    return _json_request("/api/tts/generate", {
+        "text": f"こんにちは。これは音声合成のベンチマークです。番号は {n} です。",
+        "voice_settings": {"voice": "Kore"},
+        "speaker_mode": "single",
+    })
+
+
+def _extract_builder(kind: str) -> Callable[[int], RequestSpec]:
+    builder, filename, content_type = SAMPLES[kind]
+    return lambda n: _multipart_request("/api/tts/extract-text", "file", filename, builder(n), content_type)
+
+
+SCENARIOS: Dict[str, Callable[[int], RequestSpec]] = {
+    "generate": generate_request,
+    "summarize": summarize_request,
+    "tts": tts_request,
+    **{f"extract-{kind}": _extract_builder(kind) for kind in SAMPLES},
+}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近順位法 (nearest-rank) のパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _send(base_url: str, spec: RequestSpec, timeout: float) -> Tuple[int, bool]:
+    """(ステータスコード, 成功したか)。JSON で success: false が返った場合も失敗とする"""
+    path, body, content_type = spec
+    request = urllib.request.Request(base_url + path, data=body, method="POST",
+                                     headers={"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = response.read()
+            status = response.status
+            if response.headers.get_content_type() == "application/json":
+                return status, json.loads(data).get("success", True) is not False
+            return status, True
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, False
+    except OSError:
+        return 0, False
+
+
+def run_scenario(base_url: str, name: str, concurrency: int, total: int, warmup: int,
+                 repeat: bool = False, timeout: float = 120.0) -> Dict[str, Any]:
+    build = SCENARIOS[name]
+    # リクエストの組み立て (文書の作成など) は計測の前に済ませる
+    specs = [build(0 if repeat else n) for n in range(warmup + total)]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda spec: _send(base_url, spec, timeout), specs[:warmup]))
+
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(spec: RequestSpec) -> None:
+        nonlocal errors
+        started = time.perf_counter()
+        status, ok = _send(base_url, spec, timeout)
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, specs[warmup:]))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "status": statuses,
+        "duration_s": round(duration, 3),
+        "rps": round(total / duration, 2) if duration else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "max": round(latencies[-1], 1) if latencies else 0.0,
+        },
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """前回の結果より p95 が tolerance 以上遅い、またはスループットが tolerance 以上低いシナリオを返す"""
+    previous = {scenario["scenario"]: scenario for scenario in baseline.get("scenarios", [])}
+    regressions = []
+    for scenario in results["scenarios"]:
+        base = previous.get(scenario["scenario"])
+        if base is None:
+            continue
+        if scenario["latency_ms"]["p95"] > base["latency_ms"]["p95"] * (1 + tolerance):
+            regressions.append(f"{scenario['scenario']}: p95 {base['latency_ms']['p95']}ms -> "
+                               f"{scenario['latency_ms']['p95']}ms")
+        if scenario["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{scenario['scenario']}: rps {base['rps']} -> {scenario['rps']}")
+        if scenario["errors"] > base["errors"]:
+            regressions.append(f"{scenario['scenario']}: errors {base['errors']} -> {scenario['errors']}")
+    return regressions
+
+
+class _UvicornServer:
+    """uvicorn をスレッドで動かす (停止は werkzeug のサーバーと同じく shutdown)"""
+
+    def __init__(self, app: Any):
+        import socket
+        import uvicorn
+
+        self.socket = socket.socket()
+        self.socket.bind(("127.0.0.1", 0))
+        self.server_port = self.socket.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, kwargs={"sockets": [self.socket]}, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def shutdown(self) -> None:
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def _start_local_server(asgi: bool = False) -> Tuple[str, Any]:
+    """偽のクライアントを使うサーバーをこのプロセス内のスレッドで起動する"""
+    import logging
+    from werkzeug.serving import make_server
+    from serve import create_bench_app
+
+    if asgi:
+        server = _UvicornServer(create_bench_app(asgi=True))
+        return f"http://127.0.0.1:{server.server_port}", server
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # リクエストごとのアクセスログを出さない
+    server = make_server("127.0.0.1", 0, create_bench_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="app の負荷試験 (p50 / p95 / p99 とスループット)")
+    parser.add_argument("--url", help="対象サーバー (省略時は偽のクライアントを使うサーバーをプロセス内で起動)")
+    parser.add_argument("--asgi", action="store_true", help="プロセス内のサーバーを asyncio の経路 (uvicorn) で起動する")
+    parser.add_argument("--scenario", nargs="+", default=["all"],
+                        help=f"実行するシナリオ: all / extract / {' / '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="シナリオごとのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=5, help="計測前に送るリクエスト数")
+    parser.add_argument("--repeat", action="store_true", help="毎回同じ内容を送る (キャッシュに当たる場合の計測)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--label", default="", help="結果に記録する名前 (サーバーの起動方法など)")
+    parser.add_argument("--output", help="結果の JSON の出力先 (省略時は標準出力)")
+    parser.add_argument("--baseline", help="比較する前回の結果の JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="悪化とみなす割合 (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    names: List[str] = []
+    for name in args.scenario:
+        if name == "all":
+            names.extend(SCENARIOS)
+        elif name == "extract":
+            names.extend(n for n in SCENARIOS if n.startswith("extract-"))
+        elif name in SCENARIOS:
+            names.append(name)
+        else:
+            parser.error(f"unknown scenario: {name}")
+
+    server = None
+    base_url = args.url.rstrip("/") if args.url else None
+    if base_url is None:
+        base_url, server = _start_local_server(args.asgi)
+
+    results: Dict[str, Any] = {
+        "label": args.label,
+        "target": args.url or f"in-process (bench/serve.py{' --asgi' if args.asgi else ''})",
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "scenarios": [],
+    }
+    if server is not None:
+        from serve import latency_config
+        results["fake_latency_s"] = latency_config()
+    try:
+        for name in dict.fromkeys(names):
+            scenario = run_scenario(base_url, name, args.concurrency, args.requests, args.warmup,
+                                    args.repeat, args.timeout)
+            results["scenarios"].append(scenario)
+            print(f"{name}: {scenario['rps']} req/s, p50={scenario['latency_ms']['p50']}ms "
+                  f"p95={scenario['latency_ms']['p95']}ms p99={scenario['latency_ms']['p99']}ms "
+                  f"errors={scenario['errors']}", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+ベンチマーク用のサンプル文書 (抽出処理の対応形式すべて)
+内容に variant を埋め込み、リクエストごとに異なるファイルを作れるようにする (抽出キャッシュに当てない)
+
+    python bench/samples.py OUTPUT_DIR    # 各形式のサンプルをファイルに書き出す
+"""
+import io
+import os
+import sys
+from typing import Callable, Dict, Tuple
+
+import docx
+from pptx import Presentation
+from pptx.util import Inches
+from PIL import Image, ImageDraw
+
+PARAGRAPH = ("音声合成のベンチマーク用の文章です。文書からテキストを抽出し、要約してから読み上げます。"
+             "長い文書はセクションに分けて処理されます。")
+
+
+def sample_text(variant: int, paragraphs: int = 8) -> str:
+    return "\n\n".join(f"第{i + 1}段落 ({variant}) {PARAGRAPH}" for i in range(paragraphs))
+
+
+def make_pdf(variant: int, pages: int = 20) -> bytes:
+    """1 ページ 1 行のテキストを持つ PDF (標準フォントのため ASCII のみ)"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>")
+    font = 3 + 2 * pages
+    for i in range(pages):
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> >>")
+        stream = f"BT /F1 12 Tf 72 720 Td (Benchmark document {variant}, page {i + 1}.) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("ascii")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("ascii")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("ascii")
+    return out
+
+
+def make_docx(variant: int) -> bytes:
+    document = docx.Document()
+    for paragraph in sample_text(variant).split("\n\n"):
+        document.add_paragraph(paragraph)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def make_pptx(variant: int, slides: int = 5) -> bytes:
+    presentation = Presentation()
+    for i in range(slides):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[6])
+        box = slide.shapes.add_textbox(Inches(1), Inches(1), Inches(8), Inches(4))
+        box.text_frame.text = f"スライド {i + 1} ({variant}) {PARAGRAPH}"
+    buffer = io.BytesIO()
+    presentation.save(buffer)
+    return buffer.getvalue()
+
+
+def make_txt(variant: int) -> bytes:
+    return sample_text(variant).encode("utf-8")
+
+
+def _make_image(variant: int, image_format: str) -> bytes:
+    image = Image.new("RGB", (1200, 900), "white")
+    ImageDraw.Draw(image).text((40, 40), f"Benchmark image {variant}", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def make_png(variant: int) -> bytes:
+    return _make_image(variant, "PNG")
+
+
+def make_jpeg(variant: int) -> bytes:
+    return _make_image(variant, "JPEG")
+
+
+# 形式 -> (作成関数, ファイル名, MIME タイプ)
+SAMPLES: Dict[str, Tuple[Callable[[int], bytes], str, str]] = {
+    "pdf": (make_pdf, "sample.pdf", "application/pdf"),
+    "docx": (make_docx, "sample.docx",
+             "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    "pptx": (make_pptx, "sample.pptx",
+             "application/vnd.openxmlformats-officedocument.presentationml.presentation"),
+    "txt": (make_txt, "sample.txt", "text/plain"),
+    "png": (make_png, "sample.png", "image/png"),
+    "jpeg": (make_jpeg, "sample.jpg", "image/jpeg"),
+}
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit("usage: python bench/samples.py OUTPUT_DIR")
+    os.makedirs(sys.argv[1], exist_ok=True)
+    for builder, filename, _ in SAMPLES.values():
+        with open(os.path.join(sys.argv[1], filename), "wb") as f:
+            f.write(builder(0))
+        print(os.path.join(sys.argv[1], filename))
+
+
+if __name__ == "__main__":
+    main()
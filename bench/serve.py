@@ -0,0 +1,107 @@
+"""
+ベンチマーク用のサーバー
+Gemini (google.generativeai / google.genai) と Document AI・Vision のクライアントを backend/fakes.py の
+代替実装に差し替えてから app を読み込む。API の使用量をかけずに app 自体の処理性能を測るために使う
+
+    python bench/serve.py --port 5001
+    python bench/serve.py --port 5001 --asgi    # asyncio の経路 (backend/asgi.py) を uvicorn で起動
+    python bench/serve.py --port 5001 --debug   # python backend/dev_server.py と同じ開発用サーバー (デバッガー・リローダー付き)
+
+    # 本番と同じ gunicorn の設定で起動
+    gunicorn -c backend/gunicorn.conf.py --pythonpath bench --bind 127.0.0.1:5001 "serve:create_bench_app()"
+
+外部 API の応答時間は環境変数で指定する (秒)
+    BENCH_TEXT_LATENCY (プロンプト処理・要約) / BENCH_IMAGE_LATENCY (画像生成) / BENCH_TTS_LATENCY (音声合成)
+    BENCH_DOCUMENT_AI_LATENCY / BENCH_VISION_LATENCY
+Gemini の呼び出しを BENCH_FAILURE_RATE の割合 (0〜1) で 503 にして、上流の障害時の挙動を測れる
+生成画像・音声・キャッシュの保存先は起動ごとに新しい一時ディレクトリにする (前回の結果をキャッシュから返さない)
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+from fakes import (FakeDocumentProcessorServiceClient, FakeGenaiClient, FakeGenerativeModel,  # noqa: E402
+                   FakeImageAnnotatorClient)
+
+LATENCY_DEFAULTS = {
+    "BENCH_TEXT_LATENCY": "0.2",
+    "BENCH_IMAGE_LATENCY": "1.0",
+    "BENCH_TTS_LATENCY": "0.5",
+    "BENCH_DOCUMENT_AI_LATENCY": "0.3",
+    "BENCH_VISION_LATENCY": "0.2",
+}
+
+
+def latency(name: str) -> float:
+    return float(os.getenv(name, LATENCY_DEFAULTS[name]))
+
+
+def latency_config():
+    return {name.lower().replace("bench_", ""): latency(name) for name in LATENCY_DEFAULTS}
+
+
+def install_fakes() -> None:
+    """app / tts_service を読み込む前に Gemini のクライアントを差し替える"""
+    import google.generativeai as genai_classic
+    from google import genai
+
+    FakeGenerativeModel.text_latency = latency("BENCH_TEXT_LATENCY")
+    FakeGenerativeModel.image_latency = latency("BENCH_IMAGE_LATENCY")
+    FakeGenerativeModel.failure_rate = float(os.getenv("BENCH_FAILURE_RATE", "0"))
+    genai_classic.GenerativeModel = FakeGenerativeModel
+    genai_classic.configure = lambda **kwargs: None
+    genai.Client = lambda api_key=None, **kwargs: FakeGenaiClient(
+        api_key, text_latency=latency("BENCH_TEXT_LATENCY"), tts_latency=latency("BENCH_TTS_LATENCY"),
+        image_latency=latency("BENCH_IMAGE_LATENCY"), failure_rate=float(os.getenv("BENCH_FAILURE_RATE", "0")))
+
+
+def _prepare_environment() -> None:
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    # Document AI の経路を有効にする (クライアントは下で差し替える)
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT_ID", "bench")
+    os.environ.setdefault("DOCUMENT_AI_PROCESSOR_ID", "bench")
+    # 負荷はすべて同じ接続元から送るため、クライアントごとのレート制限は無効にする
+    # (モデルごとの同時呼び出し数の上限 ADMISSION_* は本番と同じく効く)
+    os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    for name in ("IMAGE_STORE_DIR", "AUDIO_STORE_DIR", "TTS_CACHE_DIR", "EXTRACT_CACHE_DIR"):
+        os.environ.setdefault(name, os.path.join(work_dir, name.lower()))
+
+
+def create_bench_app(asgi: bool = False):
+    """偽のクライアントを使う app (asgi=True なら backend/asgi.py の ASGI アプリ)"""
+    _prepare_environment()
+    install_fakes()
+    import app as app_module
+
+    if app_module.tts_service:
+        app_module.tts_service.document_ai_client = FakeDocumentProcessorServiceClient(
+            latency=latency("BENCH_DOCUMENT_AI_LATENCY"))
+        app_module.tts_service.vision_client = FakeImageAnnotatorClient(
+            latency=latency("BENCH_VISION_LATENCY"), text_for=lambda content: "ベンチマーク用の画像テキスト")
+    if asgi:
+        import asgi as asgi_module
+        return asgi_module.app
+    return app_module.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="偽の Gemini / Google Cloud クライアントで app を起動する")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--asgi", action="store_true", help="asyncio の経路 (backend/asgi.py) を uvicorn で起動する")
+    parser.add_argument("--debug", action="store_true", help="デバッガーとリローダーを有効にする (python backend/dev_server.py と同じ)")
+    args = parser.parse_args()
+    if args.asgi:
+        import uvicorn
+        uvicorn.run(create_bench_app(asgi=True), host=args.host, port=args.port, log_level="warning")
+        return
+    create_bench_app().run(host=args.host, port=args.port, threaded=True, debug=args.debug)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ const clearImageButton = document.getElementById("clear-image-button");
 const newChatButton = document.getElementById("new-chat-button");
 const inputArea = document.querySelector(".input-area");
 
-let chatHistory = []; // Array to store chat history [{role: 'user'/'model', parts: [...]}]
+let conversationId = null; // 履歴はサーバー側で保持し、毎回は新しいターンだけを送る
 let selectedImageData = null; // To store { mime_type: '...', data: '...' (base64) }
 
 // --- Dynamic Textarea Height ---
@@ -80,7 +80,13 @@ function enableInputArea() {
 }
 
 newChatButton.addEventListener("click", () => {
-  chatHistory = []; // Clear history
+  if (conversationId) {
+    // サーバー側の履歴を破棄 (結果は待たない)
+    fetch(`/api/conversations/${conversationId}`, { method: "DELETE" }).catch(
+      () => {}
+    );
+  }
+  conversationId = null; // Clear history
   chatBox.innerHTML = ""; // Clear display
   // Add the initial assistant message back
   addMessage("assistant", [
@@ -95,100 +101,92 @@ newChatButton.addEventListener("click", () => {
 });
 
 // --- Message Handling ---
+// Render a single {type, content} part into an existing message element
+function renderMessagePart(messageDiv, sender, part) {
+  if (part.type === "text") {
+    const p = document.createElement("p");
+    p.textContent = part.content;
+    messageDiv.appendChild(p);
+  } else if (part.type === "image") {
+    // Create a container for the image and download button
+    const imageContainer = document.createElement("div");
+    imageContainer.classList.add("image-container");
+
+    const img = document.createElement("img");
+    img.src = part.content; // Data URL from upload, or /images/<hash> URL from API
+    img.alt = sender === "user" ? "Uploaded Image" : "Generated Image";
+    imageContainer.appendChild(img);
+
+    // Add download button only for assistant-generated images
+    if (sender === "assistant") {
+      const downloadLink = document.createElement("a");
+      downloadLink.href = part.content;
+      // Suggest a filename (you might want to generate a more unique name)
+      downloadLink.download = `generated_image_${Date.now()}.png`;
+      downloadLink.classList.add("download-button");
+      downloadLink.textContent = "⬇"; // Use an icon or text
+      downloadLink.title = "画像をダウンロード"; // Tooltip
+      imageContainer.appendChild(downloadLink);
+    }
+    // For user messages, just add the image (already limited by CSS)
+    else if (sender === "user") {
+      // Just append the img directly if no container needed, or container with only img
+    }
+
+    messageDiv.appendChild(imageContainer);
+  } else if (part.type === "thinking") {
+    const p = document.createElement("p");
+    p.textContent = "考え中";
+    messageDiv.appendChild(p);
+    messageDiv.classList.add("thinking");
+  } else if (part.type === "error") {
+    // Handle error display
+    const p = document.createElement("p");
+    p.textContent = part.content;
+    messageDiv.appendChild(p);
+    messageDiv.classList.add("error"); // Add error class
+  }
+}
+
 function addMessage(sender, contentParts) {
   // contentParts is now an array [{type:'text', content:'...'}, {type:'image', content:'...'}]
   const messageDiv = document.createElement("div");
   messageDiv.classList.add("message", sender);
 
-  const historyEntry = {
-    role: sender === "user" ? "user" : "model",
-    parts: [],
-  };
-
-  contentParts.forEach((part) => {
-    if (part.type === "text") {
-      const p = document.createElement("p");
-      p.textContent = part.content;
-      messageDiv.appendChild(p);
-      historyEntry.parts.push({ text: part.content });
-    } else if (part.type === "image") {
-      // Create a container for the image and download button
-      const imageContainer = document.createElement("div");
-      imageContainer.classList.add("image-container");
-
-      const img = document.createElement("img");
-      img.src = part.content; // Can be data URL from upload or from API
-      img.alt = sender === "user" ? "Uploaded Image" : "Generated Image";
-      imageContainer.appendChild(img);
-
-      // Add download button only for assistant-generated images
-      if (sender === "assistant") {
-        const downloadLink = document.createElement("a");
-        downloadLink.href = part.content;
-        // Suggest a filename (you might want to generate a more unique name)
-        downloadLink.download = `generated_image_${Date.now()}.png`;
-        downloadLink.classList.add("download-button");
-        downloadLink.textContent = "⬇"; // Use an icon or text
-        downloadLink.title = "画像をダウンロード"; // Tooltip
-        imageContainer.appendChild(downloadLink);
-      }
-      // For user messages, just add the image (already limited by CSS)
-      else if (sender === "user") {
-        // Just append the img directly if no container needed, or container with only img
-      }
-
-      messageDiv.appendChild(imageContainer);
-
-      // Add image to history only if it's from the model (generated)
-      // Or if needed for multi-turn image editing later
-      if (sender === "model") {
-        // For history, we need the format expected by the backend helper create_content_part
-        // It expects { inline_data: { mime_type: ..., data: base64_string } }
-        // We only have the data URL here, need to parse it back if storing for history re-use
-        // Let's skip adding model images to history for now to simplify
-      } else if (sender === "user" && part.isUpload) {
-        // User uploads are handled separately before sending, not added to history directly here
-        // But we need to store the necessary info if we want to include uploads in history later
-      }
-    } else if (part.type === "thinking") {
-      const p = document.createElement("p");
-      p.textContent = "考え中";
-      messageDiv.appendChild(p);
-      messageDiv.classList.add("thinking");
-      // Thinking indicators are not added to history
-      return; // Don't add thinking message to history
-    } else if (part.type === "error") {
-      // Handle error display
-      const p = document.createElement("p");
-      p.textContent = part.content;
-      messageDiv.appendChild(p);
-      messageDiv.classList.add("error"); // Add error class
-      // Errors are not added to history
-      return;
-    }
-  });
-
-  // Only add user and model messages to history
-  if (sender === "user" || sender === "model") {
-    // Basic history for text for now
-    const historyParts = contentParts
-      .filter((p) => p.type === "text")
-      .map((p) => ({ text: p.content }));
-    // If user message included an upload, we might want to represent it in history
-    // For now, just storing text parts in history
-    if (historyParts.length > 0) {
-      chatHistory.push({
-        role: sender === "user" ? "user" : "model",
-        parts: historyParts,
-      });
-    }
-  }
+  contentParts.forEach((part) => renderMessagePart(messageDiv, sender, part));
 
   chatBox.appendChild(messageDiv);
   chatBox.scrollTop = chatBox.scrollHeight;
   return messageDiv;
 }
 
+// Read a text/event-stream response body, calling onEvent(eventName, data) per event
+async function readEventStream(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  const dispatch = (block) => {
+    let event = "message";
+    const dataLines = [];
+    block.split("\n").forEach((line) => {
+      if (line.startsWith("event:")) event = line.slice(6).trim();
+      else if (line.startsWith("data:")) dataLines.push(line.slice(5).trimStart());
+    });
+    if (dataLines.length > 0) onEvent(event, JSON.parse(dataLines.join("\n")));
+  };
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      dispatch(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+    }
+  }
+  if (buffer.trim()) dispatch(buffer);
+}
+
 async function sendMessage() {
   const prompt = userInput.value.trim();
   if (!prompt && !selectedImageData) return; // Need prompt or image
@@ -213,8 +211,8 @@ async function sendMessage() {
   // Prepare data for API
   const requestData = {
     prompt: prompt, // Send original text prompt
-    // Send history *excluding* the user message we just added
-    history: chatHistory.slice(0, -1),
+    // 履歴 (生成画像を含む) はサーバーが conversation_id で管理する
+    conversation_id: conversationId,
     image_data: selectedImageData, // Send selected image data { mime_type, data (base64) }
   };
 
@@ -239,16 +237,20 @@ async function sendMessage() {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
+        Accept: "text/event-stream",
       },
-      body: JSON.stringify(requestData), // Send prompt, history, and optional image data
+      body: JSON.stringify({ ...requestData, stream: true }), // Stream parts as they are generated
     });
 
-    if (thinkingMessage && chatBox.contains(thinkingMessage)) {
-      // Check if still exists
-      chatBox.removeChild(thinkingMessage);
-    }
+    const removeThinking = () => {
+      if (thinkingMessage && chatBox.contains(thinkingMessage)) {
+        // Check if still exists
+        chatBox.removeChild(thinkingMessage);
+      }
+    };
 
     if (!response.ok) {
+      removeThinking();
       const errorData = await response.json();
       // Display error message using addMessage
       addMessage("assistant", [
@@ -265,30 +267,43 @@ async function sendMessage() {
       return; // Stop processing on error
     }
 
-    const data = await response.json();
-
-    if (data.results && data.results.length > 0) {
-      // Prepare parts for addMessage
-      const assistantMessageParts = data.results.map((result) => ({
-        type: result.type, // "text" or "image"
-        content: result.content, // text content or base64 data URL
-      }));
-      addMessage("assistant", assistantMessageParts); // Add assistant message parts
-
-      // Check if the response contains an image to trigger session end
-      const hasImage = data.results.some((result) => result.type === "image");
-      if (hasImage) {
-        disableInputArea(); // Disable input and show "New Chat" button
-      } else {
-        // Re-enable input if no image was generated (allow follow-up text chat)
-        enableInputArea();
-        newChatButton.style.display = "none";
+    // Render each streamed part into a single assistant message as it arrives
+    let assistantMessage = null;
+    let hasImage = false;
+    let streamError = null;
+    await readEventStream(response, (event, payload) => {
+      if (event === "error") {
+        streamError = payload.error || "ストリームエラー";
+        return;
       }
-    } else {
+      if (event === "done") {
+        if (payload.conversation_id) conversationId = payload.conversation_id;
+        return;
+      }
+      if (event !== "message") return;
+      removeThinking();
+      if (!assistantMessage) assistantMessage = addMessage("assistant", []);
+      renderMessagePart(assistantMessage, "assistant", payload);
+      if (payload.type === "image") hasImage = true;
+      chatBox.scrollTop = chatBox.scrollHeight;
+    });
+    removeThinking();
+
+    if (streamError) {
+      addMessage("assistant", [
+        { type: "error", content: `エラーが発生しました: ${streamError}` },
+      ]);
+    } else if (!assistantMessage) {
       addMessage("assistant", [
         { type: "text", content: "画像またはテキストが生成されませんでした。" },
       ]);
-      // Re-enable input if nothing was generated
+    }
+
+    // Check if the response contains an image to trigger session end
+    if (hasImage && !streamError) {
+      disableInputArea(); // Disable input and show "New Chat" button
+    } else {
+      // Re-enable input if no image was generated (allow follow-up text chat)
       enableInputArea();
       newChatButton.style.display = "none";
     }
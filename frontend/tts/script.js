@@ -237,18 +237,145 @@ class TTSApp {
     this.uploadZone.classList.remove("dragover");
 
     const files = e.dataTransfer.files;
-    if (files.length > 0) {
+    if (files.length > 1) {
+      this.processFiles(Array.from(files));
+    } else if (files.length > 0) {
       this.processFile(files[0]);
     }
   }
 
   handleFileSelect(e) {
     const files = e.target.files;
-    if (files.length > 0) {
+    if (files.length > 1) {
+      this.processFiles(Array.from(files));
+    } else if (files.length > 0) {
       this.processFile(files[0]);
     }
   }
 
+  processFiles(files) {
+    // 複数ファイル: 画像だけならまとめて OCR、それ以外は一括抽出
+    const allowedTypes = [
+      "application/pdf",
+      "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+      "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+      "text/plain",
+      "image/jpeg",
+      "image/png",
+    ];
+    if (!files.every((file) => allowedTypes.includes(file.type))) {
+      this.showError("サポートされていないファイル形式が含まれています。");
+      return;
+    }
+
+    const totalSize = files.reduce((sum, file) => sum + file.size, 0);
+    if (totalSize > 50 * 1024 * 1024) {
+      this.showError(
+        "ファイルサイズが大きすぎます。合計50MB以内で選択してください。"
+      );
+      return;
+    }
+
+    const imageTypes = ["image/jpeg", "image/png"];
+    const allImages = files.every((file) => imageTypes.includes(file.type));
+    this.uploadedFile = files[0];
+    this.showFilePreview({
+      name: `${files[0].name} ほか ${files.length - 1} 件`,
+      size: totalSize,
+    });
+    if (allImages) {
+      this.extractTextFromImages(files);
+    } else {
+      this.extractTextFromFiles(files);
+    }
+  }
+
+  async extractTextFromFiles(files) {
+    // 一括抽出: 結果は終わった順に NDJSON で届くので、選択順に並べ直して表示する
+    try {
+      this.showStatus(`${files.length} 件のファイルを処理中...`);
+
+      const formData = new FormData();
+      files.forEach((file) => formData.append("files", file));
+
+      const response = await fetch("/api/tts/extract-text/batch", {
+        method: "POST",
+        body: formData,
+      });
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+
+      const texts = new Array(files.length).fill("");
+      const errors = [];
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let completed = 0;
+      for (;;) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop();
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const result = JSON.parse(line);
+          if (result.done) continue;
+          completed += 1;
+          if (result.success) {
+            texts[result.index] = result.text;
+          } else {
+            errors.push(`${result.filename}: ${result.error}`);
+          }
+          this.showStatus(`${completed}/${files.length} 件のファイルを処理しました...`);
+        }
+      }
+
+      const text = texts.filter((t) => t).join("\n\n");
+      if (!text) {
+        throw new Error(errors.join(" / ") || "テキスト抽出に失敗しました。");
+      }
+      this.extractedContent = text;
+      this.showExtractedContent(text);
+      if (errors.length > 0) {
+        this.showError("一部のファイルは抽出できませんでした: " + errors.join(" / "));
+      }
+    } catch (error) {
+      console.error("Batch extraction error:", error);
+      this.showError("ファイルからのテキスト抽出に失敗しました: " + error.message);
+    } finally {
+      this.hideStatus();
+    }
+  }
+
+  async extractTextFromImages(files) {
+    try {
+      this.showStatus(`${files.length} 枚の画像を処理中...`);
+
+      const formData = new FormData();
+      files.forEach((file) => formData.append("files", file));
+
+      const response = await fetch("/api/tts/extract-text/images", {
+        method: "POST",
+        body: formData,
+      });
+      const result = await response.json();
+
+      if (result.success) {
+        this.extractedContent = result.text;
+        this.showExtractedContent(result.text);
+      } else {
+        throw new Error(result.error || "テキスト抽出に失敗しました。");
+      }
+    } catch (error) {
+      console.error("Image OCR error:", error);
+      this.showError("画像からのテキスト抽出に失敗しました: " + error.message);
+    } finally {
+      this.hideStatus();
+    }
+  }
+
   processFile(file) {
     // Validate file type
     const allowedTypes = [
@@ -329,23 +456,64 @@ class TTSApp {
     }
   }
 
+  async hashFile(file) {
+    // crypto.subtle は HTTPS / localhost でのみ使える。使えなければ事前確認を省略
+    if (!window.crypto || !window.crypto.subtle) {
+      return null;
+    }
+    const digest = await window.crypto.subtle.digest(
+      "SHA-256",
+      await file.arrayBuffer()
+    );
+    return Array.from(new Uint8Array(digest))
+      .map((b) => b.toString(16).padStart(2, "0"))
+      .join("");
+  }
+
+  async lookupExtractedText(file) {
+    // 同じファイルを抽出済みならアップロードせずに結果を受け取る
+    try {
+      const fileHash = await this.hashFile(file);
+      if (!fileHash) {
+        return null;
+      }
+      const response = await fetch("/api/tts/extract-text/lookup", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ file_hash: fileHash, file_type: file.type }),
+      });
+      if (!response.ok) {
+        return null;
+      }
+      const result = await response.json();
+      return result.success ? result : null;
+    } catch (error) {
+      console.warn("Extraction lookup failed:", error);
+      return null;
+    }
+  }
+
   async extractTextFromFile(file) {
     try {
       this.showStatus("ファイルを処理中...");
 
-      const formData = new FormData();
-      formData.append("file", file);
+      let result = await this.lookupExtractedText(file);
 
-      const response = await fetch("/api/tts/extract-text", {
-        method: "POST",
-        body: formData,
-      });
+      if (!result) {
+        const formData = new FormData();
+        formData.append("file", file);
 
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
+        const response = await fetch("/api/tts/extract-text", {
+          method: "POST",
+          body: formData,
+        });
 
-      const result = await response.json();
+        if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+        }
+
+        result = await response.json();
+      }
 
       if (result.success) {
         this.extractedContent = result.text;
@@ -724,6 +892,7 @@ class TTSApp {
           speaker_mode: speakerMode,
           style: style,
           rate: 1.0,
+          delivery: "url",
         }),
       });
 
@@ -735,7 +904,7 @@ class TTSApp {
 
       if (result.success) {
         // 音声プレイヤーを表示
-        this.showAudioPlayer(result.audio_data, result.format);
+        this.showAudioPlayer(result.audio_data, result.format, result.audio_url);
         this.showSuccess(
           `${
             speakerMode === "single" ? "単一話者" : "複数話者"
@@ -794,6 +963,7 @@ class TTSApp {
           voice: voiceId,
           text: "こんにちは。これは音声のプレビューです。",
           style: voiceStyleValue,
+          delivery: "url",
         }),
       });
 
@@ -804,22 +974,9 @@ class TTSApp {
       const result = await response.json();
 
       if (result.success) {
-        // Base64デコードしてBlobを作成
-        const binaryString = atob(result.audio_data);
-        const bytes = new Uint8Array(binaryString.length);
-        for (let i = 0; i < binaryString.length; i++) {
-          bytes[i] = binaryString.charCodeAt(i);
-        }
-        const blob = new Blob([bytes], { type: `audio/${result.format}` });
-
-        const audioUrl = URL.createObjectURL(blob);
-        const audio = new Audio(audioUrl);
+        // サーバーに保存された音声をURLで直接再生（Rangeリクエストで逐次読み込み）
+        const audio = new Audio(result.audio_url);
         audio.play();
-
-        // Clean up after playing
-        audio.addEventListener("ended", () => {
-          URL.revokeObjectURL(audioUrl);
-        });
       } else {
         throw new Error(result.error || "音声プレビューに失敗しました");
       }
@@ -864,6 +1021,7 @@ class TTSApp {
           voice: voiceId,
           text: "こんにちは。これは音声のプレビューです。",
           style: document.getElementById("voice-style-extracted")?.value || "",
+          delivery: "url",
         }),
       });
 
@@ -874,22 +1032,9 @@ class TTSApp {
       const result = await response.json();
 
       if (result.success) {
-        // Base64デコードしてBlobを作成
-        const binaryString = atob(result.audio_data);
-        const bytes = new Uint8Array(binaryString.length);
-        for (let i = 0; i < binaryString.length; i++) {
-          bytes[i] = binaryString.charCodeAt(i);
-        }
-        const blob = new Blob([bytes], { type: `audio/${result.format}` });
-
-        const audioUrl = URL.createObjectURL(blob);
-        const audio = new Audio(audioUrl);
+        // サーバーに保存された音声をURLで直接再生（Rangeリクエストで逐次読み込み）
+        const audio = new Audio(result.audio_url);
         audio.play();
-
-        // Clean up after playing
-        audio.addEventListener("ended", () => {
-          URL.revokeObjectURL(audioUrl);
-        });
       } else {
         throw new Error(result.error || "音声プレビューに失敗しました");
       }
@@ -944,33 +1089,18 @@ class TTSApp {
       try {
         this.startGeneration();
 
-        const response = await fetch("/api/tts/generate", {
-          method: "POST",
-          headers: {
-            "Content-Type": "application/json",
-          },
-          body: JSON.stringify({
-            text: textContent,
-            speaker_mode: speakerMode,
-            voice_settings: voiceSettings,
-            style: voiceStyleValue,
-          }),
+        // 文単位で合成された音声を受信しながら順に再生する
+        const result = await this.streamSpeech({
+          text: textContent,
+          speaker_mode: speakerMode,
+          voice_settings: voiceSettings,
+          style: voiceStyleValue,
         });
 
-        if (!response.ok) {
-          throw new Error(`HTTP error! status: ${response.status}`);
-        }
-
-        const result = await response.json();
-
-        if (result.success) {
-          // 音声プレイヤーを表示
-          this.showAudioPlayer(result.audio_data, result.format);
-          this.showSuccess("音声の生成が完了しました！");
-          return; // 成功したので関数を終了
-        } else {
-          throw new Error(result.error || "音声生成に失敗しました");
-        }
+        // 音声プレイヤーには全体を連結した音声を設定（再生し直し・ダウンロード用）
+        this.showAudioPlayer(null, result.format, result.audio_url);
+        this.showSuccess("音声の生成が完了しました！");
+        return; // 成功したので関数を終了
       } catch (error) {
         console.error(
           `Speech generation error (attempt ${retryCount + 1}):`,
@@ -1001,6 +1131,94 @@ class TTSApp {
     }
   }
 
+  // text/event-stream のレスポンスを読み、イベントごとに onEvent(eventName, data) を呼ぶ
+  async readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    const dispatch = (block) => {
+      let event = "message";
+      const dataLines = [];
+      block.split("\n").forEach((line) => {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) dataLines.push(line.slice(5).trimStart());
+      });
+      if (dataLines.length > 0) onEvent(event, JSON.parse(dataLines.join("\n")));
+    };
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let boundary;
+      while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+        dispatch(buffer.slice(0, boundary));
+        buffer = buffer.slice(boundary + 2);
+      }
+    }
+    if (buffer.trim()) dispatch(buffer);
+  }
+
+  // /api/tts/stream からセグメントを受信し、届いた順に連続再生する
+  // 完了時は done イベントの内容（全体音声の audio_url など）を返す
+  async streamSpeech(requestBody) {
+    const response = await fetch("/api/tts/stream", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify(requestBody),
+    });
+
+    if (!response.ok) {
+      throw new Error(`HTTP error! status: ${response.status}`);
+    }
+
+    if (this.streamPlayer) {
+      this.streamPlayer.pause();
+    }
+    const player = new Audio();
+    this.streamPlayer = player;
+    const queue = [];
+    let playing = false;
+    const playNext = () => {
+      if (player.src) URL.revokeObjectURL(player.src);
+      if (queue.length === 0) {
+        playing = false;
+        return;
+      }
+      playing = true;
+      player.src = queue.shift();
+      player.play();
+    };
+    player.addEventListener("ended", playNext);
+
+    let doneEvent = null;
+    await this.readEventStream(response, (event, payload) => {
+      if (event === "segment") {
+        console.log(
+          `Segment ${payload.index + 1}/${payload.total}: synth ${payload.synth_ms}ms, elapsed ${payload.elapsed_ms}ms`
+        );
+        const binaryString = atob(payload.audio_data);
+        const bytes = new Uint8Array(binaryString.length);
+        for (let i = 0; i < binaryString.length; i++) {
+          bytes[i] = binaryString.charCodeAt(i);
+        }
+        const blob = new Blob([bytes], { type: `audio/${payload.format}` });
+        queue.push(URL.createObjectURL(blob));
+        if (!playing) playNext();
+      } else if (event === "error") {
+        throw new Error(payload.error || "音声生成に失敗しました");
+      } else if (event === "done") {
+        doneEvent = payload;
+      }
+    });
+
+    if (!doneEvent) {
+      throw new Error("音声生成が途中で終了しました");
+    }
+    return doneEvent;
+  }
+
   startGeneration() {
     this.isGenerating = true;
     if (this.generateBtn) {
@@ -1037,21 +1255,25 @@ class TTSApp {
     }
   }
 
-  showAudioPlayer(audioData, format) {
-    // Base64デコードしてBlobを作成
-    const binaryString = atob(audioData);
-    const bytes = new Uint8Array(binaryString.length);
-    for (let i = 0; i < binaryString.length; i++) {
-      bytes[i] = binaryString.charCodeAt(i);
-    }
-    const blob = new Blob([bytes], { type: `audio/${format}` });
-
+  showAudioPlayer(audioData, format, audioUrl = null) {
     // Clean up previous audio URL
-    if (this.currentAudioUrl) {
+    if (this.currentAudioUrl && this.currentAudioUrl.startsWith("blob:")) {
       URL.revokeObjectURL(this.currentAudioUrl);
     }
 
-    this.currentAudioUrl = URL.createObjectURL(blob);
+    if (audioUrl) {
+      // サーバー上の音声URLをそのまま使う（シーク時はRangeリクエスト）
+      this.currentAudioUrl = audioUrl;
+    } else {
+      // Base64デコードしてBlobを作成
+      const binaryString = atob(audioData);
+      const bytes = new Uint8Array(binaryString.length);
+      for (let i = 0; i < binaryString.length; i++) {
+        bytes[i] = binaryString.charCodeAt(i);
+      }
+      const blob = new Blob([bytes], { type: `audio/${format}` });
+      this.currentAudioUrl = URL.createObjectURL(blob);
+    }
 
     const audioPlayer = document.getElementById("audio-player");
     const audioPlayerSection = document.getElementById("audio-player-section");
@@ -1073,7 +1295,14 @@ class TTSApp {
     }
 
     try {
-      const response = await fetch(this.currentAudioUrl);
+      // サーバー保存の音声は指定形式に変換して取得（Blob URL はそのまま）
+      const downloadUrl = this.currentAudioUrl.startsWith("blob:")
+        ? this.currentAudioUrl
+        : `${this.currentAudioUrl}?format=${format}`;
+      const response = await fetch(downloadUrl);
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
       const blob = await response.blob();
 
       const url = URL.createObjectURL(blob);